@@ -0,0 +1,182 @@
+import asyncio
+import os
+import weakref
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, Hashable, Optional
+
+from .QRBatch import RenderSpec
+
+# Define error raised when a render is rejected because the service queue is full
+class ServiceOverloaded(RuntimeError):
+    pass
+
+# Define an in-flight render, shared by every caller asking for the same (payload, spec)
+@dataclass
+class _InFlight:
+    task: asyncio.Task
+    waiters: int = 0
+
+# Define an asyncio-facing render service
+# At most max_concurrency renders run in the executor at once, and at most max_queue more
+# wait for a slot; further requests raise ServiceOverloaded instead of piling up
+class RenderService:
+
+    # Define initializer
+    def __init__(self,
+                 max_concurrency: Optional[int] = None,
+                 max_queue: int = 64,
+                 executor: Optional[Executor] = None):
+
+        # Set limits
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self.max_queue = max_queue
+
+        # Set executor (a private thread pool unless another one is passed)
+        self.__owns_executor = executor is None
+        self.__executor = executor if executor is not None else ThreadPoolExecutor(
+            max_workers=self.max_concurrency, thread_name_prefix="customQR-render")
+
+        # Set backpressure state
+        self.__slots = asyncio.Semaphore(self.max_concurrency)
+        self.__waiting = 0
+        self.__running = 0
+
+        # Set in-flight renders, keyed by the fingerprint of (payload, spec)
+        self.__inflight: Dict[Hashable, _InFlight] = {}
+        self.__closed = False
+
+        # Set counters
+        self.__counters = {"renders": 0, "coalesced": 0, "rejected": 0, "cancelled": 0}
+
+    # Define async context manager support
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # Define function to render one payload, returning an image or encoded bytes
+    # Identical in-flight requests share one render, so callers must not modify returned images
+    async def render(self, payload: str, spec: Optional[RenderSpec] = None) -> Any:
+
+        # Refuse new work once closed
+        if self.__closed:
+            raise RuntimeError("RenderService is closed")
+        spec = spec if spec is not None else RenderSpec()
+
+        # Join a matching in-flight render, or start one
+        key = self._requestKey(payload, spec)
+        entry = self.__inflight.get(key)
+        if entry is None:
+            entry = self.__inflight[key] = _InFlight(asyncio.get_running_loop().create_task(self._render(payload, spec)))
+            entry.task.add_done_callback(lambda _: self._forget(key, entry))
+        else:
+            self.__counters["coalesced"] += 1
+
+        # Wait without letting one caller's cancellation cancel the others
+        entry.waiters += 1
+        try:
+            return await asyncio.shield(entry.task)
+        finally:
+
+            # Cancel the shared render once nobody is waiting for it
+            entry.waiters -= 1
+            if entry.waiters == 0 and not entry.task.done():
+                entry.task.cancel()
+                self.__counters["cancelled"] += 1
+
+    # Define function to key a request by value, so equal specs built separately share a render
+    # Specs that cannot be fingerprinted (unsupported or self-referencing values, unreadable style files)
+    # only coalesce with requests passing the same spec object; the render itself reports any real error
+    @staticmethod
+    def _requestKey(payload: str, spec: RenderSpec):
+        try:
+            return spec.cache_key(payload)
+        except (TypeError, RecursionError, OSError):
+            return (payload, id(spec))
+
+    # Define function to drop a finished render from the in-flight table
+    def _forget(self, key: Hashable, entry: _InFlight):
+        if self.__inflight.get(key) is entry:
+            del self.__inflight[key]
+
+    # Define function to wait for an executor slot and run one render
+    async def _render(self, payload: str, spec: RenderSpec):
+
+        # Fail fast when every slot is busy and the queue is full
+        if self.__slots.locked() and self.__waiting >= self.max_queue:
+            self.__counters["rejected"] += 1
+            raise ServiceOverloaded(f"Render queue is full ({self.max_queue} waiting)")
+
+        # Wait for a slot
+        self.__waiting += 1
+        try:
+            await self.__slots.acquire()
+        finally:
+            self.__waiting -= 1
+
+        # Encode and render in the executor
+        self.__running += 1
+        future = self.__executor.submit(spec.render, payload)
+        try:
+            result = await asyncio.wrap_future(future)
+            self.__counters["renders"] += 1
+            return result
+        finally:
+
+            # A render that already started cannot be interrupted, so it keeps its slot until it finishes
+            if future.cancel() or future.done():
+                self._releaseSlot()
+            else:
+                loop = asyncio.get_running_loop()
+                future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._releaseSlot))
+
+    # Define function to return an executor slot
+    def _releaseSlot(self):
+        self.__running -= 1
+        self.__slots.release()
+
+    # Define function to report the service's load and counters
+    def stats(self):
+        return {
+            "running": self.__running,
+            "waiting": self.__waiting,
+            "in_flight": len(self.__inflight),
+            **self.__counters,
+        }
+
+    # Define function to stop accepting work, wait for in-flight renders and release the executor
+    # cancel drops in-flight renders instead of waiting for them
+    async def close(self, cancel: bool = False):
+
+        self.__closed = True
+
+        # Wait for (or cancel) in-flight renders
+        tasks = [entry.task for entry in self.__inflight.values()]
+        if cancel:
+            for task in tasks:
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Shut down our own executor without blocking the event loop
+        if self.__owns_executor:
+            await asyncio.get_running_loop().run_in_executor(None, self.__executor.shutdown)
+
+# Default services, one per event loop
+_DEFAULT_SERVICES = weakref.WeakKeyDictionary()
+
+# Define function to get the running loop's default service
+def get_default_service() -> RenderService:
+
+    loop = asyncio.get_running_loop()
+    service = _DEFAULT_SERVICES.get(loop)
+    if service is None:
+        service = _DEFAULT_SERVICES[loop] = RenderService()
+    return service
+
+# Define function to render one payload without blocking the event loop
+# Uses the running loop's default service unless another one is passed
+async def render_async(payload: str, spec: Optional[RenderSpec] = None, service: Optional[RenderService] = None):
+    service = service if service is not None else get_default_service()
+    return await service.render(payload, spec)
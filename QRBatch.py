@@ -0,0 +1,307 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from io import BytesIO
+from itertools import islice
+import os
+import PIL
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, Optional, Union
+
+from .QREngine import CanvasPool, QRGenerator, RenderSettings
+from .QRCache import LRUCache, OutputCache, fingerprint_digest
+from .QRBlock import QRBlockRenderer
+from .QRText import GLYPH_CACHE, QRTextBlockRenderer, QRTextStyle
+from .QRImage import QRImageBlockRenderer, QRImageStyle
+from .QRShared import SharedImage, share_resource_tracker
+
+# Version of the rendered output, part of every cache key
+# Bump it whenever a change to the encoder or renderers alters the output of an unchanged spec
+OUTPUT_VERSION = 1
+
+# Define a picklable description of how to render a payload
+@dataclass
+class RenderSpec:
+
+    # Renderer class and its inputs
+    renderer: type = QRBlockRenderer
+    renderSettings: RenderSettings = field(default_factory=RenderSettings)
+    style: Optional[Union[QRTextStyle, QRImageStyle]] = None
+    protocol: Optional[Any] = None
+
+    # Encode results to bytes in this format (e.g. "PNG"), or return images if None
+    output_format: Optional[str] = None
+    compress_level: int = 6
+
+    # QRGenerator encoder backend, and whether to segment payloads optimally
+    encoder: str = "qrcode"
+    optimize_segments: bool = False
+
+    # Optional cache of encoded outputs, used when output_format is set
+    output_cache: Optional[OutputCache] = field(default=None, repr=False, compare=False)
+
+    # Define function to encode one payload
+    def encode(self, payload: str):
+        return QRGenerator(payload, instrument=self.renderSettings.instrument,
+                           encoder=self.encoder, optimize_segments=self.optimize_segments)
+
+    # Define function to get the stable cache key of a payload rendered with this spec
+    # Covers the renderer, settings, style (with the contents of its font and image files) and protocol parameters,
+    # salted with the output version and the Pillow version that encodes the files
+    def cache_key(self, payload: str):
+        return fingerprint_digest({"version": [OUTPUT_VERSION, PIL.__version__], "payload": payload, "spec": self})
+
+    # Define function to get the cache key as an HTTP entity tag
+    def etag(self, payload: str):
+        return f'"{self.cache_key(payload)}"'
+
+    # Define function to build a renderer for one QR code
+    def build(self, QR: QRGenerator):
+
+        # Text renderers share the process-wide glyph cache
+        if issubclass(self.renderer, QRTextBlockRenderer):
+            return self.renderer(QR, self.style, self.renderSettings, self.protocol, glyph_cache=GLYPH_CACHE)
+
+        # Image renderers take a style but no protocol
+        if issubclass(self.renderer, QRImageBlockRenderer):
+            return self.renderer(QR, self.style, self.renderSettings)
+
+        # Block renderers take an optional protocol
+        return self.renderer(QR, self.renderSettings, self.protocol)
+
+    # Define function to get the output cache key of a payload, or None when outputs are not cached
+    # Specs that cannot be fingerprinted completely are rendered every time rather than risk a shared key
+    def _outputKey(self, payload: str):
+
+        if self.output_cache is None or self.output_format is None:
+            return None
+        try:
+            return self.cache_key(payload)
+        except TypeError:
+            return None
+
+    # Define function to encode and render one payload
+    def render(self, payload: str):
+
+        # Encoded outputs come from the cache when one is set
+        key = self._outputKey(payload)
+        if key is not None:
+            return self.output_cache.get_or_create(key, lambda: self._render(payload))
+        return self._render(payload)
+
+    # Define function to encode and render one payload, without the output cache
+    def _render(self, payload: str):
+
+        # Encode the payload
+        renderer = self.build(self.encode(payload))
+
+        # Return the image, or its encoded bytes
+        if self.output_format is None:
+            return renderer.render()
+
+        buffer = BytesIO()
+        renderer.render_to(buffer, self.output_format, self.compress_level)
+        return buffer.getvalue()
+
+    # Define function to compile a reusable render plan from this spec
+    def compile(self, max_shapes: int = 4, canvas_pool: Optional[CanvasPool] = None):
+        return RenderPlan(self, max_shapes, canvas_pool)
+
+# Define a render plan: payload-independent state compiled once from a spec
+# Fonts, glyphs, tiles and cell positions are kept per matrix size, and encoded renders return
+# their canvases to a pool, so rendering another code of a known size only does the
+# matrix-dependent work. Plans are not thread-safe
+class RenderPlan:
+
+    # Define initializer
+    # canvas_pool defaults to the spec's pool, or a private one
+    def __init__(self, spec: RenderSpec, max_shapes: int = 4, canvas_pool: Optional[CanvasPool] = None):
+
+        # Set spec
+        self.spec = spec
+
+        # Set canvas pool
+        if canvas_pool is None:
+            canvas_pool = spec.renderSettings.canvas_pool or CanvasPool()
+        self.canvas_pool = canvas_pool
+
+        # Compiled renderers, keyed by matrix shape
+        self.__renderers = LRUCache(maxsize=max_shapes)
+
+    # Define function to get the renderer compiled for a code's size, bound to that code
+    def _getRenderer(self, QR: QRGenerator):
+
+        # Compile a renderer for sizes not seen yet
+        key = QR.QRMatrix.shape
+        renderer = self.__renderers.get(key)
+        if renderer is None:
+            renderer = self.spec.build(QR)
+            self.__renderers.put(key, renderer)
+
+        # Point it at this code, drawing on the plan's pool
+        renderer._rebind(QR, self.canvas_pool)
+        return renderer
+
+    # Define function to render a code to an image
+    def render(self, QR: QRGenerator):
+        return self._getRenderer(QR).render()
+
+    # Define function to render a code straight into a file-like object
+    def render_to(self, QR: QRGenerator, stream: BinaryIO, format: str = "PNG", compress_level: Optional[int] = None):
+
+        compress_level = self.spec.compress_level if compress_level is None else compress_level
+        self._getRenderer(QR).render_to(stream, format, compress_level)
+
+    # Define function to encode and render one payload, like RenderSpec.render
+    def render_payload(self, payload: str):
+
+        # Encoded outputs come from the spec's cache when one is set
+        key = self.spec._outputKey(payload)
+        if key is not None:
+            return self.spec.output_cache.get_or_create(key, lambda: self._renderPayload(payload))
+        return self._renderPayload(payload)
+
+    # Define function to encode and render one payload, without the output cache
+    def _renderPayload(self, payload: str):
+
+        # Encode the payload
+        QR = self.spec.encode(payload)
+
+        # Return the image, or its encoded bytes
+        if self.spec.output_format is None:
+            return self.render(QR)
+
+        buffer = BytesIO()
+        self.render_to(QR, buffer, self.spec.output_format)
+        return buffer.getvalue()
+
+# Define a payload that could not be rendered, returned in place of its result when failures are captured
+@dataclass
+class RenderFailure:
+    payload: str
+
+    # Exception type and message, e.g. "ValueError: Invalid version (was 41, expected 1 to 40)"
+    error: str
+
+# Define function to call render(payload), returning a RenderFailure instead of raising
+def render_or_failure(render: Callable[[str], Any], payload: str):
+    try:
+        return render(payload)
+    except Exception as error:
+        return RenderFailure(payload, f"{type(error).__name__}: {error}")
+
+# Per-worker state, set once by the pool initializer
+_WORKER_PLAN: Optional[RenderPlan] = None
+
+# Define pool initializer: compile the spec and warm the worker's caches
+def _initWorker(spec: RenderSpec, warmup_payload: Optional[str]):
+
+    global _WORKER_PLAN
+    _WORKER_PLAN = spec.compile()
+
+    # Rendering once loads fonts, glyphs and tiles into the plan and process-wide caches
+    # The output is not cached, and a failure is left for the real payloads to report
+    if warmup_payload is not None:
+        try:
+            _WORKER_PLAN._renderPayload(warmup_payload)
+        except Exception:
+            pass
+
+# Define function to render one payload into a shared memory block
+def _renderShared(render: Callable[[str], Any], payload: str):
+    return SharedImage.create(render(payload))
+
+# Define worker task: render a chunk of payloads with the worker's plan
+# shared_memory returns images as shared memory handles instead of pickled pixels, and
+# capture_failures returns a RenderFailure for each payload that raises
+def _renderChunk(payloads: list, shared_memory: bool = False, capture_failures: bool = False):
+
+    # Choose how each payload is rendered
+    render = _WORKER_PLAN.render_payload
+    if shared_memory:
+        render = partial(_renderShared, render)
+    if capture_failures:
+        render = partial(render_or_failure, render)
+
+    return [render(payload) for payload in payloads]
+
+# Define function to yield a chunk's results, freeing the shared blocks of any the caller never receives
+def _yieldChunk(results: list, shared_memory: bool):
+
+    for index, result in enumerate(results):
+        try:
+            yield result
+        except GeneratorExit:
+            if shared_memory:
+                for handle in results[index + 1:]:
+                    if isinstance(handle, SharedImage):
+                        handle.release()
+            raise
+
+# Define function to split an iterable into lists of at most size items
+def _chunked(iterable: Iterable, size: int):
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+# Define function to render many payloads across a process pool
+# Results are yielded in input order, as images or encoded bytes
+# shared_memory yields SharedImage handles instead of images, so pixels are never pickled;
+# the caller owns each handle and must release() it
+# capture_failures yields a RenderFailure for each payload that raises, instead of ending the batch
+def render_batch(payloads: Iterable[str],
+                 spec: RenderSpec,
+                 max_workers: Optional[int] = None,
+                 chunksize: int = 64,
+                 max_pending: Optional[int] = None,
+                 warmup_payload: Optional[str] = "warmup",
+                 shared_memory: bool = False,
+                 capture_failures: bool = False) -> Iterator[Any]:
+
+    # Encoded outputs are already compact, so shared memory only applies to images
+    if shared_memory and spec.output_format is not None:
+        raise ValueError("shared_memory only applies when spec.output_format is None")
+
+    # Workers must register their blocks with this process' resource tracker
+    if shared_memory:
+        share_resource_tracker()
+
+    # Create the pool, warming each worker once
+    max_workers = max_workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=max_workers,
+                                   initializer=_initWorker,
+                                   initargs=(spec, warmup_payload))
+
+    # Limit the chunks in flight so payloads are read lazily
+    if max_pending is None:
+        max_pending = 2 * max_workers
+
+    pending = deque()
+    try:
+
+        # Submit chunks, yielding the oldest results once enough are in flight
+        for chunk in _chunked(payloads, chunksize):
+            pending.append(executor.submit(_renderChunk, chunk, shared_memory, capture_failures))
+            if len(pending) >= max_pending:
+                yield from _yieldChunk(pending.popleft().result(), shared_memory)
+
+        # Drain the remaining chunks
+        while pending:
+            yield from _yieldChunk(pending.popleft().result(), shared_memory)
+
+    finally:
+
+        # Drop queued work if the caller stopped early
+        executor.shutdown(wait=True, cancel_futures=True)
+
+        # Free the blocks of chunks that finished but were never yielded
+        if shared_memory:
+            for future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    for handle in future.result():
+                        if isinstance(handle, SharedImage):
+                            handle.release()
@@ -0,0 +1,238 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+from itertools import product
+
+import numpy as np
+import PIL
+from PIL import Image as PILImage, ImageFont
+
+from .QREngine import QRGenerator, QRRenderer, RenderSettings, reduce_image_mode, write_image
+from .QRBlock import QRBlockRenderer
+from .QRText import FONT_CACHE, FONT_METRICS_CACHE, GLYPH_CACHE, QRTextBlockRenderer, QRTextStyle, RepeatingTextStrategy
+from .QRImage import TILE_CACHE, QRImageBlockRenderer, QRImageStyle
+from .QRVerify import verify_image
+
+# Default sweep: payload lengths roughly cover versions 2, 7, 17 and 31
+PAYLOAD_LENGTHS = (20, 120, 500, 1200)
+PX_PER_CELL = (4, 10)
+CELLS_PER_BLOCK = (1, 2)
+RENDERERS = ("block", "text", "image")
+
+# Define function to write the benchmark's font and images into a directory
+# Only locally generated assets are used, so runs are reproducible anywhere
+def make_assets(directory: str):
+
+    # Write Pillow's bundled TrueType font to disk
+    font_path = os.path.join(directory, "bench_font.ttf")
+    with open(font_path, "wb") as file:
+        file.write(ImageFont.load_default(size=10).font_bytes)
+
+    # Write two seeded noise images with different aspect ratios
+    rng = np.random.default_rng(0)
+    on_path = os.path.join(directory, "bench_on.png")
+    off_path = os.path.join(directory, "bench_off.png")
+    PILImage.fromarray(rng.integers(0, 256, (96, 128, 3), dtype=np.uint8)).save(on_path)
+    PILImage.fromarray(rng.integers(0, 256, (128, 80, 4), dtype=np.uint8)).save(off_path)
+
+    return {"font_path": font_path, "on_image_filename": on_path, "off_image_filename": off_path}
+
+# Define function to build a deterministic payload of a given length
+def make_payload(length: int):
+    base = "https://example.com/campaign?id="
+    return (base + "0123456789abcdefghijklmnopqrstuvwxyz" * (length // 36 + 1))[:length]
+
+# Define function to build a renderer by name
+def make_renderer(name: str, QR: QRGenerator, renderSettings: RenderSettings, assets: dict):
+
+    if name == "block":
+        return QRBlockRenderer(QR, renderSettings)
+    if name == "text":
+        return QRTextBlockRenderer(QR, QRTextStyle(assets["font_path"]), renderSettings,
+                                   RepeatingTextStrategy("QRCODE%", overwrap=True))
+    if name == "image":
+        style = QRImageStyle(on_image_filename=assets["on_image_filename"],
+                             off_image_filename=assets["off_image_filename"])
+        return QRImageBlockRenderer(QR, style, renderSettings)
+
+    raise ValueError(f"Unknown renderer: {name}")
+
+# Define function to drop every process-wide cache, so each repeat pays full cost
+def clear_caches():
+    for cache in (FONT_CACHE, FONT_METRICS_CACHE, GLYPH_CACHE, TILE_CACHE):
+        cache.clear()
+
+# Define function to run one stage, recording either its time or its peak traced allocation
+# The process' peak RSS so far is recorded after the stage's first run; it only ever grows, so a
+# stage's own peak shows as a rise over the stage before it
+def _measure(stage: dict, func, trace: bool = False):
+
+    # Trace Python and NumPy allocations made by the stage
+    if trace:
+        tracemalloc.start()
+        result = func()
+        stage["peak_alloc_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result
+
+    # Otherwise time it, keeping the best time across repeats
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    stage["wall_s"] = min(stage.get("wall_s", elapsed), elapsed)
+    stage.setdefault("peak_rss_kb", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    return result
+
+# Define function to run one benchmark case
+def run_case(case: dict, assets: dict, repeat: int = 3, warm: bool = False):
+
+    # Set up the case
+    payload = make_payload(case["payload_length"])
+    renderSettings = RenderSettings(px_per_cell=case["px_per_cell"], cells_per_block=case["cells_per_block"])
+    stages = {name: {} for name in ("encode", "build", "cells", "draw", "verify", "reduce_mode", "encode_to_bytes")}
+    output_bytes = 0
+
+    # Run every stage, timed repeat times, then once more under tracemalloc
+    # Tracing slows allocation-heavy code, so it never overlaps with timing
+    for trace in [False] * repeat + [True]:
+        if not warm:
+            clear_caches()
+
+        QR = _measure(stages["encode"], lambda: QRGenerator(payload), trace)
+        renderer = _measure(stages["build"], lambda: make_renderer(case["renderer"], QR, renderSettings, assets), trace)
+        _measure(stages["cells"], lambda: QRRenderer(QR, renderSettings).get_cells(), trace)
+        image = _measure(stages["draw"], renderer.render, trace)
+
+        # Read the drawn image back, as RenderSettings.verify would, to keep its cost comparable with drawing
+        _measure(stages["verify"], lambda: verify_image(image, QR, renderSettings), trace)
+
+        # Reduce and encode the image drawn above, as render_to does, so drawing is not counted again
+        image = _measure(stages["reduce_mode"], lambda: reduce_image_mode(image), trace)
+        buffer = BytesIO()
+        _measure(stages["encode_to_bytes"], lambda: write_image(image, buffer), trace)
+        output_bytes = len(buffer.getvalue())
+
+    # Report the case; peak_rss_kb is the whole case's peak, as each case runs in its own process
+    return {
+        **case,
+        "modules": QR.width,
+        "image_size": QRRenderer(QR, renderSettings).get_size()[0],
+        "output_bytes": output_bytes,
+        "stages": stages,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+# Define function to run one case in a fresh process, so peak RSS is per case
+def _runIsolated(args):
+    return run_case(*args)
+
+# Define function to run the full sweep
+def run_suite(payload_lengths=PAYLOAD_LENGTHS,
+              px_per_cell=PX_PER_CELL,
+              cells_per_block=CELLS_PER_BLOCK,
+              renderers=RENDERERS,
+              repeat: int = 3,
+              warm: bool = False,
+              progress=None):
+
+    # Build the case list
+    cases = [
+        {"renderer": renderer, "payload_length": length, "px_per_cell": px, "cells_per_block": cpb}
+        for renderer, length, px, cpb in product(renderers, payload_lengths, px_per_cell, cells_per_block)
+    ]
+
+    # Run every case in its own child process
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        assets = make_assets(directory)
+        with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+            for result in pool.imap(_runIsolated, [(case, assets, repeat, warm) for case in cases]):
+                results.append(result)
+                if progress is not None:
+                    progress(result)
+
+    # Return results with enough context to compare runs
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "warm": warm,
+        },
+        "results": results,
+    }
+
+# Define function to key a result by its case parameters
+def _caseKey(result: dict):
+    return (result["renderer"], result["payload_length"], result["px_per_cell"], result["cells_per_block"])
+
+# Define function to compare two result files, returning per-stage time ratios (new / old)
+def compare(old: dict, new: dict):
+
+    # Match cases present in both runs
+    old_results = {_caseKey(result): result for result in old["results"]}
+    rows = []
+    for result in new["results"]:
+        previous = old_results.get(_caseKey(result))
+        if previous is None:
+            continue
+
+        # Compare each stage's wall time
+        for stage, values in result["stages"].items():
+            before = previous["stages"].get(stage, {}).get("wall_s")
+            if before:
+                rows.append((*_caseKey(result), stage, before, values["wall_s"], values["wall_s"] / before))
+
+    return rows
+
+# Define command-line entry point
+def main(argv=None):
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Benchmark customQR renderers.")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="compare against a previous JSON results file")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--warm", action="store_true", help="keep font, glyph and tile caches between repeats")
+    parser.add_argument("--payload-lengths", type=int, nargs="+", default=PAYLOAD_LENGTHS)
+    parser.add_argument("--px-per-cell", type=int, nargs="+", default=PX_PER_CELL)
+    parser.add_argument("--cells-per-block", type=int, nargs="+", default=CELLS_PER_BLOCK)
+    parser.add_argument("--renderers", nargs="+", choices=RENDERERS, default=RENDERERS)
+    args = parser.parse_args(argv)
+
+    # Print one line per case as it finishes
+    def progress(result):
+        times = " ".join(f"{stage}={values['wall_s'] * 1000:.2f}ms" for stage, values in result["stages"].items())
+        print(f"{result['renderer']:>5} len={result['payload_length']:<5} px={result['px_per_cell']:<3} "
+              f"cpb={result['cells_per_block']} modules={result['modules']:<3} {times} "
+              f"case peak rss={result['peak_rss_kb']}KB", file=sys.stderr)
+
+    # Run the sweep
+    results = run_suite(args.payload_lengths, args.px_per_cell, args.cells_per_block,
+                        args.renderers, args.repeat, args.warm, progress)
+
+    # Write results
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    # Compare against a previous run
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+        for renderer, length, px, cpb, stage, before, after, ratio in compare(previous, results):
+            print(f"{renderer:>5} len={length:<5} px={px:<3} cpb={cpb} {stage:<15} "
+                  f"{before * 1000:9.2f}ms -> {after * 1000:9.2f}ms  x{ratio:.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,10 @@
-from .QREngine import QRGenerator, RenderSettings, QRRenderer, QRCell
-from typing import Tuple, Protocol, Optional
+from .QREngine import CanvasPool, IndexedCanvas, QRGenerator, RenderSettings, QRRenderer, QRCell, QRCellGrid, pack_rgba, protocol_method
+from .QRInstrument import count, stage
+from .QRVerify import check_render
+from functools import partial
+from typing import BinaryIO, Tuple, Protocol, Optional
+from PIL import Image as PILImage
+import numpy as np
 
 # Define interface for cell rendering
 class BlockRenderingProtocol(Protocol):
@@ -7,10 +12,41 @@ class BlockRenderingProtocol(Protocol):
     def __call__(self, cell: QRCell, qr: QRGenerator, renderSettings: RenderSettings) -> Tuple[int, int, int]:
         ...
 
+# Define interface for batched cell rendering
+# Receives the whole cell grid as columns and returns an (N, 3) array of colors in cell order
+class BatchBlockRenderingProtocol(Protocol):
+
+    def render_cells(self, cells: QRCellGrid, qr: QRGenerator, renderSettings: RenderSettings) -> np.ndarray:
+        ...
+
+# Define adapter running a per-cell protocol through the batched interface
+class BlockProtocolAdapter:
+
+    def __init__(self, protocol: BlockRenderingProtocol):
+        self.protocol = protocol
+
+    # Call the protocol once per cell, collecting the colors
+    def render_cells(self, cells: QRCellGrid, qr: QRGenerator, renderSettings: RenderSettings):
+        return np.array([self.protocol(cell, qr, renderSettings) for cell in cells], dtype=np.uint8).reshape(-1, 3)
+
+# Define function to get the batched form of a block protocol
+def batch_block_protocol(protocol):
+
+    # Protocols with render_cells are already batched, unless a subclass overrode __call__ alone
+    if protocol_method(protocol, "render_cells") is not None:
+        return protocol
+
+    return BlockProtocolAdapter(protocol)
+
+# Define function to repeat every packed RGBA value of rows scale times across, into pixels
+def _upscaleRows(pixels: np.ndarray, rows: np.ndarray, scale: int):
+    height, width = rows.shape
+    pixels.view(np.uint32).reshape(height, width, scale)[...] = rows[:, :, None]
+
 # Define QRBlockRenderer
 class QRBlockRenderer:
-    def __init__(self, 
-                 QR: QRGenerator, 
+    def __init__(self,
+                 QR: QRGenerator,
                  renderSettings: RenderSettings,
                  block_rendering_protocol: Optional[BlockRenderingProtocol] = None):
 
@@ -23,70 +59,193 @@ class QRBlockRenderer:
         # Create a base renderer
         self.__renderer = QRRenderer(self.QR, renderSettings)
 
-        # Get the canvas
-        self.__canvas = self.__renderer.get_canvas()
-
         # Get the cells
-        self.cells = self.__renderer.get_cells()
+        self.cells = self.__renderer.get_cell_grid()
 
         # Set get cell function
         self.protocol = block_rendering_protocol if block_rendering_protocol else SimpleBlockProtocol()
 
-    # Define function for converting cell values into pixel values
-    def _getXYPos(self, cell: QRCell):
-
-        # Calculate pixel coordinates
-        xpos_start = (cell.x * 
-                self.__renderSettings.cells_per_block + 
-                cell.dx) * self.__renderSettings.px_per_cell
-        
-        ypos_start = (cell.y *
-                self.__renderSettings.cells_per_block +
-                cell.dx) * self.__renderSettings.px_per_cell
-        
-        xpos_end = ((cell.x + 1) * 
-                self.__renderSettings.cells_per_block + 
-                cell.dx) * self.__renderSettings.px_per_cell
-        
-        ypos_end = ((cell.y + 1) *
-                self.__renderSettings.cells_per_block +
-                cell.dx) * self.__renderSettings.px_per_cell
-
-        # Return pixel values
-        return (xpos_start, ypos_start, xpos_end, ypos_end)
-    
+    # Define function to point the renderer at another QR code of the same size
+    # Everything that does not depend on the payload is kept; canvas_pool, if set, overrides the one in renderSettings
+    def _rebind(self, QR: QRGenerator, canvas_pool: Optional[CanvasPool] = None):
+        self.QR = QR
+        self.cells = self.__renderer.rebind(QR, canvas_pool)
+
     # Define function for rendering
     def render(self):
 
-        # Iterate through cells
-        for cell in self.cells:
+        # Protocols that only depend on cell.value expose their two colors,
+        # which lets the whole image be built as one array upscale
+        get_palette = protocol_method(self.protocol, "get_palette")
+        with stage(self.__renderSettings.instrument, "draw"):
+            if get_palette is not None:
+                image = self._renderPalette(get_palette())
+
+            # Otherwise color every cell in one batched call, then upscale
+            else:
+                image = self._renderColors(self._getCellColors())
+
+        # Read the image back when asked
+        check_render(image, self.QR, self.__renderSettings)
+        return image
+
+    # Define function for rendering the image as horizontal strips of band_height pixels
+    # indexed yields 1-bit or palette strips for two-color protocols instead of RGBA
+    def render_bands(self, band_height: int, indexed: bool = False):
+
+        # Get the palette, if the protocol has one, otherwise every cell's color once for all bands
+        get_palette = protocol_method(self.protocol, "get_palette")
+        colors = self._getCellColors() if get_palette is None else None
+
+        # Iterate through bands
+        for top, bottom in self.__renderer.get_bands(band_height):
+            with stage(self.__renderSettings.instrument, "draw"):
+
+                # Two-color protocols slice the module matrix
+                if get_palette is not None and indexed:
+                    band = self._renderIndexed(get_palette(), top, bottom)
+                elif get_palette is not None:
+                    band = self._renderPalette(get_palette(), top, bottom)
+
+                # Anything else slices the cell colors
+                else:
+                    band = self._renderColors(colors, top, bottom)
+
+            yield band
+
+    # Define function for getting every cell's color, as a (cell row, cell column) grid of packed RGBA
+    def _getCellColors(self):
+
+        # Per-cell protocols are run through the batched interface by an adapter
+        protocol = batch_block_protocol(self.protocol)
+        with stage(self.__renderSettings.instrument, "protocol"):
+            colors = protocol.render_cells(self.cells, self.QR, self.__renderSettings)
 
-            color = self.protocol(cell, self.QR, self.__renderSettings)
+        # Record one protocol result per cell
+        count(self.__renderSettings.instrument, "protocol." + type(self.protocol).__name__, len(self.cells))
 
-            # Call render cell
-            self._renderCell(cell, color)
+        # Arrange colors as one opaque RGBA value per cell
+        grid = self.cells.to_grid(np.asarray(colors, dtype=np.uint8))
+        rgba = np.empty((*grid.shape[:2], 4), dtype=np.uint8)
+        rgba[..., :3] = grid
+        rgba[..., 3] = 255
+        return pack_rgba(rgba)
 
-        # Then, return the canvas
-        return self.__canvas.image
-    
-    # Define function for rendering a single cells
-    def _renderCell(self, cell, color: Tuple[int, int, int]):
+    # Define function for rendering pixel rows top to bottom from the cell color grid
+    def _renderColors(self, colors: np.ndarray, top: int = 0, bottom: Optional[int] = None):
 
-        # Get absolute x and y pixel positions
-        xpos_start, ypos_start, xpos_end, ypos_end = self._getXYPos(cell)
+        # Look up colors per pixel row, then upscale each cell across its width
+        px_per_cell = self.__renderSettings.px_per_cell
+        if bottom is None:
+            bottom = colors.shape[0] * px_per_cell
+        pixels = self.__renderer.get_pixels((bottom - top, colors.shape[1] * px_per_cell, 4))
+        _upscaleRows(pixels, colors[np.arange(top, bottom) // px_per_cell], px_per_cell)
 
-        # Draw the square
-        self.__canvas.draw.rectangle(
-            xy=((xpos_start, ypos_start), (xpos_end, ypos_end)),
-            fill=color,
-        )
+        # Hand the finished buffer to PIL in one call
+        return PILImage.fromarray(pixels, "RGBA")
+
+    # Define function for getting the module row of every pixel row from top to bottom
+    def _getModuleRows(self, top: int, bottom: Optional[int]):
+
+        # Default to the whole image
+        scale = self.__renderSettings.cells_per_block * self.__renderSettings.px_per_cell
+        if bottom is None:
+            bottom = self.QR.height * scale
+
+        # Repeat each module row once per pixel row
+        return self.QR.QRMatrix[np.arange(top, bottom) // scale]
+
+    # Define function for rendering a two-color image from the module matrix
+    def _renderPalette(self,
+                       palette: Tuple[Tuple[int, int, int], Tuple[int, int, int]],
+                       top: int = 0,
+                       bottom: Optional[int] = None):
+
+        # Build an RGBA lookup table: index 0 is light, index 1 is dark
+        light_color, dark_color = palette
+        lookup = pack_rgba([(*light_color, 255), (*dark_color, 255)])
+
+        # Look up colors per pixel row, then upscale each module across its block width
+        scale = self.__renderSettings.cells_per_block * self.__renderSettings.px_per_cell
+        rows = lookup[self._getModuleRows(top, bottom).view(np.uint8)]
+        pixels = self.__renderer.get_pixels((rows.shape[0], rows.shape[1] * scale, 4))
+        _upscaleRows(pixels, rows, scale)
+
+        # Hand the finished buffer to PIL in one call
+        return PILImage.fromarray(pixels, "RGBA")
+
+    # Define function for rendering to a label map, where recoloring is a palette swap
+    # Needs a protocol with get_palette; label 0 is light and 1 is dark
+    def render_indexed(self):
+
+        get_palette = protocol_method(self.protocol, "get_palette")
+        if get_palette is None:
+            raise ValueError("Indexed rendering needs a protocol with get_palette")
+
+        # Upscale the module matrix to one label per pixel
+        scale = self.__renderSettings.cells_per_block * self.__renderSettings.px_per_cell
+        with stage(self.__renderSettings.instrument, "draw"):
+            labels = np.repeat(np.repeat(self.QR.QRMatrix.view(np.uint8), scale, axis=0), scale, axis=1)
+
+        light_color, dark_color = get_palette()
+        return IndexedCanvas(labels, np.eye(2), {"light_color": light_color, "dark_color": dark_color})
+
+    # Define function for rendering straight into a file-like object
+    # band_height streams the PNG in strips, so only one strip is held in memory
+    def render_to(self,
+                  stream: BinaryIO,
+                  format: str = "PNG",
+                  compress_level: int = 6,
+                  band_height: Optional[int] = None):
+        self.__renderer.render_to(stream, self._renderOutput, partial(self.render_bands, indexed=True),
+                                  format, compress_level, band_height)
+
+    # Define function for rendering the image to encode
+    # Two-color renders are built as a 1-bit or palette image rather than RGBA
+    def _renderOutput(self):
+
+        get_palette = protocol_method(self.protocol, "get_palette")
+        if get_palette is None:
+            return self.render()
+
+        with stage(self.__renderSettings.instrument, "draw"):
+            image = self._renderIndexed(get_palette())
+
+        # Read the image back when asked
+        check_render(image, self.QR, self.__renderSettings)
+        return image
+
+    # Define function for rendering a two-color image without an RGBA buffer
+    def _renderIndexed(self,
+                       palette: Tuple[Tuple[int, int, int], Tuple[int, int, int]],
+                       top: int = 0,
+                       bottom: Optional[int] = None):
+
+        # Get the module row of every pixel row
+        rows = self._getModuleRows(top, bottom)
+        scale = self.__renderSettings.cells_per_block * self.__renderSettings.px_per_cell
+        light_color, dark_color = palette
+
+        # Black and white fits in 1 bit per pixel, where set bits are white
+        if light_color == (255, 255, 255) and dark_color == (0, 0, 0):
+            image = PILImage.fromarray(~rows)
+        elif light_color == (0, 0, 0) and dark_color == (255, 255, 255):
+            image = PILImage.fromarray(rows)
+
+        # Other pairs use a two-entry palette: index 0 is light, index 1 is dark
+        else:
+            image = PILImage.fromarray(rows.view(np.uint8))
+            image.putpalette([*light_color, *dark_color])
+
+        # Upscale each module across its block width
+        return image.resize((self.QR.width * scale, rows.shape[0]), PILImage.NEAREST)
 
 class SimpleBlockProtocol(BlockRenderingProtocol):
 
     def __init__(self,
                 light_color: Tuple[int, int, int] = (255, 255, 255),
                 dark_color: Tuple[int, int, int] = (0, 0, 0)):
-        
+
         self.light_color = light_color
         self.dark_color = dark_color
 
@@ -99,4 +258,9 @@ class SimpleBlockProtocol(BlockRenderingProtocol):
         # Return color
         return color
 
-             
\ No newline at end of file
+    # Define (light, dark) colors, used by the renderer's array fast path
+    # Subclasses that override __call__ are drawn per cell unless they override this too
+    def get_palette(self):
+        return (self.light_color, self.dark_color)
+
+
@@ -0,0 +1,561 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import fields, is_dataclass
+from functools import partial
+from threading import Lock
+from typing import Any, Callable, Hashable, Optional
+import hashlib
+import json
+import os
+import tempfile
+import types
+
+import numpy as np
+
+# File locks are POSIX-only; elsewhere disk caches are only locked within a process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Define a small thread-safe LRU cache with hit/miss counters
+# An optional byte budget evicts by total size, as measured by sizeof(value)
+class LRUCache:
+
+    # Define initializer
+    def __init__(self,
+                 maxsize: int = 128,
+                 max_bytes: Optional[int] = None,
+                 sizeof: Optional[Callable[[Any], int]] = None):
+
+        # Set the maximum number of entries and bytes
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+
+        # Entries are kept in least- to most-recently used order
+        # Sizes are only tracked when a byte budget is set
+        self._entries: OrderedDict = OrderedDict()
+        self._sizes: dict = {}
+        self.current_bytes = 0
+        self._lock = Lock()
+
+        # Set counters
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        return key in self._entries
+
+    # Define lookup, returning default on a miss
+    def get(self, key: Hashable, default: Any = None):
+
+        with self._lock:
+
+            # Record a miss if the key is absent
+            if key not in self._entries:
+                self.misses += 1
+                return default
+
+            # Otherwise mark it as most recently used and record a hit
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    # Define insert, evicting the least recently used entries when full
+    def put(self, key: Hashable, value: Any):
+
+        with self._lock:
+
+            # Replace any existing entry
+            self._discard(key)
+
+            # Measure the value against the byte budget
+            if self.max_bytes is not None:
+                size = self._sizeof(value) if self._sizeof else 0
+
+                # Values larger than the whole budget are never stored
+                if size > self.max_bytes:
+                    return
+
+                self._sizes[key] = size
+                self.current_bytes += size
+
+            # Store the entry as most recently used
+            self._entries[key] = value
+
+            # Evict least recently used entries until within both limits
+            while len(self._entries) > self.maxsize or (
+                    self.max_bytes is not None and self.current_bytes > self.max_bytes):
+                self._discard(next(iter(self._entries)))
+
+    # Define function to remove an entry and its size, if present
+    def _discard(self, key: Hashable):
+        if key in self._entries:
+            del self._entries[key]
+            self.current_bytes -= self._sizes.pop(key, 0)
+
+    # Define lookup that builds and stores the value on a miss
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]):
+
+        # Use a sentinel so cached None values still count as hits
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    # Define function to drop every entry and reset counters
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    # Define function to report counters
+    def stats(self):
+
+        # Calculate the hit rate
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": hit_rate,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+# Define a two-tier cache of QR module matrices
+# The memory tier is an LRUCache; the optional disk tier stores one .npy file per key
+class MatrixCache:
+
+    # Define initializer
+    def __init__(self, maxsize: int = 1024, directory: Optional[str] = None):
+
+        # Set memory tier
+        self.memory = LRUCache(maxsize=maxsize)
+
+        # Set disk tier
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+        # Set counters
+        self.disk_hits = 0
+        self.misses = 0
+
+    # Define function to turn encoding parameters into a stable file name
+    @staticmethod
+    def _digest(key: Hashable):
+        return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+    # Define function to get the disk path for a key
+    def _path(self, key: Hashable):
+        digest = self._digest(key)
+        return os.path.join(self.directory, digest[:2], digest + ".npy")
+
+    # Define lookup that encodes and stores the matrix on a miss
+    def get_or_create(self, key: Hashable, factory: Callable[[], np.ndarray]):
+
+        # Check the memory tier
+        matrix = self.memory.get(key)
+        if matrix is not None:
+            return matrix
+
+        # Check the disk tier
+        matrix = self._load(key)
+        if matrix is not None:
+            self.disk_hits += 1
+
+        # Otherwise encode and write through to disk
+        else:
+            self.misses += 1
+            matrix = factory()
+            self._store(key, matrix)
+
+        # Promote into memory and return
+        self.memory.put(key, matrix)
+        return matrix
+
+    # Define function to read a matrix from disk, if present
+    def _load(self, key: Hashable):
+
+        if self.directory is None:
+            return None
+
+        try:
+            matrix = np.load(self._path(key))
+        except (OSError, ValueError, EOFError):
+            return None
+
+        # Cached matrices are shared, so they stay read-only
+        matrix.flags.writeable = False
+        return matrix
+
+    # Define function to write a matrix to disk atomically
+    def _store(self, key: Hashable, matrix: np.ndarray):
+
+        if self.directory is None:
+            return
+
+        # Write to a temporary file in the same directory, then move it into place
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(handle, "wb") as file:
+            np.save(file, matrix)
+        os.replace(temp_path, path)
+
+    # Define function to report counters across both tiers
+    def stats(self):
+
+        # Calculate the overall hit rate
+        memory_hits = self.memory.hits
+        lookups = memory_hits + self.disk_hits + self.misses
+        hit_rate = (memory_hits + self.disk_hits) / lookups if lookups else 0.0
+
+        return {
+            "memory_hits": memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hit_rate,
+            "memory_size": len(self.memory),
+        }
+
+# Process-wide content digests of files, keyed by path, modification time and size
+FILE_DIGESTS = LRUCache(maxsize=256)
+
+# Define function to get the SHA-256 digest of a file's contents, hashing it again only when it changes
+def file_digest(path: str):
+
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+    def digest():
+        hasher = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    return FILE_DIGESTS.get_or_create(key, digest)
+
+# Define function to hash a code object, including the code of functions defined inside it
+def _codeDigest(code: types.CodeType):
+
+    hasher = hashlib.sha256(code.co_code)
+    hasher.update(repr(code.co_names).encode("utf-8"))
+    for const in code.co_consts:
+        hasher.update(_codeDigest(const).encode("ascii") if isinstance(const, types.CodeType)
+                      else repr(const).encode("utf-8"))
+    return hasher.hexdigest()
+
+# Define function to turn a value into a JSON-compatible description of everything that affects a render
+# Dataclasses contribute their compared fields and other objects their attributes; strings in
+# fields named *_path or *_filename are files, described by the digest of their contents.
+# Values that cannot be described completely raise TypeError, so they are never cached under a shared key
+def fingerprint(value: Any, name: str = ""):
+
+    # Referenced files
+    if isinstance(value, str) and name.endswith(("_path", "_filename")):
+        return {"file": file_digest(value)}
+
+    # Plain values, with NumPy scalars as their Python equivalents
+    if isinstance(value, np.generic):
+        return fingerprint(value.item(), name)
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, bytes):
+        return {"bytes": hashlib.sha256(value).hexdigest()}
+    if isinstance(value, (tuple, list)):
+        return [fingerprint(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): fingerprint(item, str(key)) for key, item in value.items()}
+    if isinstance(value, np.ndarray):
+        return {"array": [str(value.dtype), list(value.shape), hashlib.sha256(np.ascontiguousarray(value)).hexdigest()]}
+
+    # Classes and built-in functions by name; built-in methods also by their instance
+    if isinstance(value, type):
+        return {"type": f"{value.__module__}.{value.__qualname__}"}
+    if isinstance(value, types.BuiltinFunctionType):
+        owner = value.__self__
+        if owner is None or isinstance(owner, types.ModuleType):
+            return {"type": f"{value.__module__}.{value.__qualname__}"}
+        return {"method": value.__qualname__, "self": fingerprint(owner)}
+
+    # Functions by their code and everything bound to it: defaults and captured variables
+    if isinstance(value, types.FunctionType):
+        try:
+            captured = [cell.cell_contents for cell in value.__closure__ or ()]
+        except ValueError:
+            raise TypeError(f"Cannot fingerprint {value.__qualname__}: it captures an unset variable") from None
+        return {"function": f"{value.__module__}.{value.__qualname__}",
+                "code": _codeDigest(value.__code__),
+                "defaults": fingerprint(value.__defaults__),
+                "kwdefaults": fingerprint(value.__kwdefaults__),
+                "closure": fingerprint(captured)}
+
+    # Partials by their function and arguments, methods by their function and instance
+    if isinstance(value, partial):
+        return {"partial": fingerprint(value.func), "args": fingerprint(value.args),
+                "keywords": fingerprint(value.keywords)}
+    if isinstance(value, types.MethodType):
+        return {"method": fingerprint(value.__func__), "self": fingerprint(value.__self__)}
+
+    # Dataclasses by their compared fields, other objects by their attributes
+    # Objects keeping state in slots are not fully described by their attributes
+    kind = f"{type(value).__module__}.{type(value).__qualname__}"
+    if is_dataclass(value):
+        return {"type": kind, "fields": {field.name: fingerprint(getattr(value, field.name), field.name)
+                                         for field in fields(value) if field.compare}}
+    if hasattr(value, "__dict__") and not any("__slots__" in vars(cls) for cls in type(value).__mro__[:-1]):
+        return {"type": kind, "fields": fingerprint(vars(value))}
+
+    raise TypeError(f"Cannot fingerprint {kind}")
+
+# Define function to hash a fingerprint into a stable hex key
+# Self-referencing values cannot be described, so they raise TypeError like any other
+def fingerprint_digest(value: Any):
+    try:
+        text = json.dumps(fingerprint(value), sort_keys=True, separators=(",", ":"))
+    except RecursionError:
+        raise TypeError("Cannot fingerprint a self-referencing value") from None
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# Define a two-tier cache of encoded outputs, addressed by hex digest keys
+# The memory tier is an LRUCache bounded by bytes; the optional disk tier stores one file per key and
+# evicts least recently used files beyond max_disk_bytes. Several processes may share a directory:
+# writes hold a lock file and keep a shared usage total, and once it passes the cap the writer rescans
+# the directory and evicts the oldest files until the whole directory is back under the cap
+class OutputCache:
+
+    # Define initializer
+    def __init__(self,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 directory: Optional[str] = None,
+                 max_disk_bytes: int = 1024 * 1024 * 1024,
+                 maxsize: int = 4096):
+
+        # Set memory tier
+        self.memory = LRUCache(maxsize=maxsize, max_bytes=max_bytes, sizeof=len)
+
+        # Set disk tier, syncing the shared usage total with the files already there
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            with self._diskLock():
+                self._writeUsage(sum(size for _, _, size in self._scanDisk()))
+
+        # Set counters
+        self.disk_hits = 0
+        self.misses = 0
+
+    # Caches pickle as their limits and directory, so worker processes share the disk tier
+    def __getstate__(self):
+        return (self.memory.max_bytes, self.directory, self.max_disk_bytes, self.memory.maxsize)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    # Define function to get the disk path for a key
+    def _path(self, key: str):
+        return os.path.join(self.directory, key[:2], key)
+
+    # Define function to hold the disk tier exclusively, across threads and processes
+    @contextmanager
+    def _diskLock(self):
+        with self._lock, open(os.path.join(self.directory, _LOCK_FILE), "a") as file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX)
+            yield
+
+    # Define function to list the files in the directory as (last use, key, size), least recently used first
+    def _scanDisk(self):
+
+        entries = []
+        for prefix in os.scandir(self.directory):
+            if prefix.is_dir():
+                for entry in os.scandir(prefix.path):
+                    if entry.is_file() and not entry.name.endswith(".tmp"):
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        entries.append((stat.st_mtime_ns, entry.name, stat.st_size))
+
+        return sorted(entries)
+
+    # Define functions to read and write the bytes stored in the directory, shared by every process using it
+    # Call them while holding the disk lock
+    def _readUsage(self):
+        try:
+            with open(os.path.join(self.directory, _USAGE_FILE)) as file:
+                return int(file.read())
+        except (OSError, ValueError):
+            return sum(size for _, _, size in self._scanDisk())
+
+    def _writeUsage(self, usage: int):
+        with open(os.path.join(self.directory, _USAGE_FILE), "w") as file:
+            file.write(str(usage))
+
+    # Define property for the bytes stored in the directory
+    @property
+    def disk_bytes(self):
+        if self.directory is None:
+            return 0
+        with self._diskLock():
+            return self._readUsage()
+
+    # Define lookup, returning None on a miss
+    def get(self, key: str):
+
+        # Check the memory tier
+        data = self.memory.get(key)
+        if data is not None:
+            return data
+
+        # Check the disk tier, promoting hits into memory
+        data = self._load(key)
+        if data is not None:
+            self.disk_hits += 1
+            self.memory.put(key, data)
+            return data
+
+        self.misses += 1
+        return None
+
+    # Define insert into both tiers
+    def put(self, key: str, data: bytes):
+        self.memory.put(key, data)
+        self._store(key, data)
+
+    # Define lookup that renders and stores the output on a miss
+    def get_or_create(self, key: str, factory: Callable[[], bytes]):
+
+        data = self.get(key)
+        if data is None:
+            data = factory()
+            self.put(key, data)
+        return data
+
+    # Define function to read an output from disk, if present
+    def _load(self, key: str):
+
+        if self.directory is None:
+            return None
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except OSError:
+            return None
+
+        # Mark it as recently used for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return data
+
+    # Define function to write an output to disk atomically, evicting older files to keep the directory within the cap
+    def _store(self, key: str, data: bytes):
+
+        # Outputs larger than the whole disk budget are never stored
+        if self.directory is None or len(data) > self.max_disk_bytes:
+            return
+
+        # Write to a temporary file in the same directory, moved into place once there is room
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(handle, "wb") as file:
+            file.write(data)
+
+        with self._diskLock():
+
+            # Count it against the shared total, less any older copy it replaces
+            try:
+                replaced = os.stat(path).st_size
+            except FileNotFoundError:
+                replaced = 0
+            usage = self._readUsage() + len(data) - replaced
+
+            # Over the cap, measure the directory itself and remove least recently used files
+            # down to _EVICT_TO of the cap before moving it into place, so the rescans are spread over many writes
+            if usage > self.max_disk_bytes:
+                entries = self._scanDisk()
+                usage = sum(size for _, _, size in entries) + len(data) - replaced
+                for _, old_key, size in entries:
+                    if usage <= self.max_disk_bytes * _EVICT_TO:
+                        break
+                    if old_key == key:
+                        continue
+                    try:
+                        os.remove(self._path(old_key))
+                    except FileNotFoundError:
+                        pass
+                    usage -= size
+
+            os.replace(temp_path, path)
+            self._writeUsage(usage)
+
+    # Define function to drop every entry from both tiers and reset counters
+    def clear(self):
+
+        self.memory.clear()
+        if self.directory is not None:
+            with self._diskLock():
+                for _, key, _ in self._scanDisk():
+                    try:
+                        os.remove(self._path(key))
+                    except FileNotFoundError:
+                        pass
+                self._writeUsage(0)
+        self.disk_hits = 0
+        self.misses = 0
+
+    # Define function to report counters across both tiers
+    def stats(self):
+
+        # Calculate the overall hit rate
+        memory_hits = self.memory.hits
+        lookups = memory_hits + self.disk_hits + self.misses
+        hit_rate = (memory_hits + self.disk_hits) / lookups if lookups else 0.0
+
+        # Measure the directory, including files written by other processes
+        entries = self._scanDisk() if self.directory is not None else []
+
+        return {
+            "memory_hits": memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hit_rate,
+            "memory_size": len(self.memory),
+            "memory_bytes": self.memory.current_bytes,
+            "disk_size": len(entries),
+            "disk_bytes": sum(size for _, _, size in entries),
+        }
+
+# Files an OutputCache keeps in its directory: the lock held while writing, and the shared usage total
+_LOCK_FILE = ".lock"
+_USAGE_FILE = ".usage"
+
+# Fraction of max_disk_bytes a full disk tier is evicted down to
+_EVICT_TO = 0.9
+
+# Sentinel for get_or_create
+_MISSING = object()
@@ -0,0 +1,391 @@
+import argparse
+import csv
+import io
+import json
+import os
+import re
+import sys
+import tarfile
+import time
+import zipfile
+from collections import deque
+from functools import partial
+from itertools import islice
+from typing import Iterator, Optional, TextIO, Tuple
+
+from .QREngine import RenderSettings
+from .QRBatch import RenderFailure, RenderSpec, render_batch, render_or_failure
+from .QRBlock import QRBlockRenderer, SimpleBlockProtocol
+from .QRText import QRTextBlockRenderer, QRTextStyle, RepeatingTextStrategy
+from .QRImage import QRImageBlockRenderer, QRImageStyle
+
+# File extension for each output format
+EXTENSIONS = {"PNG": "png", "WEBP": "webp", "JPEG": "jpg", "BMP": "bmp", "TIFF": "tiff", "GIF": "gif"}
+
+# Pillow format for each common extension spelling
+FORMAT_ALIASES = {"JPG": "JPEG", "TIF": "TIFF"}
+
+# Define function to resolve a path from the config file relative to the file's directory
+def _configPath(path: Optional[str], base: str):
+    if path is None:
+        return None
+    return os.path.join(base, os.path.expanduser(path))
+
+# Define function to build a render spec from a config dict
+# base is the directory relative paths (fonts, images) are resolved against
+def load_spec(config: dict, base: str = "."):
+
+    # Get shared settings
+    renderSettings = RenderSettings(px_per_cell=config.get("px_per_cell", 10),
+                                    cells_per_block=config.get("cells_per_block", 2),
+                                    verify=config.get("verify", False),
+                                    min_contrast=config.get("min_contrast", 0.0))
+    output_format = config.get("format", "PNG").upper()
+    output_format = FORMAT_ALIASES.get(output_format, output_format)
+    compress_level = config.get("compress_level", 6)
+    renderer = config.get("renderer", "block")
+    encoder = config.get("encoder", "qrcode")
+    optimize_segments = config.get("optimize_segments", False)
+    options = dict(config.get(renderer, {}))
+
+    # Block codes take optional colors
+    if renderer == "block":
+        protocol = SimpleBlockProtocol(tuple(options.get("light_color", (255, 255, 255))),
+                                       tuple(options.get("dark_color", (0, 0, 0))))
+        return RenderSpec(QRBlockRenderer, renderSettings, None, protocol, output_format, compress_level, encoder, optimize_segments)
+
+    # Text codes repeat a string in a font
+    if renderer == "text":
+        style = QRTextStyle(_configPath(options.pop("font_path"), base))
+        for color in ("light_color", "dark_color"):
+            if color in options:
+                options[color] = tuple(options[color])
+        protocol = RepeatingTextStrategy(**options)
+        return RenderSpec(QRTextBlockRenderer, renderSettings, style, protocol, output_format, compress_level, encoder, optimize_segments)
+
+    # Image codes tile images or tints of one
+    if renderer == "image":
+        for key in ("base_image_filename", "on_image_filename", "off_image_filename"):
+            options[key] = _configPath(options.get(key), base)
+        for key in ("on_tint", "off_tint"):
+            if options.get(key) is not None:
+                color, opacity = options[key]
+                options[key] = (tuple(color), opacity)
+        style = QRImageStyle(**options)
+        return RenderSpec(QRImageBlockRenderer, renderSettings, style, None, output_format, compress_level, encoder, optimize_segments)
+
+    raise ValueError(f"Unknown renderer: {renderer}")
+
+# Define function to read a JSON config file into a render spec
+def load_config(path: str):
+    with open(path) as file:
+        return load_spec(json.load(file), os.path.dirname(os.path.abspath(path)))
+
+# Define function to stream (name, payload) records from a CSV, JSONL or plain text source
+# name is None when the record does not set one
+def read_records(file: TextIO,
+                 input_format: str,
+                 payload_field: str = "payload",
+                 name_field: str = "name") -> Iterator[Tuple[Optional[str], str]]:
+
+    # CSV rows are read by header
+    if input_format == "csv":
+        for row in csv.DictReader(file):
+            yield (row.get(name_field) or None, row[payload_field])
+
+    # JSONL lines are objects, or bare strings
+    elif input_format == "jsonl":
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                yield (None, record)
+            else:
+                yield (record.get(name_field), record[payload_field])
+
+    # Text input has one payload per line
+    elif input_format == "lines":
+        for line in file:
+            line = line.rstrip("\r\n")
+            if line:
+                yield (None, line)
+
+    else:
+        raise ValueError(f"Unknown input format: {input_format}")
+
+# Define function to guess an input format from a filename
+def _inputFormat(path: str):
+    if path.endswith(".csv"):
+        return "csv"
+    if path.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    return "lines"
+
+# Define function to make a record name safe to use as a file name
+def _safeName(name: str):
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", name).strip("._") or "_"
+
+# Define function to name a record's output, numbering repeats so no output overwrites another
+# used maps each name taken so far to the next suffix to try; records are named by position when unnamed
+def _uniqueName(record_name: Optional[str], index: int, used: dict):
+
+    base = _safeName(record_name) if record_name else f"{index:08d}"
+    name = base
+    while name in used:
+        used[base] += 1
+        name = f"{base}-{used[base]}"
+    used.setdefault(name, 0)
+    return name
+
+# Define a directory of output files
+class DirectoryWriter:
+
+    def __init__(self, path: str, resume_state: Optional[dict] = None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    # Define function to write one output
+    def write(self, name: str, data: bytes):
+
+        # Write to a temporary name first, so files are either complete or absent
+        target = os.path.join(self.path, name)
+        with open(target + ".part", "wb") as file:
+            file.write(data)
+        os.replace(target + ".part", target)
+
+    # Define function to report the state a resumed run needs
+    def checkpoint(self):
+        return {}
+
+    def close(self):
+        pass
+
+# Define an uncompressed or compressed tar archive of output files
+class TarWriter:
+
+    def __init__(self, path: str, resume_state: Optional[dict] = None):
+
+        # Compression is chosen by suffix
+        self.compressed = path.endswith((".tar.gz", ".tgz", ".tar.bz2", ".tar.xz"))
+        if resume_state is not None and self.compressed:
+            raise ValueError("Resuming is only supported for uncompressed tar archives")
+
+        # Resume by cutting the archive back to the last checkpointed member
+        if resume_state is not None:
+            # An end-of-archive block marks where appending starts
+            with open(path, "r+b") as file:
+                file.truncate(resume_state["offset"])
+                file.seek(resume_state["offset"])
+                file.write(bytes(2 * tarfile.BLOCKSIZE))
+            self.archive = tarfile.open(path, "a")
+        else:
+            mode = "w:" + path.rsplit(".", 1)[-1].replace("tgz", "gz") if self.compressed else "w"
+            self.archive = tarfile.open(path, mode)
+
+    # Define function to write one output
+    def write(self, name: str, data: bytes):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.archive.addfile(info, io.BytesIO(data))
+
+    # Define function to report the state a resumed run needs: the end of the last member
+    def checkpoint(self):
+        self.archive.fileobj.flush()
+        return {"offset": self.archive.offset}
+
+    def close(self):
+        self.archive.close()
+
+# Define a zip archive of output files
+class ZipWriter:
+
+    def __init__(self, path: str, resume_state: Optional[dict] = None):
+
+        # A zip archive is only readable once closed, so it cannot be resumed after a crash
+        if resume_state is not None:
+            raise ValueError("Resuming is not supported for zip archives")
+
+        # Images are already compressed
+        self.archive = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED)
+
+    # Define function to write one output
+    def write(self, name: str, data: bytes):
+        self.archive.writestr(name, data)
+
+    def checkpoint(self):
+        return {}
+
+    def close(self):
+        self.archive.close()
+
+# Define function to open an output writer by path
+def open_writer(path: str, resume_state: Optional[dict] = None):
+
+    if path.endswith(".zip"):
+        return ZipWriter(path, resume_state)
+    if re.search(r"\.(tar|tar\.gz|tgz|tar\.bz2|tar\.xz)$", path):
+        return TarWriter(path, resume_state)
+    return DirectoryWriter(path, resume_state)
+
+# Define function to write a checkpoint atomically
+def _writeCheckpoint(path: str, state: dict):
+    with open(path + ".part", "w") as file:
+        json.dump(state, file)
+    os.replace(path + ".part", path)
+
+# Define function to render every record of a source into a writer
+# Records that fail to render are logged, and written to errors_path as JSON lines, then skipped
+# Returns the number of records rendered by this run
+def run(records: Iterator[Tuple[Optional[str], str]],
+        spec: RenderSpec,
+        output: str,
+        workers: Optional[int] = None,
+        chunksize: int = 16,
+        checkpoint_path: Optional[str] = None,
+        checkpoint_every: int = 100,
+        resume: bool = False,
+        progress_every: float = 2.0,
+        log: Optional[TextIO] = sys.stderr,
+        errors_path: Optional[str] = None):
+
+    # Load the checkpoint, skipping records that were already written
+    # Their names are taken again, so later records are named as they were in the first run
+    done = 0
+    resume_state = None
+    used_names = {}
+    records = iter(records)
+    if resume and checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as file:
+            resume_state = json.load(file)
+        done = resume_state["done"]
+        for index, (record_name, _) in enumerate(islice(records, done)):
+            _uniqueName(record_name, index, used_names)
+        if log is not None:
+            print(f"Resuming after {done} records", file=log)
+
+    # Open the output; the error log is opened on the first failure, and a fresh run drops an old one
+    writer = open_writer(output, resume_state)
+    errors = None
+    if errors_path and resume_state is None and os.path.exists(errors_path):
+        os.remove(errors_path)
+
+    # Render records in order
+    extension = EXTENSIONS.get(spec.output_format, spec.output_format.lower())
+    names = deque()
+    start = last_report = time.perf_counter()
+    rendered = failed = 0
+
+    # Keep each record's name for its result, which arrives in the same order
+    def payloads():
+        for name, payload in records:
+            names.append(name)
+            yield payload
+
+    # Render in worker processes, or in this process when workers is 0
+    # A record that fails comes back as a RenderFailure, so one bad payload does not end the run
+    if workers == 0:
+        plan = spec.compile()
+        results = map(partial(render_or_failure, plan.render_payload), payloads())
+    else:
+        results = render_batch(payloads(), spec, max_workers=workers, chunksize=chunksize, capture_failures=True)
+
+    try:
+        for data in results:
+
+            # Name the output after the record, or its position in the input
+            record_name = names.popleft()
+            name = _uniqueName(record_name, done, used_names)
+
+            # Log failed records and move past them
+            if isinstance(data, RenderFailure):
+                failed += 1
+                if log is not None:
+                    print(f"Record {done} ({name}) failed: {data.error}", file=log)
+                if errors_path:
+                    errors = errors or open(errors_path, "a")
+                    errors.write(json.dumps({"record": done, "name": record_name,
+                                             "payload": data.payload, "error": data.error}) + "\n")
+            else:
+                writer.write(f"{name}.{extension}", data)
+                rendered += 1
+            done += 1
+
+            # Checkpoint every few records, once their errors are on disk
+            if checkpoint_path and done % checkpoint_every == 0:
+                if errors is not None:
+                    errors.flush()
+                _writeCheckpoint(checkpoint_path, {"done": done, **writer.checkpoint()})
+
+            # Report progress and throughput
+            now = time.perf_counter()
+            if log is not None and now - last_report >= progress_every:
+                print(f"{done} done, {failed} failed, {rendered / (now - start):.1f}/s", file=log)
+                last_report = now
+
+        # Finish the output; a completed run needs no checkpoint
+        writer.close()
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    except BaseException:
+
+        # Record progress so an interrupted run can be resumed, then close what was written
+        if errors is not None:
+            errors.flush()
+        if checkpoint_path:
+            _writeCheckpoint(checkpoint_path, {"done": done, **writer.checkpoint()})
+        writer.close()
+        raise
+
+    finally:
+        if errors is not None:
+            errors.close()
+
+    # Report the total
+    if log is not None:
+        elapsed = time.perf_counter() - start
+        print(f"{done} done ({rendered} rendered and {failed} failed this run) in {elapsed:.1f}s, "
+              f"{rendered / elapsed if elapsed else 0:.1f}/s", file=log)
+
+    return rendered
+
+# Define command-line entry point
+def main(argv=None):
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(prog="python -m customQR", description="Render QR codes in bulk.")
+    parser.add_argument("input", help="CSV, JSONL or text file of payloads, or - for stdin")
+    parser.add_argument("output", help="output directory, or a .zip / .tar / .tar.gz archive")
+    parser.add_argument("--config", help="JSON style config (defaults to black-on-white PNG blocks)")
+    parser.add_argument("--input-format", choices=("csv", "jsonl", "lines"), help="defaults to the input's extension")
+    parser.add_argument("--payload-field", default="payload", help="CSV column or JSON key holding the payload")
+    parser.add_argument("--name-field", default="name", help="CSV column or JSON key naming the output file")
+    parser.add_argument("--workers", type=int, help="worker processes (default: CPU count, 0 renders in-process)")
+    parser.add_argument("--chunksize", type=int, default=16, help="payloads sent to a worker at a time")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: OUTPUT.checkpoint.json)")
+    parser.add_argument("--checkpoint-every", type=int, default=100, help="records between checkpoints")
+    parser.add_argument("--errors", help="JSON lines file of records that failed (default: OUTPUT.errors.jsonl)")
+    parser.add_argument("--resume", action="store_true", help="continue from the checkpoint of an interrupted run")
+    parser.add_argument("--quiet", action="store_true", help="do not report progress")
+    args = parser.parse_args(argv)
+
+    # Build the spec
+    spec = load_config(args.config) if args.config else load_spec({})
+    checkpoint_path = args.checkpoint or args.output.rstrip("/\\") + ".checkpoint.json"
+    errors_path = args.errors or args.output.rstrip("/\\") + ".errors.jsonl"
+
+    # Stream records from the input
+    input_format = args.input_format or ("lines" if args.input == "-" else _inputFormat(args.input))
+    file = sys.stdin if args.input == "-" else open(args.input, newline="" if input_format == "csv" else None)
+    try:
+        records = read_records(file, input_format, args.payload_field, args.name_field)
+        run(records, spec, args.output, args.workers, args.chunksize, checkpoint_path,
+            args.checkpoint_every, args.resume, log=None if args.quiet else sys.stderr, errors_path=errors_path)
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,512 @@
+from bisect import bisect_left
+from functools import lru_cache
+from typing import List, Optional, Tuple
+import re
+
+import numpy as np
+from qrcode.base import rs_blocks
+from qrcode.util import (ALPHA_NUM, BCH_type_info, BCH_type_number, BIT_LIMIT_TABLE, MODE_8BIT_BYTE,
+                         MODE_ALPHA_NUM, MODE_NUMBER, PATTERN_POSITION_TABLE, mode_sizes_for_version)
+
+# A native QR encoder producing the same matrices as qrcode.QRCode.make()
+# The version, block and pattern tables are qrcode's own; the encoding, error correction,
+# placement and mask scoring are done here with table-driven GF(256) arithmetic and NumPy
+
+# A segment is an encoding mode and the bytes it encodes
+Segment = Tuple[int, bytes]
+
+# Define GF(256) tables over the QR polynomial x^8 + x^4 + x^3 + x^2 + 1
+def _galoisTables():
+
+    # Powers of the generator, doubled so sums of two logs need no modulo
+    exp = np.zeros(512, dtype=np.int32)
+    value = 1
+    for i in range(255):
+        exp[i] = value
+        value <<= 1
+        if value & 0x100:
+            value ^= 0x11D
+    exp[255:510] = exp[:255]
+
+    # Logarithms of every non-zero element
+    log = np.zeros(256, dtype=np.int32)
+    log[exp[:255]] = np.arange(255)
+
+    # Full product table, so multiplying whole vectors is a single lookup
+    product = exp[log[:, None] + log[None, :]].astype(np.uint8)
+    product[0, :] = product[:, 0] = 0
+    return exp, log, product
+
+GF_EXP, GF_LOG, GF_MUL = _galoisTables()
+
+# Alphanumeric character values, indexed by byte
+_ALPHA_VALUES = np.full(256, -1, dtype=np.int32)
+_ALPHA_VALUES[np.frombuffer(ALPHA_NUM, dtype=np.uint8)] = np.arange(len(ALPHA_NUM))
+
+# Penalty rule 3 finder-like windows, as 11-bit row values
+_FINDER_WINDOWS = (0b10111010000, 0b00001011101)
+
+# Define function to split data into segments the way qrcode.QRCode.add_data does
+# Runs of at least minimum digits become numeric segments, then runs of alphanumeric characters
+def segment_data(data, minimum: int = 20) -> List[Segment]:
+
+    # Strings are encoded as UTF-8
+    if not isinstance(data, bytes):
+        data = str(data).encode("utf-8")
+
+    # Short data is only split off whole
+    digit, alpha = rb"\d", b"[" + re.escape(ALPHA_NUM) + b"]"
+    if len(data) <= minimum:
+        numeric, alphanumeric = re.compile(b"^" + digit + b"+$"), re.compile(b"^" + alpha + b"+$")
+    else:
+        repeat = b"{" + str(minimum).encode("ascii") + b",}"
+        numeric, alphanumeric = re.compile(digit + repeat), re.compile(alpha + repeat)
+
+    # Split numeric runs out first, then alphanumeric runs out of what is left
+    segments = []
+    for is_numeric, chunk in _splitRuns(data, numeric):
+        if is_numeric:
+            segments.append((MODE_NUMBER, chunk))
+        else:
+            for is_alpha, part in _splitRuns(chunk, alphanumeric):
+                segments.append((MODE_ALPHA_NUM if is_alpha else MODE_8BIT_BYTE, part))
+    return segments
+
+# Define function to yield (matched, chunk) pairs for the runs of a pattern in data
+def _splitRuns(data: bytes, pattern: re.Pattern):
+    while data:
+        match = pattern.search(data)
+        if not match:
+            break
+        start, end = match.span()
+        if start:
+            yield False, data[:start]
+        yield True, data[start:end]
+        data = data[end:]
+    if data:
+        yield False, data
+
+# Modes each byte can be encoded in, as bit sets
+_BYTE_MODES = [MODE_8BIT_BYTE] * 256
+for _char in ALPHA_NUM:
+    _BYTE_MODES[_char] |= MODE_ALPHA_NUM
+for _char in b"0123456789":
+    _BYTE_MODES[_char] |= MODE_NUMBER
+
+# Data bits per character in each mode, in sixths of a bit
+# Numeric packs 3 characters to 10 bits and alphanumeric 2 to 11, so partial groups round up
+_SIXTHS_PER_CHAR = {MODE_NUMBER: 20, MODE_ALPHA_NUM: 33, MODE_8BIT_BYTE: 48}
+
+# Versions sharing each set of length field sizes
+_SIZE_CLASSES = ((1, 9), (10, 26), (27, 40))
+
+# Define function to split data into the segments with the fewest bits at a version's length field sizes
+# A dynamic program over characters: for each mode, the cheapest encoding of the data so far that
+# ends in an open segment of that mode. Costs are kept in sixths of a bit and rounded up to whole bits
+# when a segment closes; the cheapest open segment per mode stays cheapest once rounded, so this is exact
+def optimal_segments(data, version: int = 1) -> List[Segment]:
+
+    # Strings are encoded as UTF-8
+    if not isinstance(data, bytes):
+        data = str(data).encode("utf-8")
+    if not data:
+        return []
+
+    # A segment costs its mode and length fields, then its characters
+    mode_sizes = mode_sizes_for_version(version)
+    modes = tuple(_SIXTHS_PER_CHAR)
+    header = {mode: 6 * (4 + mode_sizes[mode]) for mode in modes}
+    infinity = float("inf")
+
+    # Cheapest cost per mode ending at the current character, and how each was reached
+    costs = dict.fromkeys(modes, infinity)
+    starts, closers = [], []
+    for char in data:
+
+        # Close the cheapest open segment (rounding up keeps it the cheapest)
+        closer = min(modes, key=lambda mode: costs[mode])
+        closed = -(-costs[closer] // 6) * 6 if costs[closer] < infinity else 0
+        closers.append(closer)
+
+        # Extend each mode's open segment, or start a new one after the closed encoding
+        allowed = _BYTE_MODES[char]
+        started = {}
+        for mode in modes:
+            if not allowed & mode:
+                costs[mode] = infinity
+                continue
+            extended, fresh = costs[mode], closed + header[mode]
+            started[mode] = fresh < extended
+            costs[mode] = min(extended, fresh) + _SIXTHS_PER_CHAR[mode]
+        starts.append(started)
+
+    # Walk back from the cheapest final segment
+    mode = min(modes, key=lambda mode: costs[mode])
+    segments = []
+    end = len(data)
+    while end:
+        start = end - 1
+        while not starts[start][mode]:
+            start -= 1
+        segments.append((mode, data[start:end]))
+        mode, end = closers[start], start
+
+    return segments[::-1]
+
+# Define function to choose optimal segments and the smallest version, from start up, that holds them
+# Returns (segments, version)
+def fit_optimal_segments(data, error_correction: int, start: Optional[int] = None):
+
+    start = 1 if start is None else start
+    if not 1 <= start <= 40:
+        raise ValueError(f"Invalid version (was {start}, expected 1 to 40)")
+
+    # Segment once per set of length field sizes; the first set that fits gives the smallest version
+    for first, last in _SIZE_CLASSES:
+        if last < start:
+            continue
+        segments = optimal_segments(data, first)
+        _, needed_bits = _segmentBits(segments, first)
+        version = bisect_left(BIT_LIMIT_TABLE[error_correction], needed_bits, max(first, start))
+        if version <= last:
+            return segments, version
+
+    # Like qrcode, data that does not fit version 40 is a ValueError
+    raise ValueError("Invalid version (was 41, expected 1 to 40)")
+
+# Define function to write segments as a bit string, returned as (value, length)
+def _segmentBits(segments: List[Segment], version: int):
+
+    mode_sizes = mode_sizes_for_version(version)
+    value = length = 0
+
+    # Collect (value, bit count) fields, then fold them into one integer
+    for mode, data in segments:
+        fields = [(mode, 4), (len(data), mode_sizes[mode])]
+
+        # Digits are packed three to ten bits
+        if mode == MODE_NUMBER:
+            for i in range(0, len(data), 3):
+                chars = data[i:i + 3]
+                fields.append((int(chars), (4, 7, 10)[len(chars) - 1]))
+
+        # Alphanumeric characters are packed two to eleven bits
+        elif mode == MODE_ALPHA_NUM:
+            values = _ALPHA_VALUES[np.frombuffer(data, dtype=np.uint8)].tolist()
+            for i in range(0, len(values) - 1, 2):
+                fields.append((values[i] * 45 + values[i + 1], 11))
+            if len(values) % 2:
+                fields.append((values[-1], 6))
+
+        # Bytes are written as they are
+        else:
+            fields.append((int.from_bytes(data, "big"), 8 * len(data)))
+
+        for field_value, field_length in fields:
+            value = (value << field_length) | field_value
+            length += field_length
+
+    return value, length
+
+# Define function to pick the smallest version, from start up, that holds the segments
+# Mirrors qrcode.QRCode.best_fit, including how it settles the length field sizes
+def best_version(segments: List[Segment], error_correction: int, start: Optional[int] = None):
+
+    start = 1 if start is None else start
+    if not 1 <= start <= 40:
+        raise ValueError(f"Invalid version (was {start}, expected 1 to 40)")
+
+    # Size the data with start's length fields, then retry if the fitting version uses others
+    while True:
+        _, needed_bits = _segmentBits(segments, start)
+        version = bisect_left(BIT_LIMIT_TABLE[error_correction], needed_bits, start)
+
+        # Like qrcode, data that does not fit version 40 is a ValueError
+        if version == 41:
+            raise ValueError("Invalid version (was 41, expected 1 to 40)")
+        if mode_sizes_for_version(version) is mode_sizes_for_version(start):
+            return version
+        start = version
+
+# Define function to get the Reed-Solomon generator polynomial for a number of error codewords
+@lru_cache(maxsize=None)
+def _generatorPolynomial(ec_count: int):
+
+    # Multiply out (x - a^0)(x - a^1)...(x - a^(n-1)), highest power first
+    polynomial = np.array([1], dtype=np.uint8)
+    for i in range(ec_count):
+        shifted = np.append(polynomial, 0)
+        shifted[1:] ^= GF_MUL[polynomial, GF_EXP[i]]
+        polynomial = shifted
+
+    # Drop the leading 1
+    return polynomial[1:]
+
+# Define function to get the block layout of a version and error correction level
+# Returns (data counts, error codeword count)
+@lru_cache(maxsize=None)
+def _blockLayout(version: int, error_correction: int):
+    blocks = rs_blocks(version, error_correction)
+    return tuple(block.data_count for block in blocks), blocks[0].total_count - blocks[0].data_count
+
+# Define function to build the final codeword sequence for segments at a version
+def _codewords(segments: List[Segment], version: int, error_correction: int):
+
+    data_counts, ec_count = _blockLayout(version, error_correction)
+    capacity = sum(data_counts)
+    value, length = _segmentBits(segments, version)
+
+    # Terminate with up to four zero bits, then pad to a whole byte
+    terminator = min(8 * capacity - length, 4)
+    terminator += -(length + terminator) % 8
+    value <<= terminator
+    length += terminator
+
+    # Fill the rest with the alternating pad bytes
+    data = np.empty(capacity, dtype=np.uint8)
+    data[:length // 8] = np.frombuffer(value.to_bytes(length // 8, "big"), dtype=np.uint8)
+    data[length // 8::2] = 0xEC
+    data[length // 8 + 1::2] = 0x11
+
+    # Lay the blocks out as rows, both left-aligned for interleaving and
+    # right-aligned for division, where leading zeros do not change the remainder
+    widest = max(data_counts)
+    blocks = np.zeros((len(data_counts), widest), dtype=np.uint8)
+    dividends = np.zeros(blocks.shape, dtype=np.uint8)
+    filled = np.zeros(blocks.shape, dtype=bool)
+    offset = 0
+    for index, count in enumerate(data_counts):
+        blocks[index, :count] = dividends[index, widest - count:] = data[offset:offset + count]
+        filled[index, :count] = True
+        offset += count
+
+    # Divide every block by the generator at once, one codeword per step
+    generator = _generatorPolynomial(ec_count)
+    remainder = np.zeros((len(data_counts), ec_count), dtype=np.uint8)
+    for column in dividends.T:
+        factor = column ^ remainder[:, 0]
+        remainder[:, :-1] = remainder[:, 1:]
+        remainder[:, -1] = 0
+        remainder ^= GF_MUL[factor[:, None], generator[None, :]]
+
+    # Interleave the data codewords column by column, skipping short blocks, then the error codewords
+    return np.concatenate((blocks.T[filled.T], remainder.T.ravel()))
+
+# Define a version's fixed layout: function patterns and where data goes
+class _Template:
+
+    def __init__(self, version: int):
+
+        size = version * 4 + 17
+        self.size = size
+
+        # Function pattern values, and which modules they (or the format and version areas) take
+        modules = np.zeros((size, size), dtype=bool)
+        reserved = np.zeros((size, size), dtype=bool)
+
+        # Finder patterns with their separators, clipped to the symbol
+        for row, col in ((0, 0), (size - 7, 0), (0, size - 7)):
+            for r in range(-1, 8):
+                for c in range(-1, 8):
+                    if 0 <= row + r < size and 0 <= col + c < size:
+                        reserved[row + r, col + c] = True
+                        modules[row + r, col + c] = ((0 <= r <= 6 and c in (0, 6))
+                                                     or (0 <= c <= 6 and r in (0, 6))
+                                                     or (2 <= r <= 4 and 2 <= c <= 4))
+
+        # Alignment patterns, skipping those that would overlap a finder
+        positions = PATTERN_POSITION_TABLE[version - 1]
+        for row in positions:
+            for col in positions:
+                if reserved[row, col]:
+                    continue
+                for r in range(-2, 3):
+                    for c in range(-2, 3):
+                        reserved[row + r, col + c] = True
+                        modules[row + r, col + c] = abs(r) == 2 or abs(c) == 2 or r == c == 0
+
+        # Timing patterns, where nothing else is
+        for i in range(8, size - 8):
+            if not reserved[i, 6]:
+                reserved[i, 6] = True
+                modules[i, 6] = i % 2 == 0
+            if not reserved[6, i]:
+                reserved[6, i] = True
+                modules[6, i] = i % 2 == 0
+
+        # Format information, then the dark module
+        self.format_rows, self.format_cols = self._formatPositions(size)
+        reserved[self.format_rows, self.format_cols] = True
+        reserved[size - 8, 8] = True
+
+        # Version information from version 7 up
+        self.version_bits = None
+        if version >= 7:
+            bits = BCH_type_number(version)
+            self.version_bits = np.array([(bits >> i) & 1 == 1 for i in range(18)])
+            i = np.arange(18)
+            self.version_rows = np.concatenate((i // 3, i % 3 + size - 11))
+            self.version_cols = np.concatenate((i % 3 + size - 11, i // 3))
+            reserved[self.version_rows, self.version_cols] = True
+
+        # Masks are scored with the format and version areas (and the dark module) left light
+        self.modules = modules
+        self.modules.flags.writeable = False
+
+        # Data modules in placement order: two-column strips from the right, snaking up and down
+        # Strips left of the vertical timing pattern shift one column further left
+        order = []
+        upward = True
+        for col in range(size - 1, 0, -2):
+            if col <= 6:
+                col -= 1
+            rows = range(size - 1, -1, -1) if upward else range(size)
+            order.extend(row * size + c for row in rows for c in (col, col - 1) if not reserved[row, c])
+            upward = not upward
+        self.order = np.array(order, dtype=np.intp)
+
+        # The eight mask patterns, at each data module
+        row, col = np.divmod(self.order, size)
+        self.masks = np.stack([
+            (row + col) % 2 == 0,
+            row % 2 == 0,
+            col % 3 == 0,
+            (row + col) % 3 == 0,
+            (row // 2 + col // 3) % 2 == 0,
+            (row * col) % 2 + (row * col) % 3 == 0,
+            ((row * col) % 2 + (row * col) % 3) % 2 == 0,
+            ((row * col) % 3 + (row + col) % 2) % 2 == 0,
+        ])
+
+    # Define function to get the two copies of the 15 format bits' positions, in bit order
+    @staticmethod
+    def _formatPositions(size: int):
+
+        rows, cols = [], []
+
+        # Down column 8
+        for i in range(15):
+            rows.append(i if i < 6 else i + 1 if i < 8 else size - 15 + i)
+            cols.append(8)
+
+        # Along row 8
+        for i in range(15):
+            rows.append(8)
+            cols.append(size - i - 1 if i < 8 else 15 - i if i < 9 else 15 - i - 1)
+
+        return np.array(rows), np.array(cols)
+
+# Define function to get a version's template, built once
+@lru_cache(maxsize=None)
+def _getTemplate(version: int):
+    return _Template(version)
+
+# Define function to count the runs of five or more same-colored modules along the last axis
+# Each run scores its length minus two
+def _runPenalty(candidates: np.ndarray):
+
+    count, size = candidates.shape[0], candidates.shape[-1]
+
+    # Mark run boundaries, including both ends of every line
+    edges = np.ones(candidates.shape[:-1] + (size + 1,), dtype=bool)
+    edges[..., 1:-1] = candidates[..., 1:] != candidates[..., :-1]
+
+    # Distances between consecutive boundaries on a line are run lengths
+    mask, _, position = np.nonzero(edges)
+    lengths = np.diff(position)
+    within = lengths > 0
+    lengths, mask = lengths[within], mask[:-1][within]
+
+    long = lengths >= 5
+    return np.bincount(mask[long], weights=lengths[long] - 2, minlength=count).astype(np.int64)
+
+# Define function to count 1:1:3:1:1 finder-like windows with four light modules on one side, along the last axis
+def _finderPenalty(candidates: np.ndarray):
+
+    # Read every 11-module window as an integer
+    size = candidates.shape[-1]
+    windows = np.zeros(candidates.shape[:-1] + (size - 10,), dtype=np.int32)
+    for i in range(11):
+        windows = (windows << 1) | candidates[..., i:i + size - 10]
+
+    matches = (windows == _FINDER_WINDOWS[0]) | (windows == _FINDER_WINDOWS[1])
+    return matches.reshape(len(candidates), -1).sum(axis=1)
+
+# Define function to score masked candidates (mask, row, column) like qrcode.util.lost_point
+def mask_penalties(candidates: np.ndarray):
+
+    size = candidates.shape[-1]
+    columns = candidates.transpose(0, 2, 1)
+
+    # Runs of five or more in rows and columns
+    penalty = _runPenalty(candidates) + _runPenalty(columns)
+
+    # 2x2 blocks of one color
+    top, bottom = candidates[:, :-1], candidates[:, 1:]
+    blocks = (top[..., :-1] == top[..., 1:]) & (top[..., 1:] == bottom[..., 1:]) & (bottom[..., 1:] == bottom[..., :-1])
+    penalty += 3 * blocks.reshape(len(candidates), -1).sum(axis=1)
+
+    # Finder-like patterns in rows and columns
+    if size > 10:
+        penalty += 40 * (_finderPenalty(candidates) + _finderPenalty(columns))
+
+    # Departure from half dark, in whole 5% steps, with qrcode's float arithmetic
+    for index, dark in enumerate(candidates.reshape(len(candidates), -1).sum(axis=1).tolist()):
+        penalty[index] += int(abs(float(dark) / size ** 2 * 100 - 50) / 5) * 10
+
+    return penalty
+
+# Define function to encode segments into a module matrix, without a border
+# version is the smallest version to use, as with qrcode; mask_pattern fixes the mask instead of scoring all eight
+def encode_segments(segments: List[Segment],
+                    error_correction: int,
+                    version: Optional[int] = None,
+                    mask_pattern: Optional[int] = None):
+
+    # Fit the data, then build its codewords
+    version = best_version(segments, error_correction, version)
+    template = _getTemplate(version)
+    codewords = _codewords(segments, version, error_correction)
+
+    # Unpack to one bit per data module; modules past the end of the data are light
+    bits = np.zeros(len(template.order), dtype=bool)
+    bits[:8 * len(codewords)] = np.unpackbits(codewords)[:len(bits)]
+
+    # Place the data under all eight masks (or the given one) at once
+    masks = template.masks if mask_pattern is None else template.masks[mask_pattern:mask_pattern + 1]
+    candidates = np.repeat(template.modules[None], len(masks), axis=0)
+    candidates.reshape(len(masks), -1)[:, template.order] = bits ^ masks
+
+    # Keep the lowest-scoring mask, the first one on ties
+    if mask_pattern is None:
+        mask_pattern = int(np.argmin(mask_penalties(candidates)))
+        matrix = candidates[mask_pattern]
+    else:
+        matrix = candidates[0]
+
+    # Write the format bits, version bits and dark module
+    format_bits = BCH_type_info((error_correction << 3) | mask_pattern)
+    matrix[template.format_rows, template.format_cols] = np.tile([(format_bits >> i) & 1 == 1 for i in range(15)], 2)
+    if template.version_bits is not None:
+        matrix[template.version_rows, template.version_cols] = np.tile(template.version_bits, 2)
+    matrix[template.size - 8, 8] = True
+
+    return matrix
+
+# Define function to encode data into a module matrix with a light border, like qrcode.QRCode.get_matrix
+# optimize_segments uses optimal_segments instead of qrcode's segmentation
+def encode_matrix(data,
+                  error_correction: int,
+                  border: int = 4,
+                  version: Optional[int] = None,
+                  mask_pattern: Optional[int] = None,
+                  optimize_segments: bool = False):
+
+    error_correction = int(error_correction)
+    if optimize_segments:
+        segments, version = fit_optimal_segments(data, error_correction, version)
+    else:
+        segments = segment_data(data)
+
+    matrix = encode_segments(segments, error_correction, version, mask_pattern)
+    return np.pad(matrix, border) if border else matrix
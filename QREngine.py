@@ -1,13 +1,143 @@
 from PIL import Image as PILImage, ImageDraw
+import numpy as np
+import operator
 import qrcode
-from dataclasses import dataclass
-from typing import Optional, Tuple
+from .QRCache import MatrixCache
+from .QREncoder import best_version, encode_matrix, fit_optimal_segments, segment_data
+from .QRInstrument import RenderInstrument, count, stage
+from .QRStream import write_png_bands
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import BinaryIO, Callable, Iterable, Optional, Tuple, Union
 
 @dataclass
 class RenderCanvas:
     image: PILImage.Image
     draw: ImageDraw.ImageDraw
 
+# Define function to measure the memory held by a canvas or pixel buffer
+def _bufferSize(buffer: Union[RenderCanvas, np.ndarray]):
+    if isinstance(buffer, RenderCanvas):
+        return len(buffer.image.getbands()) * buffer.image.width * buffer.image.height
+    return buffer.nbytes
+
+# Define a pool of reusable canvases and pixel buffers, keyed by size and mode
+# Free buffers are kept up to max_bytes, least recently returned ones being dropped first
+class CanvasPool:
+
+    # Define initializer
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+
+        # Set the byte budget
+        self.max_bytes = max_bytes
+        self.retained_bytes = 0
+
+        # Free buffers per key, in least- to most-recently returned order
+        self._free: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+        # Set counters
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    # Pools are rebuilt empty when pickled, e.g. into worker processes
+    def __getstate__(self):
+        return {"max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_bytes"])
+
+    # Define function to get a canvas cleared to color
+    def acquire_canvas(self, size: Tuple[int, int], mode: str = "RGBA", color="white"):
+
+        # Reuse a free canvas, clearing it
+        canvas = self._take(("canvas", size, mode))
+        if canvas is not None:
+            canvas.image.paste(color, (0, 0, *size))
+            return canvas
+
+        # Otherwise create one
+        image = PILImage.new(mode, size, color)
+        return RenderCanvas(image, ImageDraw.Draw(image))
+
+    # Define function to get an uninitialized uint8 pixel buffer
+    def acquire_pixels(self, shape: Tuple[int, ...]):
+
+        pixels = self._take(("pixels", shape))
+        return pixels if pixels is not None else np.empty(shape, dtype=np.uint8)
+
+    # Define function to return a canvas or pixel buffer to the pool
+    # Anything built on it (such as an image from PILImage.fromarray) must no longer be used
+    def release(self, buffer: Union[RenderCanvas, np.ndarray]):
+
+        # Key and measure the buffer
+        if isinstance(buffer, RenderCanvas):
+            key = ("canvas", buffer.image.size, buffer.image.mode)
+        else:
+            key = ("pixels", buffer.shape)
+        size = _bufferSize(buffer)
+
+        with self._lock:
+
+            # Buffers larger than the whole budget are never kept, and none is kept twice
+            free = self._free.setdefault(key, [])
+            if size > self.max_bytes or any(other is buffer for other in free):
+                self.discarded += size > self.max_bytes
+                if not free:
+                    del self._free[key]
+                return
+
+            # Keep it as most recently returned
+            free.append(buffer)
+            self._free.move_to_end(key)
+            self.retained_bytes += size
+
+            # Drop least recently returned buffers until within budget
+            while self.retained_bytes > self.max_bytes:
+                oldest_key, oldest = next(iter(self._free.items()))
+                self.retained_bytes -= _bufferSize(oldest.pop(0))
+                self.discarded += 1
+                if not oldest:
+                    del self._free[oldest_key]
+
+    # Define function to take a free buffer for a key, if there is one
+    def _take(self, key: tuple):
+
+        with self._lock:
+
+            # Record a miss if none is free
+            free = self._free.get(key)
+            if not free:
+                self.misses += 1
+                return None
+
+            # Otherwise hand out the most recently returned one
+            buffer = free.pop()
+            if not free:
+                del self._free[key]
+            self.retained_bytes -= _bufferSize(buffer)
+            self.hits += 1
+            return buffer
+
+    # Define function to report pool counters
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "discarded": self.discarded,
+                "retained_bytes": self.retained_bytes,
+                "free_buffers": sum(len(free) for free in self._free.values()),
+            }
+
+    # Define function to drop every free buffer
+    def clear(self):
+        with self._lock:
+            self._free.clear()
+            self.retained_bytes = 0
+
 @dataclass
 class RenderSettings:
 
@@ -15,39 +145,151 @@ class RenderSettings:
     px_per_cell: int = 50
     cells_per_block: int = 2
 
+    # Optional instrumentation, called with each pipeline stage and count
+    instrument: Optional[RenderInstrument] = field(default=None, repr=False, compare=False)
+
+    # Optional canvas pool; renders that encode their own output return their buffers to it
+    canvas_pool: Optional[CanvasPool] = field(default=None, repr=False, compare=False)
+
+    # Read every full render back and raise QRVerify.VerificationError if it does not match its code,
+    # or its contrast margin is below min_contrast; banded renders are not verified
+    # Both compare, so cached outputs are only shared between specs that check them the same way
+    verify: bool = False
+    min_contrast: float = 0.0
+
+# Encoder backends for QRGenerator
+# "qrcode" is the reference; "native" builds the same matrices with NumPy
+ENCODERS = ("qrcode", "native")
+
 # Define QRGenerator class
 class QRGenerator:
 
     # Define initializer
-    def __init__(self, QRString: str):
+    def __init__(self,
+                 QRString: str,
+                 error_correction: int = qrcode.constants.ERROR_CORRECT_M,
+                 border: int = 1,
+                 version: Optional[int] = None,
+                 matrix_cache: Optional[MatrixCache] = None,
+                 instrument: Optional[RenderInstrument] = None,
+                 encoder: str = "qrcode",
+                 optimize_segments: bool = False):
 
 
-        # Assign the QR string and the QR Data Matrix
+        # Assign the QR string and encoding parameters
         self.QRString: str = QRString
-        self.QRData: list[list[bool]] = self._getQRData()
+        self.error_correction = error_correction
+        self.border = border
+        self.version = version
+
+        # Set the encoder backend
+        if encoder not in ENCODERS:
+            raise ValueError(f"Unknown encoder: {encoder}")
+        self.encoder = encoder
+
+        # Split the data into numeric, alphanumeric and byte segments with the fewest bits,
+        # instead of only splitting off long numeric and alphanumeric runs
+        self.optimize_segments = optimize_segments
+
+        # Set the optional matrix cache
+        self.matrix_cache = matrix_cache
+
+        # Assign the QR module matrix
+        # The matrix is a read-only boolean array, built once
+        with stage(instrument, "encode"):
+            self.QRMatrix: np.ndarray = self._getQRData()
+
+        # The nested list view is only built when asked for
+        self.__QRData: Optional[list[list[bool]]] = None
 
         # Assign width and height
-        self.width = len(self.QRData[0])
-        self.height = len(self.QRData)
+        self.height, self.width = self.QRMatrix.shape
 
-    # Define function to generate QR code data
+        # Report how many versions optimal segmentation saved
+        if instrument is not None and self.optimize_segments:
+            count(instrument, "versions_saved", self.versions_saved() or 0)
+
+    # Define function to get the QR version the data was encoded at
+    def get_version(self):
+        return (self.height - 2 * self.border - 17) // 4
+
+    # Define function to get how many versions smaller optimal segmentation made the code
+    # Returns 0 without optimize_segments, and None if the default segmentation would not fit at all
+    def versions_saved(self):
+
+        if not self.optimize_segments:
+            return 0
+
+        try:
+            default_version = best_version(segment_data(self.QRString), int(self.error_correction), self.version)
+        except ValueError:
+            return None
+        return default_version - self.get_version()
+
+    # Define lazily-derived list view of the matrix
+    @property
+    def QRData(self) -> list[list[bool]]:
+
+        # Build the nested lists on first access
+        if self.__QRData is None:
+            self.__QRData = self.QRMatrix.tolist()
+
+        # Return the QR Data Matrix
+        return self.__QRData
+
+    # Define function to get QR code data, from the cache when one is set
     def _getQRData(self):
 
+        # Encode directly without a cache
+        if self.matrix_cache is None:
+            return self._encodeQRData()
+
+        # Otherwise key on the payload and every encoding parameter
+        # Both encoders produce the same matrix, so they share entries
+        key = (self.QRString, self.error_correction, self.border, self.version)
+
+        # Optimal segmentation can change the matrix, so it is part of the key
+        if self.optimize_segments:
+            key += ("optimize_segments",)
+        return self.matrix_cache.get_or_create(key, self._encodeQRData)
+
+    # Define function to generate QR code data
+    def _encodeQRData(self):
+
+        # Encode natively when asked
+        if self.encoder == "native":
+            QRMatrix = encode_matrix(self.QRString, self.error_correction, self.border, self.version,
+                                     optimize_segments=self.optimize_segments)
+            QRMatrix.flags.writeable = False
+            return QRMatrix
+
+        # Choose the segments, and the version they fit, up front when optimizing
+        version = self.version
+        if self.optimize_segments:
+            segments, version = fit_optimal_segments(self.QRString, int(self.error_correction), version)
+
         # Create QR object
-        qr = qrcode.QRCode(border=1)
+        qr = qrcode.QRCode(version=version,
+                           error_correction=self.error_correction,
+                           border=self.border)
 
         # Add data to the QR code and make it
-        qr.add_data(self.QRString)
+        if self.optimize_segments:
+            for mode, data in segments:
+                qr.add_data(qrcode.util.QRData(data, mode=mode, check_data=False))
+        else:
+            qr.add_data(self.QRString)
         qr.make()
 
-        # Extract the QR data
-        QRData = qr.get_matrix()
+        # Pack the QR data into a boolean array and freeze it
+        QRMatrix = np.array(qr.get_matrix(), dtype=bool)
+        QRMatrix.flags.writeable = False
 
         # Return the QR Data Matrix
-        return QRData
+        return QRMatrix
 
 # Define a class for storing a single QR Cell
-@dataclass
+@dataclass(slots=True)
 class QRCell:
     x: int
     y: int
@@ -55,47 +297,221 @@ class QRCell:
     dy: int
     value: bool
 
+# Define a lazy, column-oriented view over every cell of a QR code
+# Cells are ordered by y, x, dy, dx and only become QRCell objects when read
+class QRCellGrid:
+
+    __slots__ = ("matrix", "cells_per_block", "_columns")
+
+    # Define initializer
+    def __init__(self, matrix: np.ndarray, cells_per_block: int):
+
+        # Set the module matrix and block size
+        self.matrix = matrix
+        self.cells_per_block = cells_per_block
+
+        # Columns are only built when first requested
+        self._columns: Optional[Tuple[np.ndarray, ...]] = None
+
+    # Define the number of cells
+    def __len__(self):
+        return self.matrix.size * self.cells_per_block * self.cells_per_block
+
+    # Define iteration, yielding one QRCell at a time
+    def __iter__(self):
+        return self.iter_rows(0, self.matrix.shape[0])
+
+    # Define iteration over the cells of module rows start to stop
+    def iter_rows(self, start: int, stop: int):
+
+        # Get the block size once
+        cells_per_block = self.cells_per_block
+
+        # Iterate through pixels of the QR Code
+        for y, row in enumerate(self.matrix[start:stop].tolist(), start=start):
+            for x, value in enumerate(row):
+
+                # Iterate through the pixels in the current QR block
+                for dy in range(cells_per_block):
+                    for dx in range(cells_per_block):
+                        yield QRCell(x, y, dx, dy, value)
+
+    # Define random access by flat cell index, or a list of cells for a slice, as the list of cells used to give
+    def __getitem__(self, index: Union[int, slice]):
+
+        # Slices read each cell in turn
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        # Support negative indexes like a list
+        index = operator.index(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("cell index out of range")
+
+        # Split the index into block and sub-cell positions
+        block, sub = divmod(index, self.cells_per_block * self.cells_per_block)
+        y, x = divmod(block, self.matrix.shape[1])
+        dy, dx = divmod(sub, self.cells_per_block)
+
+        # Return the cell view
+        return QRCell(x, y, dx, dy, bool(self.matrix[y, x]))
+
+    # Define function to lay out per-cell values, given in cell order, as a (cell row, cell column, ...) grid
+    def to_grid(self, values: np.ndarray):
+
+        # Split the flat cell axis into (y, x, dy, dx), keeping any trailing axes
+        values = np.asarray(values)
+        height, width = self.matrix.shape
+        cells_per_block = self.cells_per_block
+        grid = values.reshape(height, width, cells_per_block, cells_per_block, *values.shape[1:])
+
+        # Interleave sub-cells with their modules: (y, dy, x, dx)
+        grid = grid.swapaxes(1, 2)
+        return grid.reshape(height * cells_per_block, width * cells_per_block, *values.shape[1:])
+
+    # Define function to get a grid for another matrix of the same shape
+    # Position columns only depend on the shape, so already-built ones are shared
+    def with_matrix(self, matrix: np.ndarray):
+
+        grid = QRCellGrid(matrix, self.cells_per_block)
+        if self._columns is not None and matrix.shape == self.matrix.shape:
+            grid._columns = (*self._columns[:4], grid._getValueColumn())
+
+        return grid
+
+    # Define function to build the x, y, dx, dy and value columns once
+    def _getColumns(self):
+
+        if self._columns is None:
+
+            # Index every (y, x, dy, dx) position in cell order
+            height, width = self.matrix.shape
+            shape = (height, width, self.cells_per_block, self.cells_per_block)
+            y, x, dy, dx = np.indices(shape, dtype=np.int32).reshape(4, -1)
+
+            # Freeze and store the columns
+            for column in (x, y, dx, dy):
+                column.flags.writeable = False
+            self._columns = (x, y, dx, dy, self._getValueColumn())
+
+        return self._columns
+
+    # Define function to build the value column, broadcasting each module value across its block
+    def _getValueColumn(self):
+
+        height, width = self.matrix.shape
+        shape = (height, width, self.cells_per_block, self.cells_per_block)
+        value = np.broadcast_to(self.matrix[:, :, None, None], shape).reshape(-1)
+        value.flags.writeable = False
+        return value
+
+    # Define column accessors
+    @property
+    def x(self) -> np.ndarray:
+        return self._getColumns()[0]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self._getColumns()[1]
+
+    @property
+    def dx(self) -> np.ndarray:
+        return self._getColumns()[2]
+
+    @property
+    def dy(self) -> np.ndarray:
+        return self._getColumns()[3]
+
+    @property
+    def value(self) -> np.ndarray:
+        return self._getColumns()[4]
+
 # Define QRRenderer base class
 class QRRenderer:
 
     # Define initializer
-    def __init__(self, QR: QRGenerator, renderSettings: RenderSettings):
+    # canvas_pool overrides the pool set in renderSettings
+    def __init__(self, QR: QRGenerator, renderSettings: RenderSettings, canvas_pool: Optional[CanvasPool] = None):
 
         # Set QRdata
         self.__QR = QR
 
         # Set RenderSettings
-        self.__renderSettings = RenderSettings
+        self.__renderSettings = renderSettings
+
+        # Set canvas pool, and the buffers taken from it while render_to runs (None otherwise)
+        self.__pool = canvas_pool if canvas_pool is not None else renderSettings.canvas_pool
+        self.__acquired: Optional[list] = None
+
+        # The cell grid is built on first use
+        self.__cells: Optional[QRCellGrid] = None
+
+    # Define function to point the renderer at another QR code of the same size
+    # canvas_pool, if set, overrides the one in renderSettings; returns the cell grid for the new code
+    def rebind(self, QR: QRGenerator, canvas_pool: Optional[CanvasPool] = None):
+
+        # Set the code and pool
+        self.__QR = QR
+        self.__pool = canvas_pool if canvas_pool is not None else self.__renderSettings.canvas_pool
+
+        # Position columns only depend on the size, so they are kept
+        if self.__cells is not None:
+            self.__cells = self.__cells.with_matrix(QR.QRMatrix)
+        return self.get_cell_grid()
 
     # Define get cells function
+    # Builds every QRCell up front; prefer get_cell_grid for large codes
     def get_cells(self):
 
-        # Create list for storing strings
-        cells = []
+        # Return cells list
+        with stage(self.__renderSettings.instrument, "cells"):
+            return list(self.iter_cells())
 
-        # Iterate through pixels of the QR Code
-        for y in range(self.__QR.height):
-            for x in range(self.__QR.width):
+    # Define function to iterate through cells without storing them
+    def iter_cells(self):
+        return iter(self.get_cell_grid())
 
-                # Get the value at the current position of the QR matrix
-                value = self.__QR.QRData[y][x]
+    # Define function to get a lazy, array-backed view of the cells
+    def get_cell_grid(self):
 
-                # Iterate through the pixels in the current QR block
-                for dy in range(self.__renderSettings.cells_per_block):
-                    for dx in range(self.__renderSettings.cells_per_block):
+        if self.__cells is None:
+            self.__cells = QRCellGrid(self.__QR.QRMatrix, self.__renderSettings.cells_per_block)
 
-                        # Create cell and add it to list
-                        cells.append(QRCell(x, y, dx, dy, value))
+        return self.__cells
 
-        # Return cells list
-        return cells
-    
-    def get_canvas(self):
+    # Define function to get the rendered image size in pixels
+    def get_size(self):
 
         # Calculate image width and height
         width = self.__QR.width * self.__renderSettings.cells_per_block * self.__renderSettings.px_per_cell
         height = self.__QR.height * self.__renderSettings.cells_per_block * self.__renderSettings.px_per_cell
 
+        return (width, height)
+
+    # Define function to split the image into horizontal (top, bottom) pixel bands
+    def get_bands(self, band_height: int):
+
+        # Get the image height
+        height = self.get_size()[1]
+
+        # Yield bands, the last one possibly shorter
+        for top in range(0, height, band_height):
+            yield (top, min(top + band_height, height))
+
+    # Define function to get a canvas, optionally only band_height rows tall
+    def get_canvas(self, band_height: Optional[int] = None):
+
+        # Calculate image width and height
+        width, height = self.get_size()
+        if band_height is not None:
+            height = band_height
+
+        # Take a cleared canvas from the pool
+        if self.__pool is not None:
+            return self._track(self.__pool.acquire_canvas((width, height)))
+
         # Initialize new image and draw classes
         image = PILImage.new("RGBA", (width, height), "white")
         draw = ImageDraw.Draw(image)
@@ -105,3 +521,207 @@ class QRRenderer:
 
         # Return the canvas
         return canvas
+
+    # Define function for getting an uninitialized uint8 pixel buffer of the given shape
+    def get_pixels(self, shape: Tuple[int, ...]):
+
+        # Allocate a fresh buffer unless there is a pool
+        if self.__pool is None:
+            return np.empty(shape, dtype=np.uint8)
+
+        return self._track(self.__pool.acquire_pixels(shape))
+
+    # Define function to note a pooled buffer taken while render_to runs, so it is returned once encoded
+    # Buffers taken by render() belong to the image it returns, so they are not noted
+    def _track(self, buffer: Union[RenderCanvas, np.ndarray]):
+
+        if self.__acquired is not None:
+            self.__acquired.append(buffer)
+        return buffer
+
+    # Define function to return every noted buffer to the pool
+    def _releaseBuffers(self):
+
+        for buffer in self.__acquired:
+            self.__pool.release(buffer)
+        self.__acquired.clear()
+
+    # Define function to pass bands through, returning each band's buffers once the next is requested
+    def _recycleBands(self, bands: Iterable[PILImage.Image]):
+        for band in bands:
+            yield band
+            self._releaseBuffers()
+
+    # Define function for rendering straight into a file-like object with a renderer's render and render_bands
+    # band_height streams the PNG in strips, so only one strip is held in memory; otherwise the image is
+    # reduced to the smallest exact mode before encoding. Pooled buffers are returned once encoded
+    def render_to(self,
+                  stream: BinaryIO,
+                  render: Callable[[], PILImage.Image],
+                  render_bands: Callable[[int], Iterable[PILImage.Image]],
+                  format: str = "PNG",
+                  compress_level: int = 6,
+                  band_height: Optional[int] = None):
+
+        # Strips are only written as PNG
+        if band_height is not None and format.upper() != "PNG":
+            raise ValueError("Banded rendering only supports PNG output")
+
+        instrument = self.__renderSettings.instrument
+        self.__acquired = []
+        try:
+
+            # Stream strips into an incremental PNG writer
+            if band_height is not None:
+                with stage(instrument, "encode_output"):
+                    write_png_bands(stream, self.get_size(), self._recycleBands(render_bands(band_height)), compress_level)
+                return
+
+            # Render, reduce to the smallest exact mode and encode
+            image = render()
+            with stage(instrument, "reduce_mode"):
+                image = reduce_image_mode(image)
+            with stage(instrument, "encode_output"):
+                write_image(image, stream, format, compress_level)
+
+        # Return pooled buffers, then stop noting them
+        finally:
+            self._releaseBuffers()
+            self.__acquired = None
+
+# Define function to get one of a protocol's optional fast-path methods (such as get_palette), or None
+# A method is only trusted when it is defined on the same class as __call__, so a subclass that
+# overrides __call__ alone keeps being called per cell
+def protocol_method(protocol, name: str):
+
+    # Protocols without the method, or that set it to None, have no fast path
+    method = getattr(protocol, name, None)
+    if method is None:
+        return None
+
+    # Find the classes that define the method and __call__
+    classes = type(protocol).__mro__
+    owner = next((cls for cls in classes if name in vars(cls)), None)
+    call_owner = next((cls for cls in classes if "__call__" in vars(cls)), None)
+
+    # Protocols with no per-cell form only have the fast path
+    if call_owner is None or owner is call_owner:
+        return method
+    return None
+
+# Define function to pack RGBA colors (a (..., 4) uint8 array) into 32-bit words, one per pixel
+# Whole-word copies are much faster than broadcasting 4-byte channels
+def pack_rgba(colors: np.ndarray):
+    return np.ascontiguousarray(colors, dtype=np.uint8).view(np.uint32)[..., 0]
+
+# Define function to reduce an image to the smallest mode that holds it exactly
+def reduce_image_mode(image: PILImage.Image):
+
+    # Drop an alpha channel that is fully opaque
+    if image.mode == "RGBA" and image.getextrema()[3] == (255, 255):
+        image = image.convert("RGB")
+
+    # Only opaque RGB images with at most 256 colors can be reduced further
+    colors = image.getcolors(256) if image.mode == "RGB" else None
+    if colors is None:
+        return image
+
+    # Pure black and white fits in 1 bit per pixel
+    palette = sorted(color for _, color in colors)
+    if set(palette) <= {(0, 0, 0), (255, 255, 255)}:
+        return image.convert("1", dither=PILImage.Dither.NONE)
+
+    # Otherwise map every pixel to its exact palette index
+    pixels = np.asarray(image, dtype=np.uint32)
+    packed = (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+    keys = np.array([(r << 16) | (g << 8) | b for r, g, b in palette], dtype=np.uint32)
+    indexed = PILImage.fromarray(np.searchsorted(keys, packed).astype(np.uint8))
+    indexed.putpalette([channel for color in palette for channel in color])
+
+    # Return the palette image
+    return indexed
+
+# Modes each format can store, for formats that cannot store every mode the renderers produce
+_FORMAT_MODES = {
+    "JPEG": ("1", "L", "RGB", "CMYK"),
+}
+
+# Define function to convert an image to a mode the output format can store
+# Transparency is flattened onto white, like the renderers' own background
+def _convertForFormat(image: PILImage.Image, format: str):
+
+    modes = _FORMAT_MODES.get(format.upper().replace("JPG", "JPEG"))
+    if modes is None or image.mode in modes:
+        return image
+
+    # Composite transparent images over white
+    if "A" in image.getbands() or "transparency" in image.info:
+        rgba = image.convert("RGBA")
+        flattened = PILImage.new("RGB", rgba.size, "white")
+        flattened.paste(rgba, mask=rgba.getchannel("A"))
+        return flattened
+
+    # Otherwise expand palettes and other modes to RGB
+    return image.convert("RGB")
+
+# Define function to encode an image straight into a file-like object
+# compress_level trades speed for size: zlib level for PNG, method (0-6) for lossless WebP
+def write_image(image: PILImage.Image, stream: BinaryIO, format: str = "PNG", compress_level: int = 6):
+
+    # Convert to a mode the format can store
+    image = _convertForFormat(image, format)
+
+    # Set format options
+    options = {}
+    if format.upper() == "PNG":
+        options["compress_level"] = compress_level
+    elif format.upper() == "WEBP":
+        options["lossless"] = True
+        options["method"] = min(compress_level, 6)
+
+    # Encode into the stream
+    image.save(stream, format=format, **options)
+
+# Define a render stored as one label per pixel, with each label's mix of a few named colors
+# Images from to_image() map the label buffer without copying it, so recoloring only recomputes
+# the palette, whatever the image size
+class IndexedCanvas:
+
+    # Define initializer
+    # labels is an (height, width) uint8 array; mixes gives each label's weight per color, in colors' order
+    def __init__(self, labels: np.ndarray, mixes: np.ndarray, colors: dict):
+
+        # Labels are shared by every recolored canvas and image, so they stay read-only
+        self.labels = np.ascontiguousarray(labels, dtype=np.uint8)
+        self.labels.flags.writeable = False
+        self.mixes = mixes
+        self.colors = dict(colors)
+
+    # Define image size, as (width, height)
+    @property
+    def size(self):
+        return (self.labels.shape[1], self.labels.shape[0])
+
+    # Define function to get a canvas sharing these labels with some colors replaced
+    def recolor(self, **colors):
+
+        unknown = set(colors) - set(self.colors)
+        if unknown:
+            raise ValueError(f"Unknown colors: {', '.join(sorted(unknown))} (expected {', '.join(self.colors)})")
+
+        return IndexedCanvas(self.labels, self.mixes, {**self.colors, **colors})
+
+    # Define function to get the flat RGB palette, one entry per label
+    def get_palette(self):
+        colors = np.array([self.colors[name] for name in self.colors], dtype=np.float64)
+        return np.rint(self.mixes @ colors).clip(0, 255).astype(np.uint8).ravel().tolist()
+
+    # Define function to get a "P" image over the labels
+    def to_image(self):
+        image = PILImage.frombuffer("P", self.size, self.labels, "raw", "P", 0, 1)
+        image.putpalette(self.get_palette())
+        return image
+
+    # Define function to encode the image straight into a file-like object
+    def write(self, stream: BinaryIO, format: str = "PNG", compress_level: int = 6):
+        write_image(self.to_image(), stream, format, compress_level)
@@ -1,8 +1,31 @@
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from typing import BinaryIO, Optional, Tuple
 from PIL import Image as PILImage
+import numpy as np
+import os
+import warnings
 
-from .QREngine import QRCell, QRRenderer, QRGenerator, RenderSettings
+from .QREngine import CanvasPool, QRRenderer, QRGenerator, RenderSettings, pack_rgba
+from .QRCache import LRUCache
+from .QRInstrument import stage
+from .QRVerify import check_render
+
+# Define function to measure the memory held by an (on, off) tile pair
+def _tilesSize(tiles: Tuple[PILImage.Image, PILImage.Image]):
+    return sum(len(tile.getbands()) * tile.width * tile.height for tile in tiles)
+
+# Process-wide cache of ready-to-paste (on, off) tiles, bounded to 64 MiB
+TILE_CACHE = LRUCache(maxsize=256, max_bytes=64 * 1024 * 1024, sizeof=_tilesSize)
+
+# Define function to identify a file's contents by path, modification time and size
+def _fileKey(filename: Optional[str]):
+
+    # Unused image slots stay out of the key
+    if filename is None:
+        return None
+
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
 
 @dataclass
 class QRImageStyle:
@@ -19,13 +42,18 @@ class QRImageStyle:
     on_tint: Optional[Tuple[Tuple[int, int, int], float]] = None
     off_tint: Optional[Tuple[Tuple[int, int, int], float]] = None
 
-    # Render settings
-    px_per_cell: int = 50
-    cells_per_block: int = 2
+    # Deprecated: sizes come from RenderSettings. Renderers raise ValueError if these are set and disagree
+    px_per_cell: Optional[int] = None
+    cells_per_block: Optional[int] = None
 
     # Post init to validate we have exactly one style
     def __post_init__(self):
 
+        # Warn about the deprecated size fields
+        if self.px_per_cell is not None or self.cells_per_block is not None:
+            warnings.warn("QRImageStyle.px_per_cell and cells_per_block are deprecated; set them on RenderSettings",
+                          DeprecationWarning, stacklevel=3)
+
         # Set boolean values to check if we either have two images or two tints
         two_image_set = self.on_image_filename is not None and self.off_image_filename is not None
         two_tint_set = self.on_tint is not None and self.off_tint is not None
@@ -48,7 +76,11 @@ class QRImageStyle:
 
 # Define QRImageBlockRenderer
 class QRImageBlockRenderer:
-    def __init__(self, QR: QRGenerator, style: QRImageStyle, renderSettings: RenderSettings):
+    def __init__(self,
+                 QR: QRGenerator,
+                 style: QRImageStyle,
+                 renderSettings: RenderSettings,
+                 tile_cache: Optional[LRUCache] = None):
 
         # Set QRData
         self.QR = QR
@@ -59,15 +91,24 @@ class QRImageBlockRenderer:
         # Set render settings
         self.__renderSettings = renderSettings
 
+        # Sizes still set on the style must agree with the render settings
+        for name in ("px_per_cell", "cells_per_block"):
+            value = getattr(style, name)
+            if value is not None and value != getattr(renderSettings, name):
+                raise ValueError(f"QRImageStyle.{name} ({value}) does not match RenderSettings.{name} "
+                                 f"({getattr(renderSettings, name)}); set it on RenderSettings only")
+
+        # Set tile cache (process-wide unless another one is passed)
+        self.tile_cache = tile_cache if tile_cache is not None else TILE_CACHE
 
         # Create a base renderer
         self.__renderer = QRRenderer(self.QR, self.__renderSettings)
 
         # Get the cells
-        self.cells = self.__renderer.get_cells()
+        self.cells = self.__renderer.get_cell_grid()
 
-        # Get the canvas
-        self.__canvas = self.__renderer.get_canvas()
+        # Tiles are fetched once per renderer
+        self.__tiles = None
 
         # Set tints
         # First value: color
@@ -76,29 +117,55 @@ class QRImageBlockRenderer:
         self.offTint = ((255, 255, 255), 0.7)
 
 
-    def _getXYPos(self, currentCell: QRCell):
-
-        # Calculate pixel coordinates
-        xpos = (currentCell.x * self.style.cells_per_block + currentCell.dx) * self.style.px_per_cell
-        ypos = (currentCell.y * self.style.cells_per_block + currentCell.dy) * self.style.px_per_cell
-
-        return (xpos, ypos)
-
+    # Define function to point the renderer at another QR code of the same size
+    # The tiles are kept; canvas_pool, if set, overrides the one in renderSettings
+    def _rebind(self, QR: QRGenerator, canvas_pool: Optional[CanvasPool] = None):
+        self.QR = QR
+        self.cells = self.__renderer.rebind(QR, canvas_pool)
 
     # Define function to open the image
     def _openImage(self, filename):
 
         # Open the image
-        image: PILImage.Image = PILImage.open(filename).convert("RGBA")
+        with stage(self.__renderSettings.instrument, "open_image"):
+            image: PILImage.Image = PILImage.open(filename).convert("RGBA")
 
         # Scale the image
-        image = self._scaleImage(image)
+        with stage(self.__renderSettings.instrument, "scale_image"):
+            image = self._scaleImage(image)
 
         # Return the image
         return image
     
-    # Create render function
-    def render(self):
+    # Define function to get the (on, off) tiles, from the cache on first use
+    def _getTiles(self):
+
+        if self.__tiles is None:
+            self.__tiles = self._fetchTiles()
+
+        return self.__tiles
+
+    # Define function to get the (on, off) tiles from the cache
+    def _fetchTiles(self):
+
+        # The base image is only used when the style is tinted
+        two_image_set = self.style.on_image_filename and self.style.off_image_filename
+        base_image_filename = None if two_image_set else self.style.base_image_filename
+
+        # Key on file contents and everything that changes the processed tiles
+        key = (
+            _fileKey(base_image_filename),
+            _fileKey(self.style.on_image_filename),
+            _fileKey(self.style.off_image_filename),
+            self.style.on_tint,
+            self.style.off_tint,
+            self.__renderSettings.px_per_cell,
+        )
+        with stage(self.__renderSettings.instrument, "tiles"):
+            return self.tile_cache.get_or_create(key, self._loadTiles)
+
+    # Define function to decode, scale and tint the (on, off) tiles
+    def _loadTiles(self):
 
         # Get on / off images if present
         if self.style.on_image_filename and self.style.off_image_filename:
@@ -121,31 +188,78 @@ class QRImageBlockRenderer:
             else:
                 offImage = baseImage.copy()
 
+        # Return the tiles
+        return (onImage, offImage)
 
-        # Iterate through cells
-        for cell in self.cells:
+    # Create render function
+    def render(self):
 
-            # Get the correct tinted image depending on if cell value is true or not
-            image = onImage if cell.value else offImage
+        # Get on / off tiles, decoding them only on a cache miss
+        onImage, offImage = self._getTiles()
 
-            # Call render cell
-            self._renderCell(cell, image)
+        # Build the whole canvas from the two tiles
+        with stage(self.__renderSettings.instrument, "draw"):
+            image = self._composeTiles(onImage, offImage)
 
-        # Return the canvas (should contain rendered image)
-        return self.__canvas.image
+        # Read the image back when asked
+        check_render(image, self.QR, self.__renderSettings)
+        return image
 
-    
-    # Define a function to render a cell
-    def _renderCell(self, 
-                    currentCell: QRCell,
-                    image: PILImage.Image):
+    # Define function for rendering the image as horizontal strips of band_height pixels
+    def render_bands(self, band_height: int):
+
+        # Get on / off tiles once for every band
+        onImage, offImage = self._getTiles()
+
+        # Iterate through bands
+        for top, bottom in self.__renderer.get_bands(band_height):
+            with stage(self.__renderSettings.instrument, "draw"):
+                band = self._composeTiles(onImage, offImage, top, bottom)
+            yield band
+
+    # Define function for rendering straight into a file-like object
+    # band_height streams the PNG in strips, so only one strip is held in memory
+    def render_to(self,
+                  stream: BinaryIO,
+                  format: str = "PNG",
+                  compress_level: int = 6,
+                  band_height: Optional[int] = None):
+        self.__renderer.render_to(stream, self.render, self.render_bands, format, compress_level, band_height)
+
+    # Define function to tile the canvas (or pixel rows top to bottom of it) with the on/off images in one pass
+    def _composeTiles(self,
+                      onImage: PILImage.Image,
+                      offImage: PILImage.Image,
+                      top: int = 0,
+                      bottom: Optional[int] = None):
+
+        # Upscale the module matrix to one value per cell
+        cells_per_block, px_per_cell = self.__renderSettings.cells_per_block, self.__renderSettings.px_per_cell
+        mask = np.repeat(np.repeat(self.QR.QRMatrix, cells_per_block, axis=0), cells_per_block, axis=1)
+
+        # Keep only the cell rows that overlap the requested pixel rows
+        if bottom is None:
+            bottom = mask.shape[0] * px_per_cell
+        first_row = top // px_per_cell
+        mask = mask[first_row:-(-bottom // px_per_cell)]
+        rows, columns = mask.shape
+
+        # Allocate the canvas, viewed as packed pixels by (cell row, cell column, tile row, tile column)
+        pixels = self.__renderer.get_pixels((rows, px_per_cell, columns, px_per_cell, 4))
+        tiles = pixels.view(np.uint32)[..., 0].transpose(0, 2, 1, 3)
+
+        # Fill every cell with the off tile, then copy the on tile where the module is set
+        tiles[...] = pack_rgba(np.asarray(offImage))
+        np.copyto(tiles, pack_rgba(np.asarray(onImage)), where=mask[:, :, None, None])
+
+        # Crop to the requested rows
+        pixels = pixels.reshape(rows * px_per_cell, columns * px_per_cell, 4)
+        offset = first_row * px_per_cell
+        pixels = pixels[top - offset:bottom - offset]
 
-        # Get the pixel coordinates
-        xpos, ypos = self._getXYPos(currentCell)
+        # Return the canvas (should contain rendered image)
+        return PILImage.fromarray(pixels, "RGBA")
 
-        # paste the image at this location
-        self.__canvas.image.paste(image, (xpos, ypos))
-    
     # Define function to scale image to fit and crop to square
     def _scaleImage(self, image):
 
@@ -154,7 +268,7 @@ class QRImageBlockRenderer:
         original_width, original_height = original_size
 
         # Get target width and height from settings
-        target_width =  target_height = self.style.px_per_cell
+        target_width =  target_height = self.__renderSettings.px_per_cell
 
         # Calculate aspect ratios
         original_aspect = original_width / original_height
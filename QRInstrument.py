@@ -0,0 +1,87 @@
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Callable, ContextManager, Optional, Protocol
+import time
+
+# Define interface for render pipeline instrumentation
+# stage() wraps a timed pipeline stage; count() records an event count
+class RenderInstrument(Protocol):
+
+    def stage(self, name: str) -> ContextManager:
+        ...
+
+    def count(self, name: str, n: int = 1) -> None:
+        ...
+
+# Shared no-op context, so disabled instrumentation allocates nothing
+_NULL_STAGE = nullcontext()
+
+# Define function to enter a stage on an optional instrument
+def stage(instrument: Optional[RenderInstrument], name: str):
+
+    # No instrument: return the shared no-op context
+    if instrument is None:
+        return _NULL_STAGE
+
+    return instrument.stage(name)
+
+# Define function to record a count on an optional instrument
+def count(instrument: Optional[RenderInstrument], name: str, n: int = 1):
+    if instrument is not None:
+        instrument.count(name, n)
+
+# Define a simple instrument that totals stage durations and counts
+# on_stage and on_count forward every event, e.g. to a metrics exporter
+class StageTimer:
+
+    # Define initializer
+    def __init__(self,
+                 on_stage: Optional[Callable[[str, float], None]] = None,
+                 on_count: Optional[Callable[[str, int], None]] = None,
+                 clock: Callable[[], float] = time.perf_counter):
+
+        # Set callbacks and clock
+        self.on_stage = on_stage
+        self.on_count = on_count
+        self.clock = clock
+
+        # Set totals
+        self.durations = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counts = defaultdict(int)
+
+    # Define a timed stage
+    @contextmanager
+    def stage(self, name: str):
+
+        start = self.clock()
+        try:
+            yield
+        finally:
+
+            # Record the duration, even if the stage raised
+            elapsed = self.clock() - start
+            self.durations[name] += elapsed
+            self.calls[name] += 1
+            if self.on_stage is not None:
+                self.on_stage(name, elapsed)
+
+    # Define event counter
+    def count(self, name: str, n: int = 1):
+
+        self.counts[name] += n
+        if self.on_count is not None:
+            self.on_count(name, n)
+
+    # Define function to report totals
+    def report(self):
+        return {
+            "stages": {name: {"seconds": self.durations[name], "calls": self.calls[name]} for name in self.durations},
+            "counts": dict(self.counts),
+        }
+
+    # Define function to reset totals
+    def reset(self):
+        self.durations.clear()
+        self.calls.clear()
+        self.counts.clear()
@@ -0,0 +1,133 @@
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Optional, Tuple
+from PIL import Image as PILImage
+
+# Modes whose raw layout PIL can map without copying
+_MAPPABLE_MODES = ("L", "P", "RGBA", "RGBX", "CMYK", "I", "F")
+
+# Bytes of pixels copied into a block at a time
+_COPY_BYTES = 4 * 1024 * 1024
+
+# Blocks released while images still mapped them, closed once those images are gone
+_LINGERING = []
+
+# Define function to close lingering blocks whose images have been collected
+def _closeLingering():
+    for block in list(_LINGERING):
+        try:
+            block.close()
+            _LINGERING.remove(block)
+        except BufferError:
+            pass
+
+# Define a handle to an image held in a shared memory block
+# Handles pickle as (name, size, mode, palette, transparency), so only a few bytes cross process boundaries
+class SharedImage:
+
+    # Define initializer
+    # palette is (palette mode, raw palette bytes) for palette images, and transparency is the image's info entry
+    def __init__(self,
+                 name: str,
+                 size: Tuple[int, int],
+                 mode: str,
+                 palette: Optional[Tuple[str, bytes]] = None,
+                 transparency: Optional[Any] = None):
+
+        # Set block name and image layout
+        self.name = name
+        self.size = size
+        self.mode = mode
+
+        # Set what the pixels alone do not describe
+        self.palette = palette
+        self.transparency = transparency
+
+        # The block is attached on first open
+        self._block: Optional[SharedMemory] = None
+
+    # Handles pickle without their attachment
+    def __getstate__(self):
+        return (self.name, self.size, self.mode, self.palette, self.transparency)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        return f"SharedImage(name={self.name!r}, size={self.size}, mode={self.mode!r})"
+
+    # Define function to copy an image into a new shared memory block
+    @classmethod
+    def create(cls, image: PILImage.Image):
+
+        # Size the block from one row of raw pixels, as every row packs to the same length
+        width, height = image.size
+        row_bytes = len(image.crop((0, 0, width, 1)).tobytes()) if height else 0
+        block = SharedMemory(create=True, size=max(row_bytes * height, 1))
+
+        # Copy the pixels in strips of rows, so only one strip is ever held twice
+        step = max(1, _COPY_BYTES // max(row_bytes, 1))
+        for top in range(0, height, step):
+            bottom = min(top + step, height)
+            block.buf[top * row_bytes:bottom * row_bytes] = image.crop((0, top, width, bottom)).tobytes()
+
+        # Palette images keep their colors with the handle
+        palette = (image.palette.mode, image.palette.tobytes()) if image.mode in ("P", "PA") and image.palette else None
+
+        # The reader unlinks the block, so the writer only drops its mapping
+        handle = cls(block.name, image.size, image.mode, palette, image.info.get("transparency"))
+        block.close()
+        return handle
+
+    # Define function to get the image, mapped onto the block without copying where the mode allows
+    # The image stays valid after release(), until it is collected
+    def open(self):
+
+        # Attach to the block
+        if self._block is None:
+            self._block = SharedMemory(name=self.name)
+
+        # Map the pixels, or copy modes PIL cannot map
+        if self.mode in _MAPPABLE_MODES:
+            image = PILImage.frombuffer(self.mode, self.size, self._block.buf, "raw", self.mode, 0, 1)
+        else:
+            image = PILImage.frombytes(self.mode, self.size, bytes(self._block.buf))
+
+        # Restore the colors and transparency
+        if self.palette is not None:
+            palette_mode, palette_data = self.palette
+            image.putpalette(palette_data, palette_mode)
+        if self.transparency is not None:
+            image.info["transparency"] = self.transparency
+        return image
+
+    # Define function to free the block; images from open() keep its memory until they are collected
+    def release(self):
+
+        # Attach if needed, so a never-opened block can still be freed
+        if self._block is None:
+            self._block = SharedMemory(name=self.name)
+
+        # Remove the name, then drop our mapping
+        # Images that still map the block keep the memory alive until they are collected
+        self._block.unlink()
+        try:
+            self._block.close()
+        except BufferError:
+            _LINGERING.append(self._block)
+        self._block = None
+
+        # Close blocks left by earlier releases
+        _closeLingering()
+
+    # Define context manager support: open on enter, release on exit
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+# Define function to make sure processes forked from here share one resource tracker
+# Otherwise each worker's own tracker would unlink its blocks when it exits, before they are read
+def share_resource_tracker():
+    resource_tracker.ensure_running()
@@ -0,0 +1,104 @@
+from PIL import Image as PILImage
+from typing import BinaryIO, Iterable, Optional, Tuple
+import numpy as np
+import struct
+import zlib
+
+# PNG color type and bit depth for each supported PIL mode
+_PNG_MODES = {
+    "1": (0, 1),
+    "L": (0, 8),
+    "P": (3, 8),
+    "RGB": (2, 8),
+    "RGBA": (6, 8),
+}
+
+# Define an incremental PNG writer that accepts the image as horizontal strips
+# Only one strip and the zlib window are held in memory at a time
+class PNGStripWriter:
+
+    # Define initializer, writing the PNG header
+    def __init__(self,
+                 stream: BinaryIO,
+                 size: Tuple[int, int],
+                 mode: str,
+                 palette: Optional[list] = None,
+                 compress_level: int = 6):
+
+        # Check the mode is supported
+        if mode not in _PNG_MODES:
+            raise ValueError(f"Unsupported PNG strip mode: {mode}")
+
+        # Set output and image properties
+        self.stream = stream
+        self.width, self.height = size
+        self.mode = mode
+        self.rows_written = 0
+
+        # Set compressor
+        self._compressor = zlib.compressobj(compress_level)
+
+        # Write signature and header
+        color_type, bit_depth = _PNG_MODES[mode]
+        self.stream.write(b"\x89PNG\r\n\x1a\n")
+        self._writeChunk(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, bit_depth, color_type, 0, 0, 0))
+
+        # Palette images carry their palette before any pixel data
+        if mode == "P":
+            self._writeChunk(b"PLTE", bytes(palette[:768]))
+
+    # Define function to write one PNG chunk
+    def _writeChunk(self, kind: bytes, data: bytes):
+        self.stream.write(struct.pack(">I", len(data)))
+        self.stream.write(kind + data)
+        self.stream.write(struct.pack(">I", zlib.crc32(kind + data)))
+
+    # Define function to append a strip below the rows written so far
+    def write(self, strip: PILImage.Image):
+
+        # Check the strip fits the image
+        if strip.mode != self.mode or strip.width != self.width:
+            raise ValueError("Strip mode and width must match the image")
+        if self.rows_written + strip.height > self.height:
+            raise ValueError("Strip runs past the bottom of the image")
+
+        # Get raw rows, packing 1-bit images to one bit per pixel
+        rows = np.asarray(strip)
+        if self.mode == "1":
+            rows = np.packbits(rows, axis=1)
+        rows = rows.reshape(strip.height, -1)
+
+        # Prefix every row with filter type 0 (none) and compress
+        filtered = np.zeros((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 1:] = rows
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._writeChunk(b"IDAT", data)
+
+        self.rows_written += strip.height
+
+    # Define function to finish the image
+    def close(self):
+
+        # Check every row has been written
+        if self.rows_written != self.height:
+            raise ValueError(f"Only {self.rows_written} of {self.height} rows were written")
+
+        # Flush compressed data and end the image
+        self._writeChunk(b"IDAT", self._compressor.flush())
+        self._writeChunk(b"IEND", b"")
+
+# Define function to stream a sequence of strips into a PNG
+def write_png_bands(stream: BinaryIO, size: Tuple[int, int], bands: Iterable[PILImage.Image], compress_level: int = 6):
+
+    # The writer is created from the first strip's mode and palette
+    writer = None
+    for band in bands:
+        if writer is None:
+            palette = band.getpalette() if band.mode == "P" else None
+            writer = PNGStripWriter(stream, size, band.mode, palette, compress_level)
+        writer.write(band)
+
+    # Finish the image
+    if writer is not None:
+        writer.close()
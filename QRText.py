@@ -1,8 +1,27 @@
-from .QREngine import QRCell, QRGenerator, QRRenderer, RenderSettings
+from .QREngine import CanvasPool, IndexedCanvas, QRCell, QRCellGrid, QRGenerator, QRRenderer, RenderCanvas, RenderSettings, protocol_method
+from .QRCache import LRUCache
+from .QRInstrument import count, stage
+from .QRVerify import check_render
 
 from dataclasses import dataclass
-from typing import Protocol, Tuple
-from PIL import ImageFont
+from typing import BinaryIO, Optional, Protocol, Sequence, Tuple
+from PIL import Image as PILImage, ImageDraw, ImageFont
+import numpy as np
+
+# Process-wide glyph tile cache, shared by renderers that opt into it
+GLYPH_CACHE = LRUCache(maxsize=4096)
+
+# Process-wide font caches
+# Measurements are keyed by (font_path, testChar), fonts by (font_path, px_per_cell, testChar)
+FONT_METRICS_CACHE = LRUCache(maxsize=64)
+FONT_CACHE = LRUCache(maxsize=64)
+
+# Define function to report font cache hit/miss counters
+def font_cache_stats():
+    return {
+        "metrics": FONT_METRICS_CACHE.stats(),
+        "fonts": FONT_CACHE.stats(),
+    }
 
 @dataclass
 class QRTextStyle:
@@ -16,6 +35,36 @@ class CellRenderingProtocol(Protocol):
     def __call__(self, cell: QRCell, qr: QRGenerator, style: QRTextStyle, renderSettings: RenderSettings) -> Tuple[str, Tuple[int, int, int]]:
         ...
 
+# Define interface for batched cell rendering
+# Receives the whole cell grid as columns and returns N characters and an (N, 3) color array, in cell order
+class BatchCellRenderingProtocol(Protocol):
+
+    def render_cells(self, cells: QRCellGrid, qr: QRGenerator, style: QRTextStyle, renderSettings: RenderSettings) -> Tuple[Sequence[str], np.ndarray]:
+        ...
+
+# Define adapter running a per-cell protocol through the batched interface
+class CellProtocolAdapter:
+
+    def __init__(self, protocol: CellRenderingProtocol):
+        self.protocol = protocol
+
+    # Call the protocol once per cell, collecting characters and colors
+    def render_cells(self, cells: QRCellGrid, qr: QRGenerator, style: QRTextStyle, renderSettings: RenderSettings):
+
+        results = [self.protocol(cell, qr, style, renderSettings) for cell in cells]
+        characters = [character for character, _ in results]
+        colors = np.array([color for _, color in results], dtype=np.uint8).reshape(-1, 3)
+        return (characters, colors)
+
+# Define function to get the batched form of a text protocol
+def batch_cell_protocol(protocol):
+
+    # Protocols with render_cells are already batched, unless a subclass overrode __call__ alone
+    if protocol_method(protocol, "render_cells") is not None:
+        return protocol
+
+    return CellProtocolAdapter(protocol)
+
 # Define QRTextBlockRenderer
 class QRTextBlockRenderer:
 
@@ -23,7 +72,8 @@ class QRTextBlockRenderer:
                  QR: QRGenerator, 
                  style: QRTextStyle,
                  renderSettings: RenderSettings,
-                 text_rendering_protocol: CellRenderingProtocol):
+                 text_rendering_protocol: CellRenderingProtocol,
+                 glyph_cache: Optional[LRUCache] = None):
 
         # Set QRData
         self.QR = QR
@@ -40,25 +90,29 @@ class QRTextBlockRenderer:
         # Get font
         self.font = self._getScaledFont()
 
+        # Set glyph tile cache (per-renderer unless a shared one is passed)
+        self.glyph_cache = glyph_cache if glyph_cache is not None else LRUCache(maxsize=1024)
+
         # Create a renderer
         self.__renderer = QRRenderer(self.QR, self.__renderSettings)
 
-        # Get the canvas
-        self.__canvas = self.__renderer.get_canvas()
-
         # Get cells
-        self.cells = self.__renderer.get_cells()
+        self.cells = self.__renderer.get_cell_grid()
 
     def _getScaledFont(self, testChar = "%"):
 
-        # Step 1: Load with arbitrary small size first to measure
-        base_font_size = 10
-        font = ImageFont.truetype(self.style.font_path, base_font_size)
+        # Fonts are shared between renderers with the same file, scale and test character
+        key = (self.style.font_path, self.__renderSettings.px_per_cell, testChar)
+        with stage(self.__renderSettings.instrument, "font"):
+            return FONT_CACHE.get_or_create(key, lambda: self._loadScaledFont(testChar))
 
-        # Step 2: Measure test character
-        bbox = font.getbbox(testChar)
-        char_width = bbox[2] - bbox[0]
-        char_height = bbox[3] - bbox[1]
+    def _loadScaledFont(self, testChar):
+
+        # Step 1 & 2: Load with arbitrary small size and measure test character
+        base_font_size = 10
+        char_width, char_height = FONT_METRICS_CACHE.get_or_create(
+            (self.style.font_path, testChar),
+            lambda: self._measureChar(testChar, base_font_size))
 
         # Step 3: Calculate scaling factor
         scale = self.__renderSettings.px_per_cell / max(char_width, char_height)
@@ -68,48 +122,200 @@ class QRTextBlockRenderer:
         font = ImageFont.truetype(self.style.font_path, final_font_size)
 
         return font
-    
-    def _getXYPos(self, currentCell: QRCell):
 
-        # Extract
-        x, y = currentCell.x, currentCell.y
-        dx, dy = currentCell.dx, currentCell.dy
-        cells_per_block, px_per_cell = self.__renderSettings.cells_per_block, self.__renderSettings.px_per_cell
+    def _measureChar(self, testChar, font_size):
 
-        # Calculate pixel coordinates
-        xpos = (x * cells_per_block + dx) * px_per_cell + (px_per_cell // 2)
-        ypos = (y * cells_per_block + dy) * px_per_cell + (px_per_cell // 2)
+        # Load the font and measure the test character
+        font = ImageFont.truetype(self.style.font_path, font_size)
+        bbox = font.getbbox(testChar)
+        char_width = bbox[2] - bbox[0]
+        char_height = bbox[3] - bbox[1]
 
-        return (xpos, ypos)
+        return (char_width, char_height)
     
+    # Define function to point the renderer at another QR code of the same size
+    # The font and glyph cache are kept; canvas_pool, if set, overrides the one in renderSettings
+    def _rebind(self, QR: QRGenerator, canvas_pool: Optional[CanvasPool] = None):
+        self.QR = QR
+        self.cells = self.__renderer.rebind(QR, canvas_pool)
+
     def render(self):
 
-        # Iterate through cells
-        for cell in self.cells:
+        with stage(self.__renderSettings.instrument, "draw"):
 
-            # Get a character
-            char, color = self._get_cell_func(cell, self.QR, self.style, self.__renderSettings)
+            # Get the canvas
+            canvas = self.__renderer.get_canvas()
 
-            # Call render cell
-            self._renderCell(cell, char, color)
+            # Draw every cell
+            self._renderCells(canvas, self._getCellGlyphs(), 0, canvas.image.height)
 
-        # Then, return the canvas (should contain rendered image)
-        return self.__canvas.image
-            
+        # Read the image back when asked, then return the canvas (should contain rendered image)
+        check_render(canvas.image, self.QR, self.__renderSettings)
+        return canvas.image
 
-    
-    def _renderCell(self, currentCell: QRCell, character: str, color: Tuple[int, int, int]):
+    # Define function for rendering the image as horizontal strips of band_height pixels
+    def render_bands(self, band_height: int):
 
-        # Get absolute x and y positions
-        xpos, ypos = self._getXYPos(currentCell)
+        # Get every cell's glyph and color once for all bands
+        glyphs = self._getCellGlyphs()
+
+        # Iterate through bands, drawing each onto its own strip canvas
+        for top, bottom in self.__renderer.get_bands(band_height):
+            with stage(self.__renderSettings.instrument, "draw"):
+                canvas = self.__renderer.get_canvas(bottom - top)
+                self._renderCells(canvas, glyphs, top, bottom)
+            yield canvas.image
+
+    # Define function for getting every cell's glyph and color in one batched protocol call
+    # Returns (glyphs, glyph index per cell, colors, color index per cell)
+    def _getCellGlyphs(self):
+
+        # Per-cell protocols are run through the batched interface by an adapter
+        protocol = batch_cell_protocol(self._get_cell_func)
+        with stage(self.__renderSettings.instrument, "protocol"):
+            characters, colors = protocol.render_cells(self.cells, self.QR, self.style, self.__renderSettings)
+
+        # Record one protocol result per cell
+        count(self.__renderSettings.instrument, "protocol." + type(self._get_cell_func).__name__, len(self.cells))
+
+        # Resolve each distinct character and color once
+        glyphs, glyph_index = self._resolveGlyphs(characters)
+        colors, color_index = np.unique(np.asarray(colors, dtype=np.uint8).reshape(-1, 3), axis=0, return_inverse=True)
+        colors = [tuple(color) for color in colors.tolist()]
+
+        return (glyphs, glyph_index, colors, color_index.reshape(-1))
+
+    # Define function for getting each distinct character's glyph, and every cell's glyph index
+    def _resolveGlyphs(self, characters: Sequence[str]):
+        characters, glyph_index = np.unique(np.asarray(characters, dtype=str), return_inverse=True)
+        glyphs = [self._getGlyph(character) for character in characters.tolist()]
+        return (glyphs, glyph_index.reshape(-1))
+
+    # Define function for rendering to a label map, where recoloring is a palette swap
+    # Needs a protocol with get_palette. Glyphs are drawn once as light and dark coverage, and each
+    # label is a mix of the background, light and dark colors; when antialiasing makes more than 256
+    # mixes, coverage is rounded to fewer levels
+    def render_indexed(self, background: Tuple[int, int, int] = (255, 255, 255)):
+
+        get_palette = protocol_method(self._get_cell_func, "get_palette")
+        if get_palette is None:
+            raise ValueError("Indexed rendering needs a protocol with get_palette")
+
+        # Characters come from the protocol; colors only depend on the cell value
+        protocol = batch_cell_protocol(self._get_cell_func)
+        with stage(self.__renderSettings.instrument, "protocol"):
+            characters, _ = protocol.render_cells(self.cells, self.QR, self.style, self.__renderSettings)
+        count(self.__renderSettings.instrument, "protocol." + type(self._get_cell_func).__name__, len(self.cells))
+
+        # Draw light glyphs into the red channel and dark ones into green, over black
+        with stage(self.__renderSettings.instrument, "draw"):
+            glyphs, glyph_index = self._resolveGlyphs(characters)
+            canvas = RenderCanvas(PILImage.new("RGB", self.__renderer.get_size(), (0, 0, 0)), None)
+            cellGlyphs = (glyphs, glyph_index, [(255, 0, 0), (0, 255, 0)], self.cells.value.astype(np.intp))
+            self._renderCells(canvas, cellGlyphs, 0, canvas.image.height)
+
+            # Label the distinct (light, dark) coverage pairs
+            coverage = np.asarray(canvas.image)
+            pairs = (coverage[..., 0].astype(np.intp) << 8) | coverage[..., 1]
+            labels, mixes = _coverageLabels(pairs)
+
+        light_color, dark_color = get_palette()
+        return IndexedCanvas(labels, mixes, {"background": background, "light_color": light_color, "dark_color": dark_color})
+
+    # Define function for drawing every glyph that reaches pixel rows top to bottom
+    def _renderCells(self, canvas: RenderCanvas, cellGlyphs: tuple, top: int, bottom: int):
+
+        # Glyphs can overhang their cell by up to the font's full line height
+        ascent, descent = self.font.getmetrics()
+        margin = ascent + descent
+
+        # Get the range of cell rows whose glyphs can reach the band
+        cells_per_block, px_per_cell = self.__renderSettings.cells_per_block, self.__renderSettings.px_per_cell
+        first_row = max(0, (top - margin) // px_per_cell)
+        last_row = (bottom + margin) // px_per_cell + 1
+
+        # Get the cells in the module rows covering that range, then skip cells outside it
+        cells_per_module_row = self.QR.width * cells_per_block * cells_per_block
+        start = first_row // cells_per_block * cells_per_module_row
+        stop = -(-last_row // cells_per_block) * cells_per_module_row
+        rows = self.cells.y[start:stop] * cells_per_block + self.cells.dy[start:stop]
+        index = np.flatnonzero((rows >= first_row) & (rows < last_row))
+
+        # Get every cell's centre, shifted up to the canvas' first row
+        columns = self.cells.x[start:stop][index] * cells_per_block + self.cells.dx[start:stop][index]
+        xpos = columns * px_per_cell + px_per_cell // 2
+        ypos = rows[index] * px_per_cell + px_per_cell // 2 - top
+
+        # Paste each glyph in cell order, filling its footprint with the color
+        glyphs, glyph_index, colors, color_index = cellGlyphs
+        index += start
+        for x, y, glyph, color in zip(xpos.tolist(), ypos.tolist(), glyph_index[index].tolist(), color_index[index].tolist()):
+
+            # Skip glyphs with no ink
+            mask, (left, offset_top) = glyphs[glyph]
+            if mask is None:
+                continue
+
+            box = (x + left, y + offset_top, x + left + mask.width, y + offset_top + mask.height)
+            canvas.image.paste(colors[color], box, mask)
+
+    # Define function for rendering straight into a file-like object
+    # band_height streams the PNG in strips, so only one strip is held in memory
+    def render_to(self,
+                  stream: BinaryIO,
+                  format: str = "PNG",
+                  compress_level: int = 6,
+                  band_height: Optional[int] = None):
+        self.__renderer.render_to(stream, self.render, self.render_bands, format, compress_level, band_height)
+
+    # Define function to get a glyph tile from the cache
+    def _getGlyph(self, character: str):
+
+        # Color is applied when pasting, so it is not part of the key
+        key = (self.style.font_path, self.font.size, character)
+        return self.glyph_cache.get_or_create(key, lambda: self._rasterizeGlyph(character))
+
+    # Define function to rasterize a glyph into an "L" coverage mask
+    def _rasterizeGlyph(self, character: str):
+
+        # Measure the glyph relative to its middle anchor
+        left, top, right, bottom = self.font.getbbox(character, anchor="mm")
+        if right <= left or bottom <= top:
+            return (None, (0, 0))
+
+        # Draw it once at full coverage
+        mask = PILImage.new("L", (right - left, bottom - top), 0)
+        ImageDraw.Draw(mask).text((-left, -top), character, font=self.font, fill=255, anchor="mm")
+
+        # Return the mask and its offset from the cell centre
+        return (mask, (left, top))
+
+# Define function to turn (light << 8 | dark) coverage pairs into at most 256 labels
+# Returns the labels and each label's (background, light, dark) weights
+def _coverageLabels(pairs: np.ndarray):
+
+    # Work on the distinct pairs only
+    present = np.flatnonzero(np.bincount(pairs.ravel(), minlength=1 << 16))
+    light, dark = present >> 8, present & 0xFF
+
+    # Keep full coverage resolution when it fits, otherwise round to fewer levels until it does
+    # 16 levels always fit, as 16 x 16 pairs
+    for steps in (255, 127, 63, 31, 15):
+        keys = np.rint(light * steps / 255).astype(np.intp) << 8 | np.rint(dark * steps / 255).astype(np.intp)
+        keys, label = np.unique(keys, return_inverse=True)
+        if len(keys) <= 256:
+            break
+
+    # Map every pixel through a table of the distinct pairs' labels
+    lookup = np.zeros(1 << 16, dtype=np.uint8)
+    lookup[present] = label.reshape(-1)
+    labels = lookup[pairs]
+
+    # Weights of each label, with the background taking the rest
+    light, dark = (keys >> 8) / steps, (keys & 0xFF) / steps
+    mixes = np.column_stack((np.clip(1 - light - dark, 0, 1), light, dark))
+    return labels, mixes
 
-        self.__canvas.draw.text(
-            (xpos, ypos), 
-            character, 
-            font=self.font, 
-            fill=color, 
-            anchor="mm")
-        
 # Define some Cell Rendering Protocols
 class RepeatingTextStrategy(CellRenderingProtocol):
 
@@ -131,15 +337,16 @@ class RepeatingTextStrategy(CellRenderingProtocol):
         self._offset = offset
         self._shift = shift
 
-    def __call__(self, cell: QRCell, qr: QRGenerator, style: QRTextStyle, renderSettings: RenderSettings) -> Tuple[str, Tuple[int, int, int]]:
+    # Define function for getting a cell's absolute column, row and row-major index
+    def _getAbsolutePositions(self, cell: QRCell, qr: QRGenerator, renderSettings: RenderSettings):
+        absolute_x = cell.x * renderSettings.cells_per_block + cell.dx
+        absolute_y = cell.y * renderSettings.cells_per_block + cell.dy
+        total_rendered_cells_per_row = qr.width * renderSettings.cells_per_block
+        absolute_index = (absolute_y * total_rendered_cells_per_row + absolute_x)
 
-        def _getAbsolutePositions(cell: QRCell, style):
-            absolute_x = cell.x * renderSettings.cells_per_block + cell.dx
-            absolute_y = cell.y * renderSettings.cells_per_block + cell.dy
-            total_rendered_cells_per_row = qr.width * renderSettings.cells_per_block
-            absolute_index = (absolute_y * total_rendered_cells_per_row + absolute_x)
+        return absolute_x, absolute_y, absolute_index
 
-            return absolute_x, absolute_y, absolute_index
+    def __call__(self, cell: QRCell, qr: QRGenerator, style: QRTextStyle, renderSettings: RenderSettings) -> Tuple[str, Tuple[int, int, int]]:
 
         # If cell is true, 
         if cell.value:
@@ -147,7 +354,7 @@ class RepeatingTextStrategy(CellRenderingProtocol):
         else:
             color = self._light_color
         
-        abs_x, abs_y, abs_index = _getAbsolutePositions(cell, style)
+        abs_x, abs_y, abs_index = self._getAbsolutePositions(cell, qr, renderSettings)
         shift = self._shift * abs_y
 
         if self._overwrap:
@@ -155,4 +362,29 @@ class RepeatingTextStrategy(CellRenderingProtocol):
         else:
             character = self._string[(abs_x + self._offset + shift) % len(self._string)]
 
-        return (character, color)
\ No newline at end of file
+        return (character, color)
+
+    # Define batched action, computing every cell's character index with one modular expression
+    # Subclasses that override __call__ are called per cell unless they override this too
+    def render_cells(self, cells: QRCellGrid, qr: QRGenerator, style: QRTextStyle, renderSettings: RenderSettings):
+
+        # Get absolute positions for every cell
+        abs_x = cells.x.astype(np.int64) * renderSettings.cells_per_block + cells.dx
+        abs_y = cells.y.astype(np.int64) * renderSettings.cells_per_block + cells.dy
+
+        # Index into the string, row-major when overwrapping
+        position = abs_y * (qr.width * renderSettings.cells_per_block) + abs_x if self._overwrap else abs_x
+        position = (position + self._offset + self._shift * abs_y) % len(self._string)
+        characters = np.array(list(self._string))[position]
+
+        # Select colors by cell value
+        colors = np.where(cells.value[:, None],
+                          np.array(self._dark_color, dtype=np.uint8),
+                          np.array(self._light_color, dtype=np.uint8))
+
+        return (characters, colors)
+
+    # Define function for getting the (light, dark) colors, as colors only depend on cell.value
+    # Subclasses that override __call__ have no palette unless they override this too
+    def get_palette(self):
+        return (self._light_color, self._dark_color)
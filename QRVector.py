@@ -0,0 +1,169 @@
+from .QREngine import CanvasPool, QRGenerator, RenderSettings, QRRenderer, protocol_method
+from .QRBlock import BlockRenderingProtocol, SimpleBlockProtocol, batch_block_protocol
+from typing import BinaryIO, Optional, Tuple
+import numpy as np
+import zlib
+
+# Define function to merge the set cells of a mask into rectangles
+# Horizontal runs are found per row, then identical runs in consecutive rows are joined
+def merge_rects(mask: np.ndarray):
+
+    # Rectangles are stored as [x, y, width, height]
+    rects = []
+    open_runs = {}
+
+    # Iterate through rows of the mask
+    for y, row in enumerate(mask):
+
+        # Find where runs of set cells start and stop
+        padded = np.concatenate(([0], row.astype(np.int8), [0]))
+        edges = np.flatnonzero(np.diff(padded)).tolist()
+
+        # Extend a rectangle from the row above, or start a new one
+        next_runs = {}
+        for run in zip(edges[::2], edges[1::2]):
+            rect = open_runs.pop(run, None)
+            if rect is None:
+                rect = [run[0], y, run[1] - run[0], 0]
+                rects.append(rect)
+            rect[3] += 1
+            next_runs[run] = rect
+
+        # Runs that did not continue are closed
+        open_runs = next_runs
+
+    # Return rectangles
+    return rects
+
+# Define function to format an RGB color for SVG
+def _hexColor(color: Tuple[int, int, int]):
+    return "#%02x%02x%02x" % tuple(color)
+
+# Define QRVectorRenderer
+# Emits the same geometry as QRBlockRenderer as SVG or PDF, with merged rectangles
+class QRVectorRenderer:
+    def __init__(self,
+                 QR: QRGenerator,
+                 renderSettings: RenderSettings,
+                 block_rendering_protocol: Optional[BlockRenderingProtocol] = None):
+
+        # Set QRData
+        self.QR = QR
+
+        # Set render settings
+        self.__renderSettings = renderSettings
+
+        # Create a base renderer
+        self.__renderer = QRRenderer(self.QR, renderSettings)
+
+        # Get the cells
+        self.cells = self.__renderer.get_cell_grid()
+
+        # Set get cell function
+        self.protocol = block_rendering_protocol if block_rendering_protocol else SimpleBlockProtocol()
+
+    # Define function to point the renderer at another QR code of the same size
+    # Vector output draws no canvas, so canvas_pool is only passed on to the base renderer
+    def _rebind(self, QR: QRGenerator, canvas_pool: Optional[CanvasPool] = None):
+        self.QR = QR
+        self.cells = self.__renderer.rebind(QR, canvas_pool)
+
+    # Define function for splitting the code into a background and colored layers
+    # Returns (background, [(color, mask)], (grid height, grid width), unit size in pixels)
+    def _getLayers(self):
+
+        # Two-color protocols are drawn per module
+        get_palette = protocol_method(self.protocol, "get_palette")
+        if get_palette is not None:
+            light_color, dark_color = get_palette()
+            unit = self.__renderSettings.cells_per_block * self.__renderSettings.px_per_cell
+            return (tuple(light_color), [(tuple(dark_color), self.QR.QRMatrix)], self.QR.QRMatrix.shape, unit)
+
+        # Otherwise collect every cell's color in one batched call, drawn per cell
+        protocol = batch_block_protocol(self.protocol)
+        rgb = self.cells.to_grid(protocol.render_cells(self.cells, self.QR, self.__renderSettings)).astype(np.uint32)
+        colors = (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+        # The most common color becomes the background
+        values, counts = np.unique(colors, return_counts=True)
+        order = np.argsort(-counts, kind="stable")
+        unpack = lambda value: (value >> 16 & 255, value >> 8 & 255, value & 255)
+        layers = [(unpack(int(values[i])), colors == values[i]) for i in order[1:]]
+        return (unpack(int(values[order[0]])), layers, colors.shape, self.__renderSettings.px_per_cell)
+
+    # Define function for rendering SVG markup
+    def render(self):
+
+        # Get layers
+        background, layers, (grid_height, grid_width), unit = self._getLayers()
+
+        # Grid units map to pixels through the viewBox
+        parts = [
+            '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '
+            f'width="{grid_width * unit}" height="{grid_height * unit}" '
+            f'viewBox="0 0 {grid_width} {grid_height}" shape-rendering="crispEdges">',
+            f'<rect width="{grid_width}" height="{grid_height}" fill="{_hexColor(background)}"/>',
+        ]
+
+        # Draw each color layer as one path of merged rectangles
+        for color, mask in layers:
+            path = "".join(f"M{x} {y}h{w}v{h}h-{w}z" for x, y, w, h in merge_rects(mask))
+            parts.append(f'<path fill="{_hexColor(color)}" d="{path}"/>')
+
+        # Return markup
+        parts.append("</svg>")
+        return "".join(parts)
+
+    # Define function for rendering a single-page PDF
+    def render_pdf(self, compress_level: int = 6):
+
+        # Get layers
+        background, layers, (grid_height, grid_width), unit = self._getLayers()
+        page_width, page_height = grid_width * unit, grid_height * unit
+
+        # Flip to a top-left origin and scale grid units to points
+        ops = [f"{unit} 0 0 -{unit} 0 {page_height} cm"]
+
+        # Fill the background, then each color layer
+        ops.append("%.4f %.4f %.4f rg 0 0 %d %d re f" % (*(c / 255 for c in background), grid_width, grid_height))
+        for color, mask in layers:
+            ops.append("%.4f %.4f %.4f rg" % tuple(c / 255 for c in color))
+            ops.extend(f"{x} {y} {w} {h} re" for x, y, w, h in merge_rects(mask))
+            ops.append("f")
+
+        # Compress the content stream
+        content = zlib.compress("\n".join(ops).encode("ascii"), compress_level)
+
+        # Write objects, recording their byte offsets for the xref table
+        objects = [
+            b"<< /Type /Catalog /Pages 2 0 R >>",
+            b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width} {page_height}] "
+            f"/Resources << >> /Contents 4 0 R >>".encode("ascii"),
+            f"<< /Length {len(content)} /Filter /FlateDecode >>\nstream\n".encode("ascii") + content + b"\nendstream",
+        ]
+        pdf = bytearray(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(len(pdf))
+            pdf += f"{number} 0 obj\n".encode("ascii") + body + b"\nendobj\n"
+
+        # Write the xref table and trailer
+        xref = len(pdf)
+        pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("ascii")
+        pdf += b"".join(f"{offset:010d} 00000 n \n".encode("ascii") for offset in offsets)
+        pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("ascii")
+
+        # Return the document
+        return bytes(pdf)
+
+    # Define function for rendering straight into a file-like object
+    def render_to(self, stream: BinaryIO, format: str = "SVG", compress_level: int = 6):
+
+        # Encode into the stream
+        if format.upper() == "PDF":
+            stream.write(self.render_pdf(compress_level))
+        elif format.upper() == "SVG":
+            stream.write(self.render().encode("utf-8"))
+        else:
+            raise ValueError(f"Unsupported vector format: {format}")
@@ -0,0 +1,153 @@
+from dataclasses import dataclass
+from typing import Optional
+from PIL import Image as PILImage
+import numpy as np
+
+from .QREngine import QRGenerator, RenderSettings
+from .QRInstrument import count, stage
+
+# Define the result of reading a rendered code back
+@dataclass
+class VerifyReport:
+
+    # (row, column) of every module read as the wrong color, in QRMatrix coordinates
+    mismatches: np.ndarray
+
+    # Mean luminance (0-255) sampled for every module
+    levels: np.ndarray
+
+    # Luminance threshold the modules were read with, chosen from the levels alone
+    threshold: float
+
+    # Lightest dark module to darkest light module, as a fraction of full scale
+    # Negative when no single threshold separates them
+    contrast_margin: float
+
+    # Mean luminance of the dark and light modules
+    dark_level: float
+    light_level: float
+
+    @property
+    def mismatch_count(self):
+        return len(self.mismatches)
+
+    # Define function to check the read-back against a minimum contrast margin
+    def passed(self, min_contrast: float = 0.0):
+        return self.mismatch_count == 0 and self.contrast_margin >= min_contrast
+
+# Define error raised when a render does not read back as its QR code
+class VerificationError(ValueError):
+
+    def __init__(self, report: VerifyReport, min_contrast: float):
+        self.report = report
+        super().__init__(f"Rendered code does not verify: {report.mismatch_count} mismatched modules, "
+                         f"contrast margin {report.contrast_margin:.3f} (minimum {min_contrast:.3f})")
+
+# Define function to choose the threshold that best splits levels into two classes (Otsu's method)
+def _threshold(levels: np.ndarray):
+
+    # Count levels per whole luminance bin
+    histogram = np.bincount(np.clip(levels, 0, 255).astype(np.intp).ravel(), minlength=256).astype(np.float64)
+    weight = np.cumsum(histogram)
+    total = np.cumsum(histogram * np.arange(256))
+
+    # Between-class variance for a split after every bin, where both classes are non-empty
+    below, above = weight[:-1], weight[-1] - weight[:-1]
+    valid = (below > 0) & (above > 0)
+    if not valid.any():
+        return 128.0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = np.where(valid, below * above * (total[:-1] / below - (total[-1] - total[:-1]) / above) ** 2, -1)
+
+    # Splits across an empty gap score the same, so take the middle of the best ones
+    best = np.flatnonzero(np.isclose(variance, variance.max()))
+    split = (best[0] + best[-1]) / 2
+
+    # Levels below the end of the split bin read as dark
+    return float(split + 1)
+
+# Define function to get the luminance (0-255) of an image, as if over white where transparent
+def _luminance(image: PILImage.Image):
+
+    # Blend over white only when some pixels are transparent
+    if "A" in image.getbands() or "transparency" in image.info or (image.mode == "P" and "A" in image.palette.mode):
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        if image.getchannel("A").getextrema()[0] < 255:
+            image = PILImage.alpha_composite(PILImage.new("RGBA", image.size, "white"), image)
+
+    return np.asarray(image if image.mode == "L" else image.convert("L"))
+
+# Define function to read a rendered image back and compare it with the code's modules
+# Samples a grid over the middle of every cell, averages it per module and thresholds the result
+# without using the expected matrix; transparent pixels count as if over white
+# The grid is samples x samples at most, with one sample per side for every 3 pixels of cell, so
+# cells under 3 pixels are read at their centre only
+def verify_image(image: PILImage.Image,
+                 QR: QRGenerator,
+                 renderSettings: RenderSettings,
+                 samples: int = 3):
+
+    # Limit the sample grid to what the cells can hold
+    cells_per_block = renderSettings.cells_per_block
+    rows, columns = QR.height * cells_per_block, QR.width * cells_per_block
+    cell_width, cell_height = image.width / columns, image.height / rows
+    samples = max(1, min(samples, int(min(cell_width, cell_height)) // 3))
+
+    # Split every cell into 2 * samples - 1 points per side and read the middle samples of them
+    # Each nearest-neighbour affine transform picks one point from every cell, so only sampled pixels are read;
+    # the points are stacked into one sheet, so luminance is taken once
+    grid = 2 * samples - 1
+    offsets = [((i + 0.5) / grid - 0.5) for i in range(samples // 2, samples // 2 + samples)]
+    points = [image.transform((columns, rows), PILImage.Transform.AFFINE,
+                              (cell_width, 0, x * cell_width, 0, cell_height, y * cell_height), PILImage.NEAREST)
+              for y in offsets for x in offsets]
+    if len(points) == 1:
+        sheet = points[0]
+    else:
+        sheet = PILImage.new(image.mode, (columns, rows * len(points)))
+        if image.mode == "P":
+            sheet.putpalette(image.getpalette(image.palette.mode), image.palette.mode)
+            sheet.info = dict(image.info)
+        for index, plane in enumerate(points):
+            sheet.paste(plane, (0, rows * index))
+    luminance = _luminance(sheet).reshape(len(points), rows * columns).sum(axis=0, dtype=np.uint32)
+
+    # Average the samples of every module, adding its cells as strided views (much cheaper than summing over axes)
+    cells = luminance.reshape(QR.height, cells_per_block, QR.width, cells_per_block)
+    levels = sum(cells[:, y, :, x] for y in range(cells_per_block) for x in range(cells_per_block))
+    levels = levels / (len(points) * cells_per_block ** 2)
+
+    # Read the modules and compare with the code
+    threshold = _threshold(levels)
+    expected = QR.QRMatrix
+    mismatches = np.argwhere((levels < threshold) != expected)
+
+    # Measure the worst-case separation between the two colors
+    # Dark levels are lifted above the light range, so one max and one min find both extremes without masking
+    lifted = levels + expected * 256.0
+    dark_count = np.count_nonzero(expected)
+    dark_total = float(np.dot(expected.ravel(), levels.ravel()))
+    return VerifyReport(
+        mismatches=mismatches,
+        levels=levels,
+        threshold=threshold,
+        contrast_margin=float((lifted.min() - (lifted.max() - 256)) / 255),
+        dark_level=dark_total / dark_count,
+        light_level=(float(levels.sum()) - dark_total) / (levels.size - dark_count),
+    )
+
+# Define function to verify a render when renderSettings asks for it
+# Raises VerificationError when the image does not read back, and otherwise returns the report (or None when off)
+def check_render(image: PILImage.Image, QR: QRGenerator, renderSettings: RenderSettings) -> Optional[VerifyReport]:
+
+    if not renderSettings.verify:
+        return None
+
+    with stage(renderSettings.instrument, "verify"):
+        report = verify_image(image, QR, renderSettings)
+    count(renderSettings.instrument, "verify.mismatches", report.mismatch_count)
+
+    if not report.passed(renderSettings.min_contrast):
+        raise VerificationError(report, renderSettings.min_contrast)
+    return report
@@ -0,0 +1,3 @@
+from .QRCli import main
+
+main()
@@ -0,0 +1,12 @@
+import importlib.util
+import os
+import sys
+
+# The repository root is the customQR package, so load it under that name when it is not installed
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if "customQR" not in sys.modules:
+    spec = importlib.util.spec_from_file_location("customQR", os.path.join(ROOT, "__init__.py"),
+                                                  submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["customQR"] = module
+    spec.loader.exec_module(module)
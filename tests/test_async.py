@@ -0,0 +1,116 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+from customQR.QRAsync import RenderService, ServiceOverloaded
+from customQR.QRBatch import RenderSpec
+from customQR.QREngine import RenderSettings
+
+# Renders wait on this gate, so tests decide when they finish
+_GATE = threading.Event()
+
+# Define protocol that waits for the gate, then colors cells black on white
+class _GatedProtocol:
+    def render_cells(self, cells, qr, renderSettings):
+        _GATE.wait(10)
+        return np.where(np.asarray(cells.value)[:, None], 0, 255).repeat(3, axis=1)
+
+# Define protocol whose state cannot be fingerprinted
+class _SlotsProtocol(_GatedProtocol):
+    __slots__ = ("color",)
+
+@pytest.fixture(autouse=True)
+def gate():
+    _GATE.clear()
+    yield _GATE
+    _GATE.set()
+
+def _spec(protocol=None):
+    return RenderSpec(renderSettings=RenderSettings(px_per_cell=2), protocol=protocol or _GatedProtocol(), output_format="PNG")
+
+# Define function to let started tasks run until they block
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0.01)
+
+def test_equal_specs_share_one_render(gate):
+    async def main():
+        async with RenderService(max_concurrency=2) as service:
+            tasks = [asyncio.create_task(service.render("payload", _spec())) for _ in range(3)]
+            await _settle()
+            gate.set()
+            results = await asyncio.gather(*tasks)
+            return results, service.stats()
+
+    results, stats = asyncio.run(main())
+    assert results[0] == results[1] == results[2]
+    assert (stats["renders"], stats["coalesced"], stats["in_flight"]) == (1, 2, 0)
+
+def test_unfingerprintable_specs_only_share_the_same_object(gate):
+    async def main():
+        async with RenderService(max_concurrency=3) as service:
+            shared = _spec(_SlotsProtocol())
+            tasks = [asyncio.create_task(service.render("payload", spec))
+                     for spec in (shared, shared, _spec(_SlotsProtocol()))]
+            await _settle()
+            gate.set()
+            await asyncio.gather(*tasks)
+            return service.stats()
+
+    stats = asyncio.run(main())
+    assert (stats["renders"], stats["coalesced"]) == (2, 1)
+
+def test_self_referencing_specs_fall_back_to_identity():
+    protocol = _GatedProtocol()
+    protocol.parent = protocol
+    spec = _spec(protocol)
+    assert RenderService._requestKey("payload", spec) == ("payload", id(spec))
+
+def test_cancelling_one_waiter_keeps_the_shared_render(gate):
+    async def main():
+        async with RenderService(max_concurrency=1) as service:
+            spec = _spec()
+            first, second = (asyncio.create_task(service.render("payload", spec)) for _ in range(2))
+            await _settle()
+            first.cancel()
+            await _settle()
+            gate.set()
+            return await second, first.cancelled(), service.stats()
+
+    result, cancelled, stats = asyncio.run(main())
+    assert result.startswith(b"\x89PNG") and cancelled
+    assert (stats["renders"], stats["cancelled"]) == (1, 0)
+
+def test_cancelling_every_waiter_drops_a_queued_render(gate):
+    async def main():
+        async with RenderService(max_concurrency=1) as service:
+            running = asyncio.create_task(service.render("running", _spec()))
+            queued = asyncio.create_task(service.render("queued", _spec()))
+            await _settle()
+            assert service.stats()["waiting"] == 1
+
+            queued.cancel()
+            await _settle()
+            gate.set()
+            await running
+            return service.stats()
+
+    stats = asyncio.run(main())
+    assert (stats["renders"], stats["cancelled"], stats["running"], stats["in_flight"]) == (1, 1, 0, 0)
+
+def test_full_queue_rejects_new_renders(gate):
+    async def main():
+        async with RenderService(max_concurrency=1, max_queue=1) as service:
+            running = asyncio.create_task(service.render("running", _spec()))
+            queued = asyncio.create_task(service.render("queued", _spec()))
+            await _settle()
+            with pytest.raises(ServiceOverloaded):
+                await service.render("rejected", _spec())
+            gate.set()
+            await asyncio.gather(running, queued)
+            return service.stats()
+
+    stats = asyncio.run(main())
+    assert (stats["renders"], stats["rejected"]) == (2, 1)
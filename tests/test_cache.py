@@ -0,0 +1,130 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from customQR.QRBatch import RenderSpec
+from customQR.QRCache import OutputCache, fingerprint_digest
+from customQR.QREngine import RenderSettings
+
+# Define function to build a block protocol drawing dark modules in one captured color
+def _colorProtocol(color):
+    def protocol(cell, qr, renderSettings):
+        return color if cell.value else (255, 255, 255)
+    return protocol
+
+# Define block protocol taking its dark color as an argument, for partials
+def _argumentProtocol(cell, qr, renderSettings, color=(0, 0, 0)):
+    return color if cell.value else (255, 255, 255)
+
+# Define protocol object keeping a NumPy scalar attribute
+class _ScalarProtocol:
+    def __init__(self, level):
+        self.level = np.int64(level)
+
+    def __call__(self, cell, qr, renderSettings):
+        level = int(self.level)
+        return (level, level, level) if cell.value else (255, 255, 255)
+
+# Define protocol object keeping its state in slots, which cannot be fingerprinted
+class _SlotsProtocol:
+    __slots__ = ("color",)
+
+    def __init__(self, color):
+        self.color = color
+
+    def __call__(self, cell, qr, renderSettings):
+        return self.color if cell.value else (255, 255, 255)
+
+# Define function to get the darkest color in an encoded render
+def _darkest(data: bytes):
+    pixels = np.asarray(Image.open(BytesIO(data)).convert("RGB")).reshape(-1, 3)
+    return tuple(int(channel) for channel in pixels[pixels.sum(axis=1).argmin()])
+
+def _spec(protocol, **settings):
+    return RenderSpec(renderSettings=RenderSettings(px_per_cell=2, **settings), protocol=protocol, output_format="PNG")
+
+def test_closures_differing_in_captured_values_get_different_keys(tmp_path):
+    red, blue = _spec(_colorProtocol((255, 0, 0))), _spec(_colorProtocol((0, 0, 255)))
+    assert red.cache_key("payload") != blue.cache_key("payload")
+    assert red.etag("payload") != blue.etag("payload")
+
+    # A shared cache serves each spec its own output
+    cache = OutputCache(directory=str(tmp_path))
+    red.output_cache = blue.output_cache = cache
+    assert _darkest(red.render("payload")) == (255, 0, 0)
+    assert _darkest(blue.render("payload")) == (0, 0, 255)
+
+def test_partials_and_defaults_are_part_of_the_key():
+    red = _spec(partial(_argumentProtocol, color=(255, 0, 0)))
+    blue = _spec(partial(_argumentProtocol, color=(0, 0, 255)))
+    assert red.cache_key("payload") != blue.cache_key("payload")
+
+    def first(cell, qr, renderSettings, color=(255, 0, 0)):
+        return color
+    def second(cell, qr, renderSettings, color=(0, 0, 255)):
+        return color
+    assert fingerprint_digest(first) != fingerprint_digest(second)
+
+def test_numpy_scalars_are_fingerprinted_as_python_values():
+    spec = _spec(_ScalarProtocol(40))
+    spec.output_cache = OutputCache()
+    assert _darkest(spec.render("payload")) == (40, 40, 40)
+    assert spec.cache_key("payload") != _spec(_ScalarProtocol(41)).cache_key("payload")
+
+def test_verification_settings_are_part_of_the_key():
+    assert _spec(None).cache_key("payload") != _spec(None, verify=True).cache_key("payload")
+    assert _spec(None, verify=True).cache_key("payload") != _spec(None, verify=True, min_contrast=0.5).cache_key("payload")
+
+def test_unfingerprintable_specs_render_without_the_cache():
+    slotted = _SlotsProtocol((255, 0, 0))
+    with pytest.raises(TypeError):
+        _spec(slotted).cache_key("payload")
+
+    spec = _spec(slotted)
+    spec.output_cache = cache = OutputCache()
+    assert _darkest(spec.render("payload")) == (255, 0, 0)
+    assert cache.stats()["memory_size"] == 0
+
+def test_self_referencing_objects_raise_type_error():
+    class Node:
+        pass
+    node = Node()
+    node.next = node
+    with pytest.raises(TypeError):
+        fingerprint_digest(node)
+
+# Define worker filling a shared cache directory with random outputs
+def _fillCache(cache: OutputCache, worker: int):
+    for i in range(150):
+        cache.put(hashlib.sha256(f"{worker}-{i}".encode()).hexdigest(), os.urandom(5000))
+
+# Define function to measure the outputs in a cache directory
+def _directoryBytes(directory):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(directory) for name in names if not name.startswith("."))
+
+def test_disk_cap_holds_across_processes(tmp_path):
+    cache = OutputCache(directory=str(tmp_path), max_disk_bytes=200_000)
+    with ProcessPoolExecutor(max_workers=3) as executor:
+        list(executor.map(_fillCache, [cache] * 3, range(3)))
+
+    assert _directoryBytes(tmp_path) <= 200_000
+    assert cache.disk_bytes == _directoryBytes(tmp_path)
+    assert cache.stats()["disk_bytes"] == _directoryBytes(tmp_path)
+
+def test_disk_tier_survives_a_new_process_and_clears(tmp_path):
+    key = hashlib.sha256(b"key").hexdigest()
+    OutputCache(directory=str(tmp_path)).put(key, b"output")
+
+    cache = OutputCache(directory=str(tmp_path))
+    assert cache.get(key) == b"output"
+    assert cache.stats()["disk_hits"] == 1
+
+    cache.clear()
+    assert _directoryBytes(tmp_path) == 0 and cache.disk_bytes == 0
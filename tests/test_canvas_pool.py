@@ -0,0 +1,100 @@
+import pickle
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from customQR.QRBatch import RenderSpec
+from customQR.QRBlock import QRBlockRenderer
+from customQR.QREngine import CanvasPool, QRGenerator, RenderSettings
+from customQR.QRText import QRTextBlockRenderer, QRTextStyle
+
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+# Define text protocol drawing dark modules as #
+def _textProtocol(cell, qr, style, renderSettings):
+    return ("#", (0, 0, 0)) if cell.value else (".", (200, 200, 200))
+
+# Define block protocol coloring each cell, which draws on pixel buffers; two-color protocols build 1-bit images
+def _blockProtocol(cell, qr, renderSettings):
+    return (0, 0, 128) if cell.value else (255, 255, 255)
+
+# Define function to build a renderer of one type drawing on a pool
+def _renderer(kind: str, QR: QRGenerator, pool: CanvasPool):
+    renderSettings = RenderSettings(px_per_cell=8, cells_per_block=1, canvas_pool=pool)
+    if kind == "text":
+        return QRTextBlockRenderer(QR, QRTextStyle(FONT_PATH), renderSettings, _textProtocol)
+    return QRBlockRenderer(QR, renderSettings, _blockProtocol)
+
+def test_released_buffers_are_reused_and_cleared():
+    pool = CanvasPool()
+    canvas = pool.acquire_canvas((20, 10))
+    canvas.draw.rectangle((0, 0, 19, 9), fill="black")
+    pool.release(canvas)
+
+    # The same canvas comes back, cleared to the requested color
+    again = pool.acquire_canvas((20, 10), color="red")
+    assert again is canvas
+    assert again.image.getcolors() == [(200, (255, 0, 0, 255))]
+
+    # Pixel buffers are keyed by shape
+    pixels = pool.acquire_pixels((4, 5, 3))
+    pool.release(pixels)
+    assert pool.acquire_pixels((4, 5, 3)) is pixels
+    assert pool.acquire_pixels((5, 4, 3)) is not pixels
+    assert (pool.stats()["hits"], pool.stats()["misses"]) == (2, 3)
+
+def test_budget_drops_least_recently_returned():
+    pool = CanvasPool(max_bytes=250)
+    first, second, third = (np.zeros(100, dtype=np.uint8) for _ in range(3))
+    for buffer in (first, second, third):
+        pool.release(buffer)
+
+    # Only the two most recent fit; a buffer is never kept twice, and one over budget is never kept
+    assert pool.stats()["retained_bytes"] == 200 and pool.stats()["discarded"] == 1
+    pool.release(third)
+    pool.release(np.zeros(300, dtype=np.uint8))
+    assert pool.stats()["free_buffers"] == 2 and pool.stats()["discarded"] == 2
+    assert pool.acquire_pixels((100,)) is third
+    assert pool.acquire_pixels((100,)) is second
+
+def test_pools_pickle_empty():
+    pool = CanvasPool(max_bytes=1000)
+    pool.release(np.zeros(10, dtype=np.uint8))
+    copy = pickle.loads(pickle.dumps(pool))
+    assert copy.max_bytes == 1000 and copy.stats()["free_buffers"] == 0
+
+@pytest.mark.parametrize("kind", ["block", "text"])
+def test_rendered_images_belong_to_the_caller(kind):
+    pool = CanvasPool()
+    renderer = _renderer(kind, QRGenerator("first payload"), pool)
+    image = renderer.render()
+    pixels = image.tobytes()
+
+    # Nothing from render() is returned to the pool, so later renders cannot draw over it
+    assert pool.stats()["free_buffers"] == 0
+    other = _renderer(kind, QRGenerator("other payload"), pool).render()
+    assert other is not image and image.tobytes() == pixels
+
+@pytest.mark.parametrize("kind", ["block", "text"])
+def test_render_to_returns_its_buffers(kind):
+    pool = CanvasPool()
+    QR = QRGenerator("pooled payload")
+    expected = BytesIO()
+    _renderer(kind, QR, None).render_to(expected)
+
+    # Every render after the first draws on buffers the previous one returned
+    for _ in range(3):
+        output = BytesIO()
+        _renderer(kind, QR, pool).render_to(output)
+        assert output.getvalue() == expected.getvalue()
+    assert pool.stats()["free_buffers"] > 0 and pool.stats()["hits"] > 0
+    assert pool.stats()["misses"] == pool.stats()["free_buffers"]
+
+def test_compiled_plans_draw_on_their_pool():
+    pool = CanvasPool()
+    spec = RenderSpec(QRBlockRenderer, RenderSettings(px_per_cell=4), protocol=_blockProtocol, output_format="PNG")
+    plan = spec.compile(canvas_pool=pool)
+    for payload in ("first payload", "second payload", "third payload"):
+        assert plan.render_payload(payload) == spec.render(payload)
+    assert pool.stats()["hits"] > 0
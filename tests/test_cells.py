@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from customQR.QREngine import QRGenerator, QRRenderer, RenderSettings
+
+@pytest.fixture(params=[1, 2, 3])
+def grid(request):
+    QR = QRGenerator("cell grid")
+    return QRRenderer(QR, RenderSettings(px_per_cell=2, cells_per_block=request.param)).get_cell_grid()
+
+def test_cells_index_like_a_list(grid):
+    cells = list(grid)
+    assert len(grid) == len(cells)
+    for index in (0, 1, len(cells) - 1, -1, -len(cells), np.int64(7)):
+        assert grid[index] == cells[index]
+    for index in (len(cells), -len(cells) - 1):
+        with pytest.raises(IndexError):
+            grid[index]
+
+@pytest.mark.parametrize("index", [slice(None), slice(3, 20), slice(-5, None), slice(None, None, -7),
+                                   slice(100, 2, -3), slice(10 ** 6, None)])
+def test_cells_slice_like_a_list(grid, index):
+    assert grid[index] == list(grid)[index]
@@ -0,0 +1,81 @@
+import json
+import os
+import tarfile
+
+import pytest
+
+from customQR.QRCli import load_spec, main, run
+
+RECORDS = [(f"code-{i}", f"payload {i}") for i in range(10)]
+
+# Define function to yield records, stopping the run partway as an interrupt would
+def _interrupted(records, after: int):
+    for index, record in enumerate(records):
+        if index == after:
+            raise KeyboardInterrupt
+        yield record
+
+def _outputs(directory):
+    return sorted(name for name in os.listdir(directory) if not name.endswith(".part"))
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_resume_continues_after_the_checkpoint(tmp_path, workers):
+    output, checkpoint = str(tmp_path / "out"), str(tmp_path / "out.checkpoint.json")
+    spec = load_spec({"px_per_cell": 2})
+
+    with pytest.raises(KeyboardInterrupt):
+        run(_interrupted(RECORDS, 6), spec, output, workers=workers, chunksize=1,
+            checkpoint_path=checkpoint, checkpoint_every=4, log=None)
+
+    # Workers read ahead of the results, so the checkpoint covers the records written before the interrupt
+    done = json.load(open(checkpoint))["done"]
+    assert _outputs(output) == sorted(f"{name}.png" for name, _ in RECORDS[:done])
+
+    # The resumed run renders only the records after the checkpoint, then drops it
+    assert run(iter(RECORDS), spec, output, workers=workers, checkpoint_path=checkpoint, resume=True, log=None) == 10 - done
+    assert _outputs(output) == sorted(f"{name}.png" for name, _ in RECORDS)
+    assert not os.path.exists(checkpoint)
+
+def test_resume_appends_to_a_tar_archive(tmp_path):
+    output, checkpoint = str(tmp_path / "out.tar"), str(tmp_path / "out.checkpoint.json")
+    spec = load_spec({"px_per_cell": 2})
+
+    with pytest.raises(KeyboardInterrupt):
+        run(_interrupted(RECORDS, 5), spec, output, workers=0, checkpoint_path=checkpoint, checkpoint_every=3, log=None)
+    run(iter(RECORDS), spec, output, workers=0, checkpoint_path=checkpoint, resume=True, log=None)
+
+    with tarfile.open(output) as archive:
+        assert archive.getnames() == [f"{name}.png" for name, _ in RECORDS]
+
+def test_repeated_names_do_not_overwrite_outputs(tmp_path):
+    output, checkpoint = str(tmp_path / "out"), str(tmp_path / "out.checkpoint.json")
+    records = [("a", "1"), ("a", "2"), ("a-1", "3"), (None, "4"), ("a", "5"), ("00000003", "6")]
+    expected = ["a.png", "a-1.png", "a-1-1.png", "00000003.png", "a-2.png", "00000003-1.png"]
+    spec = load_spec({"px_per_cell": 2})
+
+    # Names stay the same when the repeats are split across a resumed run
+    with pytest.raises(KeyboardInterrupt):
+        run(_interrupted(records, 3), spec, output, workers=0, checkpoint_path=checkpoint, checkpoint_every=1, log=None)
+    run(iter(records), spec, output, workers=0, checkpoint_path=checkpoint, resume=True, log=None)
+    assert _outputs(output) == sorted(expected)
+
+@pytest.mark.parametrize("alias, output_format, extension", [("jpg", "JPEG", "jpg"), ("tif", "TIFF", "tiff"), ("webp", "WEBP", "webp")])
+def test_format_aliases(tmp_path, alias, output_format, extension):
+    spec = load_spec({"format": alias, "px_per_cell": 2})
+    assert spec.output_format == output_format
+
+    run(iter(RECORDS[:1]), spec, str(tmp_path), workers=0, log=None)
+    assert _outputs(tmp_path) == [f"code-0.{extension}"]
+
+def test_failed_records_are_logged_with_workers(tmp_path):
+    input_path, output = tmp_path / "input.txt", str(tmp_path / "out")
+    config = tmp_path / "config.json"
+    input_path.write_text("first\nsecond\n")
+    config.write_text(json.dumps({"px_per_cell": 4, "verify": True, "min_contrast": 0.5,
+                                  "block": {"light_color": [200, 200, 200], "dark_color": [170, 170, 170]}}))
+
+    main([str(input_path), output, "--config", str(config), "--workers", "2", "--quiet"])
+    errors = [json.loads(line) for line in open(output + ".errors.jsonl")]
+    assert [error["payload"] for error in errors] == ["first", "second"]
+    assert all(error["error"].startswith("VerificationError") for error in errors)
+    assert _outputs(output) == []
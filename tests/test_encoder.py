@@ -0,0 +1,81 @@
+import random
+import string
+
+import numpy as np
+import pytest
+import qrcode
+
+from customQR.QREncoder import encode_matrix
+from customQR.QREngine import QRGenerator
+
+# Error correction levels, in qrcode's constants
+LEVELS = (qrcode.constants.ERROR_CORRECT_L, qrcode.constants.ERROR_CORRECT_M,
+          qrcode.constants.ERROR_CORRECT_Q, qrcode.constants.ERROR_CORRECT_H)
+
+# Payloads covering every mode, qrcode's numeric and alphanumeric run splitting, and capacity edges
+PAYLOADS = (
+    "",
+    "0",
+    "0123456789",
+    "12345678901234567890",
+    "123456789012345678901",
+    "HELLO WORLD",
+    "HTTPS://EXAMPLE.COM/ORDERS/12345678901234567890/ITEM/0042",
+    "https://example.com/verify/12345",
+    "héllo wörld ✓ 0123456789",
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:" * 4,
+    "".join(random.Random(21).choice(string.printable) for _ in range(700)),
+    "9" * 1500,
+)
+
+# Define function to get qrcode's matrix for a payload
+def _reference(data, error_correction, border, version=None, mask_pattern=None):
+    QR = qrcode.QRCode(version=version, error_correction=error_correction, border=border, mask_pattern=mask_pattern)
+    QR.add_data(data)
+    QR.make()
+    return np.array(QR.get_matrix(), dtype=bool)
+
+# Define function to check the native matrix against qrcode's, including which payloads overflow
+def _checkParity(data, error_correction, border, version=None, mask_pattern=None):
+    try:
+        expected = _reference(data, error_correction, border, version, mask_pattern)
+    except ValueError:
+        with pytest.raises(ValueError):
+            encode_matrix(data, error_correction, border, version, mask_pattern)
+        return
+
+    matrix = encode_matrix(data, error_correction, border, version, mask_pattern)
+    assert matrix.shape == expected.shape
+    assert np.array_equal(matrix, expected)
+
+@pytest.mark.parametrize("error_correction", LEVELS)
+@pytest.mark.parametrize("border", (0, 1, 4))
+@pytest.mark.parametrize("data", PAYLOADS)
+def test_matrix_matches_qrcode(data, error_correction, border):
+    _checkParity(data, error_correction, border)
+
+@pytest.mark.parametrize("error_correction", LEVELS)
+@pytest.mark.parametrize("version", (1, 7, 10, 27, 40))
+@pytest.mark.parametrize("data", ("", "12345678901234567890", "HELLO WORLD", "https://example.com/verify/12345",
+                                  "héllo wörld ✓ 0123456789"))
+def test_matrix_matches_qrcode_at_explicit_version(data, error_correction, version):
+    _checkParity(data, error_correction, 4, version)
+
+@pytest.mark.parametrize("mask_pattern", range(8))
+def test_matrix_matches_qrcode_with_fixed_mask(mask_pattern):
+    _checkParity("https://example.com/verify/12345", qrcode.constants.ERROR_CORRECT_Q, 2, 3, mask_pattern)
+
+def test_matrix_matches_qrcode_for_random_payloads():
+    rng = random.Random(2021)
+    alphabets = (string.digits, "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:", string.printable, "héllo wörld ✓")
+    for _ in range(80):
+        data = "".join(rng.choice(rng.choice(alphabets)) for _ in range(rng.choice((1, 19, 21, 60, 300))))
+        _checkParity(data, rng.choice(LEVELS), rng.choice((0, 1, 4)), rng.choice((None, None, 5, 12)))
+
+@pytest.mark.parametrize("optimize_segments", (False, True))
+def test_generator_backends_agree(optimize_segments):
+    data = "HTTPS://EXAMPLE.COM/ORDERS/12345678901234567890/ITEM/0042"
+    for error_correction in LEVELS:
+        reference = QRGenerator(data, error_correction, optimize_segments=optimize_segments)
+        native = QRGenerator(data, error_correction, encoder="native", optimize_segments=optimize_segments)
+        assert np.array_equal(native.QRMatrix, reference.QRMatrix)
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+from PIL import Image
+
+from customQR.QRBatch import RenderFailure, RenderSpec, render_batch
+from customQR.QRBlock import QRBlockRenderer, SimpleBlockProtocol
+from customQR.QRCache import OutputCache
+from customQR.QREngine import RenderSettings
+from customQR.QRImage import QRImageBlockRenderer, QRImageStyle
+from customQR.QRText import QRTextBlockRenderer, QRTextStyle
+from customQR.QRVector import QRVectorRenderer
+
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+# Payloads of the same size reuse one compiled renderer, the last one needs a larger code
+PAYLOADS = ["first payload", "second payload", "third payload " * 8]
+
+# Define text protocol drawing dark modules as #
+def _textProtocol(cell, qr, style, renderSettings):
+    return ("#", (0, 0, 0)) if cell.value else (".", (200, 200, 200))
+
+# Define function to build one spec per renderer type
+def _specs(directory):
+    on, off = str(directory / "on.png"), str(directory / "off.png")
+    Image.new("RGB", (8, 8), (20, 40, 60)).save(on)
+    Image.new("RGB", (8, 8), (230, 220, 210)).save(off)
+
+    settings = RenderSettings(px_per_cell=8, cells_per_block=1)
+    return {
+        "block": RenderSpec(QRBlockRenderer, settings, output_format="PNG"),
+        "text": RenderSpec(QRTextBlockRenderer, settings, style=QRTextStyle(FONT_PATH), protocol=_textProtocol, output_format="PNG"),
+        "image": RenderSpec(QRImageBlockRenderer, settings, style=QRImageStyle(on_image_filename=on, off_image_filename=off),
+                            output_format="PNG"),
+        "vector": RenderSpec(QRVectorRenderer, settings, output_format="SVG"),
+    }
+
+@pytest.fixture(params=["block", "text", "image", "vector"])
+def spec(request, tmp_path):
+    return _specs(tmp_path)[request.param]
+
+def test_compiled_plan_matches_spec(spec):
+    plan = spec.compile()
+    for payload in PAYLOADS:
+        assert plan.render_payload(payload) == spec.render(payload)
+
+def test_render_batch_matches_spec(spec):
+    results = list(render_batch(PAYLOADS, spec, max_workers=2, chunksize=1))
+    assert results == [spec.render(payload) for payload in PAYLOADS]
+
+def test_worker_failures_are_captured_per_payload():
+    # Every payload fails verification, including the warm-up; an over-capacity payload fails to encode
+    spec = RenderSpec(QRBlockRenderer, RenderSettings(px_per_cell=4, verify=True, min_contrast=0.5),
+                      protocol=SimpleBlockProtocol((200, 200, 200), (170, 170, 170)), output_format="PNG")
+    payloads = ["first payload", "x" * 8000, "second payload"]
+    results = list(render_batch(payloads, spec, max_workers=2, chunksize=1, capture_failures=True))
+
+    assert [type(result) for result in results] == [RenderFailure] * 3
+    assert [result.payload for result in results] == payloads
+    assert results[0].error.startswith("VerificationError")
+
+def test_warmup_output_is_not_cached(tmp_path):
+    spec = RenderSpec(QRBlockRenderer, RenderSettings(px_per_cell=4), output_format="PNG",
+                      output_cache=OutputCache(directory=str(tmp_path)))
+    assert list(render_batch(["payload"], spec, max_workers=1)) == [spec.render("payload")]
+
+    cached = [name for _, _, names in os.walk(tmp_path) for name in names if not name.startswith(".")]
+    assert cached == [spec.cache_key("payload")]
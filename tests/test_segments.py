@@ -0,0 +1,83 @@
+import itertools
+import random
+
+import pytest
+from qrcode.util import MODE_8BIT_BYTE, MODE_ALPHA_NUM, MODE_NUMBER
+
+from customQR.QREncoder import _segmentBits, best_version, fit_optimal_segments, optimal_segments, segment_data
+
+# Characters by the cheapest mode that holds them; "é" is two bytes that only fit byte mode
+DIGITS = "0123456789"
+ALPHANUMERIC = DIGITS + "ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:"
+KINDS = (DIGITS, "ABC -./", "ab?é")
+
+# Mode names by qrcode's mode constants
+MODES = {MODE_NUMBER: "numeric", MODE_ALPHA_NUM: "alphanumeric", MODE_8BIT_BYTE: "byte"}
+
+# Length field sizes per mode (numeric, alphanumeric, byte) for versions 1-9, 10-26 and 27-40
+LENGTH_BITS = {1: (10, 9, 8), 10: (12, 11, 16), 27: (14, 13, 16)}
+
+# Define function to count the bits of one segment straight from the QR specification
+# Returns None when the chunk cannot be encoded in the mode
+def _segmentCost(chunk: bytes, mode: str, version: int):
+
+    numeric_bits, alphanumeric_bits, byte_bits = LENGTH_BITS[version]
+    text = chunk.decode("latin-1")
+    if mode == "numeric" and all(char in DIGITS for char in text):
+        return 4 + numeric_bits + 10 * (len(chunk) // 3) + (0, 4, 7)[len(chunk) % 3]
+    if mode == "alphanumeric" and all(char in ALPHANUMERIC for char in text):
+        return 4 + alphanumeric_bits + 11 * (len(chunk) // 2) + 6 * (len(chunk) % 2)
+    if mode == "byte":
+        return 4 + byte_bits + 8 * len(chunk)
+    return None
+
+# Define function to find the fewest bits over every split of data and every mode for each part
+# Parts are independent once the split is fixed, so each takes its cheapest mode
+def _bruteForce(data: bytes, version: int):
+
+    best = None
+    for cuts in itertools.product((False, True), repeat=len(data) - 1):
+        bounds = [0] + [i + 1 for i, cut in enumerate(cuts) if cut] + [len(data)]
+        total = 0
+        for start, end in zip(bounds, bounds[1:]):
+            costs = [_segmentCost(data[start:end], mode, version) for mode in MODES.values()]
+            total += min(cost for cost in costs if cost is not None)
+        if best is None or total < best:
+            best = total
+    return best
+
+@pytest.mark.parametrize("version", sorted(LENGTH_BITS))
+def test_optimal_segments_match_brute_force(version):
+    rng = random.Random(version)
+    for _ in range(40):
+
+        # Runs of one kind of character, so splitting can pay off
+        text = ""
+        while len(text.encode("utf-8")) < 10:
+            kind = rng.choice(KINDS)
+            text += "".join(rng.choice(kind) for _ in range(rng.randint(1, 8)))
+        text = text.encode("utf-8")[:10].decode("utf-8", "ignore")
+        data = text.encode("utf-8")
+        segments = optimal_segments(text, version)
+
+        # Segments cover the data in order, each in a mode that holds it
+        assert b"".join(chunk for _, chunk in segments) == data
+        assert all(_segmentCost(chunk, MODES[mode], version) is not None for mode, chunk in segments)
+        assert _segmentBits(segments, version)[1] == _bruteForce(data, version), text
+
+def test_optimal_segments_of_nothing():
+    assert optimal_segments("") == []
+
+def test_optimal_segments_never_need_a_larger_version():
+    rng = random.Random(22)
+    alphabets = (DIGITS, ALPHANUMERIC[10:], "abcdefghijklmnopqrstuvwxyz-_?=&")
+    for _ in range(100):
+        text = "".join("".join(rng.choice(rng.choice(alphabets)) for _ in range(rng.choice((3, 12, 40, 150))))
+                       for _ in range(rng.randint(1, 6)))
+        for error_correction in range(4):
+            try:
+                default = best_version(segment_data(text), error_correction)
+            except ValueError:
+                continue
+            _, version = fit_optimal_segments(text, error_correction)
+            assert version <= default, text
@@ -0,0 +1,49 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from customQR.QRBatch import RenderSpec, render_batch
+from customQR.QREngine import RenderSettings
+from customQR.QRShared import SharedImage
+
+# Define function to list the shared memory blocks that exist
+def _blocks():
+    return set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+
+# Define function to round trip an image through a handle, as a worker and the parent would
+def _roundTrip(image):
+    handle = pickle.loads(pickle.dumps(SharedImage.create(image)))
+    with handle as shared:
+        return shared.copy()
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA", "1", "I", "F"])
+def test_pixels_round_trip(mode):
+    image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (37, 53, 4), dtype=np.uint8), "RGBA").convert(mode)
+    shared = _roundTrip(image)
+    assert shared.mode == mode and shared.tobytes() == image.tobytes()
+
+@pytest.mark.parametrize("palette_mode", ["RGB", "RGBA"])
+def test_palette_images_keep_their_colors(palette_mode):
+    image = Image.fromarray(np.arange(64 * 16, dtype=np.uint8).reshape(64, 16) % 7)
+    image.putpalette(bytes(range(7 * len(palette_mode))) + bytes(3), palette_mode)
+    image.info["transparency"] = 3
+
+    shared = _roundTrip(image)
+    assert shared.mode == "P"
+    assert shared.getpalette(palette_mode) == image.getpalette(palette_mode)
+    assert shared.info["transparency"] == 3
+    assert shared.convert("RGBA").tobytes() == image.convert("RGBA").tobytes()
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="needs /dev/shm to list blocks")
+def test_stopping_early_frees_every_block():
+    before = _blocks()
+    spec = RenderSpec(renderSettings=RenderSettings(px_per_cell=2))
+    batch = render_batch((f"payload {i}" for i in range(40)), spec, max_workers=2, chunksize=4, shared_memory=True)
+
+    # Take one image, then stop with chunks both yielded in part and still in flight
+    next(batch).release()
+    batch.close()
+    assert _blocks() - before == set()
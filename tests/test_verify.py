@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from customQR.QRBlock import QRBlockRenderer
+from customQR.QREngine import QRGenerator, RenderSettings
+from customQR.QRVerify import VerificationError, check_render, verify_image
+
+QR = QRGenerator("verify payload " * 4)
+
+def _render(px_per_cell: int, cells_per_block: int = 1):
+    renderSettings = RenderSettings(px_per_cell=px_per_cell, cells_per_block=cells_per_block)
+    return QRBlockRenderer(QR, renderSettings).render(), renderSettings
+
+@pytest.mark.parametrize("px_per_cell", [1, 2, 3, 5, 10])
+@pytest.mark.parametrize("cells_per_block", [1, 2])
+def test_clean_renders_verify_at_full_contrast(px_per_cell, cells_per_block):
+    image, renderSettings = _render(px_per_cell, cells_per_block)
+    report = verify_image(image, QR, renderSettings)
+    assert report.mismatch_count == 0 and report.contrast_margin == 1.0
+    assert (report.dark_level, report.light_level) == (0.0, 255.0)
+
+def test_only_the_middle_of_each_cell_is_read():
+
+    # Paint the outer ring of every cell grey; the samples stay inside it
+    image, renderSettings = _render(10)
+    pixels = np.array(image.convert("RGB"))
+    ring = np.zeros((10, 10), dtype=bool)
+    ring[[0, 1, 8, 9], :] = ring[:, [0, 1, 8, 9]] = True
+    pixels[np.tile(ring, (QR.height, QR.width))] = 128
+    report = verify_image(Image.fromarray(pixels), QR, renderSettings)
+    assert report.mismatch_count == 0 and report.contrast_margin == 1.0
+
+@pytest.mark.parametrize("mode", ["RGB", "L", "1", "P", "LA"])
+def test_modes_read_the_same(mode):
+    image, renderSettings = _render(4)
+    assert np.array_equal(verify_image(image.convert(mode), QR, renderSettings).levels,
+                          verify_image(image, QR, renderSettings).levels)
+
+def test_transparent_pixels_read_as_white():
+
+    # Light modules are transparent black
+    image, renderSettings = _render(4)
+    pixels = np.array(image)
+    pixels[pixels[..., 0] == 255] = (0, 0, 0, 0)
+    for transparent in (Image.fromarray(pixels), Image.fromarray(pixels).convert("P")):
+        report = verify_image(transparent, QR, renderSettings)
+        assert report.mismatch_count == 0 and report.light_level == 255.0
+
+def test_flipped_modules_are_reported():
+    image, renderSettings = _render(4)
+    pixels = np.array(image)
+    pixels[8:12, 40:44] = 255 - pixels[8:12, 40:44]
+    pixels[..., 3] = 255
+    report = verify_image(Image.fromarray(pixels), QR, renderSettings)
+    assert report.mismatches.tolist() == [[2, 10]]
+    assert report.contrast_margin <= 0
+
+    with pytest.raises(VerificationError):
+        check_render(Image.fromarray(pixels), QR, RenderSettings(px_per_cell=4, verify=True))